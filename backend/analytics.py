@@ -0,0 +1,380 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, date, timedelta
+from typing import Optional, Dict, Any, List
+
+from sqlalchemy import text
+
+from database import ReaderSessionLocal, oldest_transaction_start
+from ids import TransactionId
+from models import CurrencyType, TransactionStatusType
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.fs
+    import pyarrow.parquet as pq
+except ImportError:  # analytics snapshot is optional, reports fall back to SQL
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_DIR = os.getenv(
+    "ANALYTICS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "analytics_snapshot")
+)
+# Seconds between snapshot exports; 0 disables the background exporter
+ANALYTICS_EXPORT_INTERVAL = int(os.getenv("ANALYTICS_EXPORT_INTERVAL", "3600"))
+SNAPSHOT_COLUMNS = (
+    "id", "date", "day", "amount", "benefited_amount", "tax_rate", "tax_amount",
+    "currency", "status", "branch_id", "destination_branch_id"
+)
+
+if pa is not None:
+    SNAPSHOT_SCHEMA = pa.schema([
+        ("id", pa.string()),
+        ("date", pa.timestamp("us")),
+        ("day", pa.string()),
+        ("amount", pa.float64()),
+        ("benefited_amount", pa.float64()),
+        ("tax_rate", pa.float64()),
+        ("tax_amount", pa.float64()),
+        ("currency", pa.string()),
+        ("status", pa.string()),
+        ("branch_id", pa.int64()),
+        ("destination_branch_id", pa.int64()),
+    ])
+
+# The exporter keeps a watermark instead of re-reading history: every
+# transactions row carries updated_at, stamped by the database on insert and
+# on every UPDATE (status changes, receipts). A run re-reads only the days that
+# have a row updated since the previous watermark, plus the days that closed
+# since the previous run. The watermark is the start of the oldest transaction
+# open in the database when the run begins, so a change committed after it read
+# its rows is stamped no earlier than the next run's watermark. Transactions
+# are never deleted one by one; whole months leave with archived partitions.
+_CHANGED_DAYS_SQL = text("""
+    SELECT DISTINCT to_char(date, 'YYYY-MM-DD') AS day
+    FROM transactions
+    WHERE date < :boundary AND (updated_at >= :since OR date >= :closed_since)
+""")
+
+_ALL_MONTHS_SQL = text("""
+    SELECT DISTINCT to_char(date, 'YYYY-MM') AS month FROM transactions WHERE date < :boundary
+""")
+
+_FIRST_MONTH_SQL = text("SELECT to_char(min(date), 'YYYY-MM') FROM transactions")
+
+_ROWS_SQL = text("""
+    SELECT id, date, to_char(date, 'YYYY-MM-DD') AS day, amount, benefited_amount, tax_rate, tax_amount,
+           currency, status, branch_id, destination_branch_id
+    FROM transactions
+    WHERE date >= :start AND date < :end
+    ORDER BY date, id
+""").columns(id=TransactionId, currency=CurrencyType, status=TransactionStatusType)  # decoded to strings
+
+
+def is_available() -> bool:
+    return pa is not None
+
+
+def _month_path(root: str, month: str) -> str:
+    return os.path.join(root, "transactions", f"month={month}.parquet")
+
+
+def _manifest_path(root: str) -> str:
+    return os.path.join(root, "manifest.json")
+
+
+def load_manifest(root: str = ANALYTICS_DIR) -> Dict[str, Any]:
+    try:
+        with open(_manifest_path(root), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"complete_through": None, "months": []}
+
+
+def _write_manifest(root: str, manifest: Dict[str, Any]):
+    path = _manifest_path(root)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def _rows_table(rows: List[tuple]):
+    if not rows:
+        return SNAPSHOT_SCHEMA.empty_table()
+    columns = list(zip(*rows))
+    return pa.table(
+        {name: pa.array(values) for name, values in zip(SNAPSHOT_COLUMNS, columns)}
+    ).cast(SNAPSHOT_SCHEMA)
+
+
+def _write_month(root: str, month: str, table) -> bool:
+    """Replace a month's file; False when the month is empty (and has no file)"""
+    path = _month_path(root, month)
+    if table.num_rows == 0:
+        if os.path.exists(path):
+            os.remove(path)
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    pq.write_table(table, tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+    return True
+
+
+def _read_rows(db, start: datetime, end: datetime):
+    return _rows_table([tuple(row) for row in db.execute(_ROWS_SQL, {"start": start, "end": end})])
+
+
+def _midnight(day: date) -> datetime:
+    return datetime.combine(day, datetime.min.time())
+
+
+def export_snapshot(session_factory=ReaderSessionLocal, root: str = ANALYTICS_DIR) -> Dict[str, Any]:
+    """Bring the Parquet snapshot up to date with every day before today.
+
+    Transactions are stored one Parquet file per month. The first run (or one
+    without a watermark in the manifest) reads every month. Later runs read
+    only the days with rows updated since the last watermark or closed since
+    the last run, and splice them into their month files.
+    """
+    if pa is None:
+        raise RuntimeError("pyarrow is not installed")
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, ".lock"), "w") as lock_file:
+        try:
+            # Every worker runs an exporter; only one of them does the work
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return {"skipped": True}
+
+        boundary = date.today()
+        manifest = load_manifest(root)
+        months = set(manifest.get("months", []))
+        db = session_factory()
+        try:
+            # Read first: every change not yet committed is stamped at or after it
+            watermark = oldest_transaction_start(db)
+            since = manifest.get("watermark")
+            if since is None:
+                changed_days = None
+                rewrite = sorted(set(db.execute(_ALL_MONTHS_SQL, {"boundary": boundary}).scalars()) | months)
+            else:
+                previous = manifest.get("complete_through")
+                closed_since = date.fromisoformat(previous) + timedelta(days=1) if previous else date.min
+                changed_days = sorted(db.execute(_CHANGED_DAYS_SQL, {
+                    "boundary": boundary, "since": datetime.fromisoformat(since), "closed_since": closed_since
+                }).scalars())
+                rewrite = sorted({day[:7] for day in changed_days})
+
+            for month in rewrite:
+                month_start = datetime.strptime(month, "%Y-%m")
+                if changed_days is None:
+                    month_end = min((month_start + timedelta(days=32)).replace(day=1), _midnight(boundary))
+                    table = _read_rows(db, month_start, month_end)
+                else:
+                    days = [day for day in changed_days if day.startswith(month)]
+                    fresh = [_read_rows(db, _midnight(date.fromisoformat(day)),
+                                        _midnight(date.fromisoformat(day) + timedelta(days=1))) for day in days]
+                    path = _month_path(root, month)
+                    if os.path.exists(path):
+                        kept = pq.read_table(path, schema=SNAPSHOT_SCHEMA)
+                        kept = kept.filter(pc.invert(pc.is_in(kept["day"], value_set=pa.array(days))))
+                        fresh.append(kept)
+                    table = pa.concat_tables(fresh).sort_by([("date", "ascending"), ("id", "ascending")])
+                if _write_month(root, month, table):
+                    months.add(month)
+                else:
+                    months.discard(month)
+
+            # Months archived out of transactions leave the snapshot too
+            first_month = db.execute(_FIRST_MONTH_SQL).scalar()
+            archived = [month for month in months if first_month is None or month < first_month]
+            for month in archived:
+                _write_month(root, month, SNAPSHOT_SCHEMA.empty_table())
+                months.discard(month)
+        finally:
+            db.close()
+
+        manifest = {
+            "complete_through": (boundary - timedelta(days=1)).isoformat(),
+            "watermark": watermark.isoformat(),
+            "months": sorted(months),
+            "exported_at": datetime.now().isoformat(),
+        }
+        _write_manifest(root, manifest)
+        changed = "all" if changed_days is None else len(changed_days)
+        logger.info(
+            f"Analytics snapshot exported through {manifest['complete_through']}: "
+            f"{changed} days re-read, {len(rewrite)} months rewritten, {len(archived)} archived"
+        )
+        return {"changed_days": changed, "months_rewritten": len(rewrite), "archived_months": len(archived),
+                "complete_through": manifest["complete_through"]}
+
+
+class AnalyticsSnapshot:
+    """Read side of the Parquet snapshot.
+
+    Month files are memory-mapped and scanned with pyarrow; months outside the
+    requested range are never opened. Callers must check covers() first: only days
+    up to the manifest's complete_through are guaranteed to be in the snapshot.
+    """
+
+    def __init__(self, root: str = ANALYTICS_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+        self._manifest: Dict[str, Any] = {"complete_through": None, "months": []}
+        self._manifest_mtime = None
+
+    def _refresh_manifest(self):
+        try:
+            mtime = os.path.getmtime(_manifest_path(self.root))
+        except OSError:
+            return
+        if mtime != self._manifest_mtime:
+            with self._lock:
+                self._manifest = load_manifest(self.root)
+                self._manifest_mtime = mtime
+
+    def complete_through(self) -> Optional[date]:
+        if pa is None:
+            return None
+        self._refresh_manifest()
+        value = self._manifest.get("complete_through")
+        return date.fromisoformat(value) if value else None
+
+    def covers(self, end: Optional[datetime]) -> bool:
+        """True when every transaction up to `end` is in the snapshot"""
+        through = self.complete_through()
+        return through is not None and end is not None and end.date() <= through
+
+    def boundary(self) -> Optional[datetime]:
+        """First instant that is not in the snapshot"""
+        through = self.complete_through()
+        return datetime.combine(through + timedelta(days=1), datetime.min.time()) if through else None
+
+    def load(self, start: Optional[datetime], end: Optional[datetime], columns: List[str], condition=None):
+        """Return rows with start <= date <= end as a pyarrow Table"""
+        first = start.strftime("%Y-%m") if start is not None else ""
+        last = end.strftime("%Y-%m") if end is not None else "9999-12"
+        paths = [
+            _month_path(self.root, month)
+            for month in self._manifest.get("months", []) if first <= month <= last
+        ]
+        if not paths:
+            return SNAPSHOT_SCHEMA.empty_table().select(columns)
+        dataset = ds.dataset(
+            paths, schema=SNAPSHOT_SCHEMA, format="parquet",
+            filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True)
+        )
+        expression = ds.scalar(True)
+        if start is not None:
+            expression &= ds.field("date") >= start
+        if end is not None:
+            expression &= ds.field("date") <= end
+        if condition is not None:
+            expression &= condition
+        return dataset.to_table(columns=columns, filter=expression)
+
+    def _branch_condition(self, report_type: str, branch_id: Optional[int]):
+        if not branch_id:
+            return None
+        if report_type == "tax_summary":
+            return (ds.field("branch_id") == branch_id) | (ds.field("destination_branch_id") == branch_id)
+        return ds.field("branch_id") == branch_id
+
+    def report_partial(self, report_type: str, start: Optional[datetime], end: datetime,
+                       branch_id: Optional[int] = None) -> Dict[str, Any]:
+        """Same partial shape report_jobs.compute_partition produces, so merge_partials applies"""
+        condition = self._branch_condition(report_type, branch_id)
+        if report_type in ("daily", "branch", "currency"):
+            key = {"daily": "day", "branch": "branch_id", "currency": "currency"}[report_type]
+            columns = list(dict.fromkeys(["id", "amount", "currency", key]))
+            table = self.load(start, end, columns, condition)
+            grouped = table.group_by(list(dict.fromkeys([key, "currency"]))).aggregate(
+                [("amount", "sum"), ("id", "count")]
+            )
+            return {"rows": [
+                [row[key], row["currency"], row["amount_sum"] or 0.0, row["id_count"]]
+                for row in grouped.to_pylist()
+            ]}
+
+        if report_type == "daily_summary":
+            table = self.load(start, end, ["id", "status", "amount", "tax_amount"], condition)
+            grouped = table.group_by("status").aggregate(
+                [("id", "count"), ("amount", "sum"), ("tax_amount", "sum")]
+            )
+            return {"rows": [
+                [row["status"], row["id_count"], row["amount_sum"] or 0.0, row["tax_amount_sum"] or 0.0]
+                for row in grouped.to_pylist()
+            ]}
+
+        if report_type == "tax_summary":
+            completed = ds.field("status") == "completed"
+            table = self.load(
+                start, end, list(SNAPSHOT_COLUMNS),
+                completed if condition is None else condition & completed
+            ).sort_by("date")
+            return {"rows": [
+                [r["id"], r["date"].isoformat(), r["amount"], r["benefited_amount"], r["tax_rate"],
+                 r["tax_amount"], r["currency"], r["branch_id"], r["destination_branch_id"], r["status"]]
+                for r in table.to_pylist()
+            ]}
+
+        raise ValueError(f"Unknown report type: {report_type}")
+
+
+class SnapshotExporter:
+    """Background thread that calls export_snapshot() every `interval` seconds"""
+
+    def __init__(self, interval: int = ANALYTICS_EXPORT_INTERVAL):
+        self.interval = interval
+        self._thread: Optional[threading.Thread] = None
+
+    def _run(self):
+        while True:
+            try:
+                export_snapshot()
+            except Exception as e:
+                logger.error(f"Analytics snapshot export failed: {str(e)}")
+            time.sleep(self.interval)
+
+    def start(self) -> bool:
+        if pa is None or self.interval <= 0 or self._thread is not None:
+            return False
+        self._thread = threading.Thread(target=self._run, name="analytics-export", daemon=True)
+        self._thread.start()
+        return True
+
+
+# Create global snapshot reader/exporter for this worker
+analytics_snapshot = AnalyticsSnapshot()
+snapshot_exporter = SnapshotExporter()
+
+
+if __name__ == "__main__":
+    # Export once, then compare a full-history report against row-oriented SQL
+    logging.basicConfig(level=logging.INFO)
+    from report_jobs import compute_partition, merge_partials
+
+    started = time.perf_counter()
+    print("export:", export_snapshot(), f"{time.perf_counter() - started:.2f}s")
+    end = analytics_snapshot.boundary() - timedelta(microseconds=1)
+    for report_type in ("daily", "branch", "currency", "daily_summary", "tax_summary"):
+        params = {"report_type": report_type, "start_date": "1970-01-01", "end_date": end.strftime("%Y-%m-%d")}
+        started = time.perf_counter()
+        from_sql = merge_partials(params, [compute_partition(report_type, "1970-01-01T00:00:00", end.isoformat(), {})])
+        sql_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        from_parquet = merge_partials(params, [analytics_snapshot.report_partial(report_type, None, end)])
+        parquet_seconds = time.perf_counter() - started
+        print(f"{report_type:14s} sql {sql_seconds:.3f}s  parquet {parquet_seconds:.3f}s  "
+              f"same result: {json.dumps(from_sql, sort_keys=True) == json.dumps(from_parquet, sort_keys=True)}")
@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+import uuid
+from collections import namedtuple
+from typing import Optional, Dict
+
+from cache import cache
+from database import SessionLocal
+from models import Branch
+
+logger = logging.getLogger(__name__)
+
+BRANCH_DIRECTORY_CHANNEL = "branch_directory:changed"
+UNSUBSCRIBED_MAX_AGE = 60  # seconds
+
+BranchEntry = namedtuple("BranchEntry", ["id", "name", "governorate", "tax_rate"])
+
+
+class BranchDirectory:
+    """Per-worker map of branch id -> (name, governorate, tax_rate).
+
+    The whole branches table is small, so it is loaded with a single query and
+    then served from memory. Every branch mutation calls publish_change(), which
+    reloads this worker and tells the other workers (over Redis pub/sub) to
+    reload on their next lookup.
+    """
+
+    def __init__(self, session_factory=SessionLocal):
+        self._session_factory = session_factory
+        self._lock = threading.Lock()
+        self._entries: Dict[int, BranchEntry] = {}
+        self._stale = True
+        self._generation = 0  # bumped by every invalidation
+        self._loaded_at = 0.0
+        self._subscribed = False
+        self._origin = uuid.uuid4().hex
+        self.version = 0
+
+    def _subscribe(self):
+        if not self._subscribed:
+            self._subscribed = cache.subscribe(
+                BRANCH_DIRECTORY_CHANNEL, self._on_remote_change, on_stopped=self._on_subscription_stopped
+            )
+
+    def _on_subscription_stopped(self):
+        # Changes published from now on are missed: reload, then expire by age until resubscribed
+        self._subscribed = False
+        self.invalidate()
+
+    def _on_remote_change(self, message):
+        if message.get("origin") != self._origin:
+            self.invalidate()
+
+    def refresh(self):
+        """Reload all branches from the database in one query"""
+        # Subscribe first, so no change published after the query starts is missed
+        self._subscribe()
+        with self._lock:
+            generation = self._generation
+        db = self._session_factory()
+        try:
+            rows = db.query(Branch.id, Branch.name, Branch.governorate, Branch.tax_rate).all()
+        finally:
+            db.close()
+        entries = {
+            row.id: BranchEntry(row.id, row.name, row.governorate, row.tax_rate or 0.0)
+            for row in rows
+        }
+        with self._lock:
+            self._entries = entries
+            # An invalidation that arrived during the query may not be reflected in it
+            self._stale = self._generation != generation
+            self._loaded_at = time.monotonic()
+            self.version += 1
+        logger.info(f"Branch directory loaded {len(entries)} branches (version {self.version})")
+
+    def invalidate(self):
+        """Mark the directory stale so the next lookup reloads it"""
+        with self._lock:
+            self._generation += 1
+            self._stale = True
+
+    def publish_change(self):
+        """Reload after a branch mutation and notify the other workers"""
+        self.refresh()
+        cache.publish(BRANCH_DIRECTORY_CHANNEL, {"version": self.version, "origin": self._origin})
+
+    def get(self, branch_id: Optional[int], reload_on_miss: bool = False) -> Optional[BranchEntry]:
+        if branch_id is None:
+            return None
+        if self._stale or (
+            # Without pub/sub we cannot hear about other workers' changes, so expire instead
+            not self._subscribed and time.monotonic() - self._loaded_at > UNSUBSCRIBED_MAX_AGE
+        ):
+            self.refresh()
+        entry = self._entries.get(branch_id)
+        if entry is None and reload_on_miss:
+            # A branch created by another worker may not have reached us yet
+            self.refresh()
+            entry = self._entries.get(branch_id)
+        return entry
+
+    def name(self, branch_id: Optional[int], default=None):
+        entry = self.get(branch_id)
+        return entry.name if entry else default
+
+    def tax_rate(self, branch_id: Optional[int], default: float = 0.0) -> float:
+        entry = self.get(branch_id)
+        return entry.tax_rate if entry else default
+
+
+# Create a global branch directory for this worker
+branch_directory = BranchDirectory()
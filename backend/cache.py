@@ -1,7 +1,7 @@
 import redis
 import json
 from datetime import timedelta, datetime
-from typing import Optional, Any, Dict, List
+from typing import Optional, Any, Dict, List, Callable
 import logging
 import os
 
@@ -12,8 +12,24 @@ def default_serializer(obj):
         return obj.isoformat()
     raise TypeError(f"Type {type(obj)} not serializable")
 
+# KEYS are deleted as given; each ARGV is a pattern whose matches are deleted too
+_INVALIDATE_SCRIPT = """
+local deleted = 0
+for _, pattern in ipairs(ARGV) do
+    local matched = redis.call('KEYS', pattern)
+    for i = 1, #matched, 1000 do
+        deleted = deleted + redis.call('DEL', unpack(matched, i, math.min(i + 999, #matched)))
+    end
+end
+if #KEYS > 0 then
+    deleted = deleted + redis.call('DEL', unpack(KEYS))
+end
+return deleted
+"""
+
 class Cache:
     def __init__(self, host=None, port=None, db=0):
+        self._invalidate_script = None
         try:
             # Use environment variables with fallback to default values
             redis_host = host or os.getenv('REDIS_HOST', 'localhost')
@@ -85,6 +101,60 @@ class Cache:
             logger.error(f"Cache clear pattern error: {str(e)}")
             return False
 
+    def invalidate(self, keys: List[str] = (), patterns: List[str] = ()) -> bool:
+        """Delete keys and every key matching patterns in one round trip (a Lua script)"""
+        try:
+            if self.redis_client and (keys or patterns):
+                if self._invalidate_script is None:
+                    self._invalidate_script = self.redis_client.register_script(_INVALIDATE_SCRIPT)
+                return bool(self._invalidate_script(keys=list(keys), args=list(patterns)))
+            return False
+        except Exception as e:
+            logger.error(f"Cache invalidate error: {str(e)}")
+            return False
+
+    def publish(self, channel: str, message: Any) -> bool:
+        """Publish a message to every worker subscribed to a channel"""
+        try:
+            if self.redis_client:
+                self.redis_client.publish(channel, json.dumps(message, default=default_serializer))
+                return True
+            return False
+        except Exception as e:
+            logger.error(f"Cache publish error: {str(e)}")
+            return False
+
+    def subscribe(self, channel: str, callback: Callable[[Any], None],
+                  on_stopped: Optional[Callable[[], None]] = None) -> bool:
+        """Call callback with every message published on a channel, from a background thread.
+
+        If the connection fails later the subscription ends and on_stopped is
+        called; messages published from then on are missed, so the caller
+        should stop relying on them (and may subscribe again).
+        """
+        def handler(message):
+            try:
+                callback(json.loads(message["data"]))
+            except Exception as e:
+                logger.error(f"Cache subscriber error on {channel}: {str(e)}")
+
+        def on_error(e, pubsub, thread):
+            logger.error(f"Cache subscription to {channel} stopped: {str(e)}")
+            thread.stop()
+            if on_stopped is not None:
+                on_stopped()
+
+        try:
+            if self.redis_client:
+                pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{channel: handler})
+                pubsub.run_in_thread(sleep_time=1.0, daemon=True, exception_handler=on_error)
+                return True
+            return False
+        except Exception as e:
+            logger.error(f"Cache subscribe error: {str(e)}")
+            return False
+
 # Create a global cache instance
 cache = Cache()
 
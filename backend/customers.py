@@ -0,0 +1,266 @@
+import logging
+import re
+import sys
+from datetime import datetime
+from typing import Optional, List, Dict, Any
+
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import insert
+
+from database import engine
+from models import Customer, CurrencyType, CURRENCIES
+
+logger = logging.getLogger(__name__)
+
+# +963 / 00963 numbers are stored with the local 0 prefix, like tellers type them.
+# Without a + or 00, 963 only counts as the country code in front of a full
+# 9-digit number (963... is also a valid local prefix).
+_COUNTRY_PREFIX = re.compile(r"^(?:00963|963(?=\d{9}$))")
+# Alef forms and tatweel vary between tellers typing the same name
+_NAME_FOLD = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ـ": None})
+
+# The same normalisations in SQL, for rebuilding the table from transactions
+MOBILE_SQL = (
+    "regexp_replace(regexp_replace(COALESCE({column}, ''), '\\D', '', 'g'), "
+    "'^(00963|963(?=\\d{{9}}$))', '0')"
+)
+NAME_KEY_SQL = "btrim(regexp_replace(translate(lower({column}), 'أإآـ', 'ااا'), '\\s+', ' ', 'g'))"
+
+
+def normalize_mobile(value: Optional[str]) -> str:
+    digits = re.sub(r"\D", "", value or "")
+    if (value or "").strip().startswith("+963"):
+        # explicit country code, also on the partial numbers typed into a search
+        return "0" + digits[3:]
+    return _COUNTRY_PREFIX.sub("0", digits)
+
+
+def normalize_name(value: Optional[str]) -> str:
+    return " ".join((value or "").lower().translate(_NAME_FOLD).split())
+
+
+def customer_row(
+    name: Optional[str],
+    mobile: Optional[str],
+    seen_at: datetime,
+    governorate: Optional[str] = None,
+    location: Optional[str] = None,
+    id_number: Optional[str] = None,
+    sent: int = 0,
+    received: int = 0,
+    amount: float = 0.0,
+    currency: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
+    """Values for one upsert into customers, or None when there is no name to key on"""
+    name_key = normalize_name(name)
+    if not name_key:
+        return None
+    syp = CurrencyType.normalize(currency) == "SYP"
+    return {
+        "mobile": normalize_mobile(mobile),
+        "name_key": name_key,
+        "name": " ".join(name.split()),
+        "governorate": governorate or None,
+        "location": location or None,
+        "id_number": id_number or None,
+        "sent_count": sent,
+        "received_count": received,
+        "total_amount_syp": (amount or 0.0) if syp else 0.0,
+        "total_amount_usd": 0.0 if syp else (amount or 0.0),
+        "first_seen": seen_at,
+        "last_seen": seen_at,
+    }
+
+
+def _merge(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """One row per key (a customer can be both sender and receiver), sorted by key.
+
+    A single INSERT ... ON CONFLICT cannot update the same row twice, and a
+    fixed key order keeps concurrent upserts of the same two customers from
+    locking them in opposite orders.
+    """
+    merged: Dict[tuple, Dict[str, Any]] = {}
+    for row in rows:
+        key = (row["mobile"], row["name_key"])
+        if key not in merged:
+            merged[key] = dict(row)
+            continue
+        target = merged[key]
+        for column in ("sent_count", "received_count", "total_amount_syp", "total_amount_usd"):
+            target[column] += row[column]
+        for column in ("governorate", "location", "id_number"):
+            target[column] = row[column] or target[column]
+        target["first_seen"] = min(target["first_seen"], row["first_seen"])
+        target["last_seen"] = max(target["last_seen"], row["last_seen"])
+    return [merged[key] for key in sorted(merged)]
+
+
+def _upsert_statement(values):
+    stmt = insert(Customer).values(values)
+    current = Customer.__table__.c
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["mobile", "name_key"],
+        set_={
+            "name": stmt.excluded.name,
+            "governorate": func.coalesce(stmt.excluded.governorate, current.governorate),
+            "location": func.coalesce(stmt.excluded.location, current.location),
+            "id_number": func.coalesce(stmt.excluded.id_number, current.id_number),
+            "sent_count": current.sent_count + stmt.excluded.sent_count,
+            "received_count": current.received_count + stmt.excluded.received_count,
+            "total_amount_syp": current.total_amount_syp + stmt.excluded.total_amount_syp,
+            "total_amount_usd": current.total_amount_usd + stmt.excluded.total_amount_usd,
+            "first_seen": func.least(current.first_seen, stmt.excluded.first_seen),
+            "last_seen": func.greatest(current.last_seen, stmt.excluded.last_seen),
+        }
+    )
+    return stmt
+
+
+def upsert_statements(rows: List[Optional[Dict[str, Any]]]) -> list:
+    """One single-row upsert per customer, in key order.
+
+    SQLAlchemy caches the compiled form of a single-row INSERT but compiles a
+    multi-row VALUES list again on every execution.
+    """
+    return [_upsert_statement(row) for row in _merge([row for row in rows if row])]
+
+
+def upsert_customers(db, rows: List[Optional[Dict[str, Any]]]):
+    """Insert or update customers in the caller's transaction (committed with it)"""
+    rows = _merge([row for row in rows if row])
+    if rows:
+        db.execute(_upsert_statement(rows))
+
+
+def search_filters(
+    name: Optional[str] = None,
+    mobile: Optional[str] = None,
+    id_number: Optional[str] = None,
+    governorate: Optional[str] = None,
+    user_type: Optional[str] = None
+) -> list:
+    """Predicates for /customers/; name and mobile are prefix matches on indexed keys"""
+    predicates = []
+    if name:
+        predicates.append(Customer.name_key.startswith(normalize_name(name), autoescape=True))
+    if mobile:
+        predicates.append(Customer.mobile.startswith(normalize_mobile(mobile), autoescape=True))
+    if id_number:
+        predicates.append(Customer.id_number == id_number.strip())
+    if governorate:
+        predicates.append(Customer.governorate == governorate)
+    if user_type == "sender":
+        predicates.append(Customer.sent_count > 0)
+    elif user_type == "receiver":
+        predicates.append(Customer.received_count > 0)
+    return predicates
+
+
+def autocomplete_filter(term: str):
+    """Digits search the mobile prefix index; anything else the name prefix index"""
+    term = term.strip()
+    if term and not re.search(r"[^\d\s+()-]", term):
+        return Customer.mobile.startswith(normalize_mobile(term), autoescape=True)
+    return Customer.name_key.startswith(normalize_name(term), autoescape=True)
+
+
+def customer_dict(customer: Customer) -> Dict[str, Any]:
+    return {
+        "id": customer.id,
+        "name": customer.name,
+        "mobile": customer.mobile,
+        "governorate": customer.governorate,
+        "location": customer.location,
+        "id_number": customer.id_number,
+        "sent_count": customer.sent_count,
+        "received_count": customer.received_count,
+        "total_amount_syp": customer.total_amount_syp,
+        "total_amount_usd": customer.total_amount_usd,
+        "first_seen": customer.first_seen.strftime("%Y-%m-%d %H:%M:%S") if customer.first_seen else None,
+        "last_seen": customer.last_seen.strftime("%Y-%m-%d %H:%M:%S") if customer.last_seen else None,
+    }
+
+
+def rebuild_customers(bind=engine) -> int:
+    """Recompute the whole customers table from transactions (initial backfill or repair).
+
+    Id numbers and addresses only ever come from pickups, so they are carried
+    over from the existing rows rather than recomputed.
+    """
+    syp = CURRENCIES["SYP"]
+    party_sql = """
+        SELECT {mobile} AS mobile, {name_key} AS name_key,
+               btrim(regexp_replace(t.{party}, '\\s+', ' ', 'g')) AS name,
+               t.{party}_governorate AS governorate, {location} AS location,
+               {sent} AS sent, {received} AS received, t.amount, t.currency, t.date
+        FROM transactions t
+        LEFT JOIN transaction_details d ON d.transaction_id = t.id
+        WHERE btrim(COALESCE(t.{party}, '')) <> ''
+    """
+    parties = " UNION ALL ".join(
+        party_sql.format(
+            party=party,
+            mobile=MOBILE_SQL.format(column=f"d.{party}_mobile"),
+            name_key=NAME_KEY_SQL.format(column=f"t.{party}"),
+            location=f"d.{party}_location",
+            sent=int(party == "sender"),
+            received=int(party == "receiver"),
+        )
+        for party in ("sender", "receiver")
+    )
+    with bind.begin() as conn:
+        conn.execute(text("LOCK TABLE customers IN EXCLUSIVE MODE"))
+        conn.execute(text(
+            "CREATE TEMP TABLE customers_kept ON COMMIT DROP AS "
+            "SELECT mobile, name_key, id_number, location FROM customers WHERE id_number IS NOT NULL"
+        ))
+        conn.execute(text("TRUNCATE customers"))
+        rebuilt = conn.execute(text(f"""
+            INSERT INTO customers (mobile, name_key, name, governorate, location, sent_count, received_count,
+                                   total_amount_syp, total_amount_usd, first_seen, last_seen)
+            SELECT mobile, name_key,
+                   (array_agg(name ORDER BY date DESC))[1],
+                   (array_agg(governorate ORDER BY date DESC) FILTER (WHERE governorate IS NOT NULL))[1],
+                   (array_agg(location ORDER BY date DESC) FILTER (WHERE location IS NOT NULL))[1],
+                   sum(sent), sum(received),
+                   COALESCE(sum(amount) FILTER (WHERE currency = {syp}), 0),
+                   COALESCE(sum(amount) FILTER (WHERE currency IS DISTINCT FROM {syp}), 0),
+                   min(date), max(date)
+            FROM ({parties}) parties
+            WHERE name_key <> ''
+            GROUP BY mobile, name_key
+        """)).rowcount
+        conn.execute(text("""
+            UPDATE customers c SET id_number = k.id_number, location = COALESCE(k.location, c.location)
+            FROM customers_kept k WHERE k.mobile = c.mobile AND k.name_key = c.name_key
+        """))
+    logger.info(f"Rebuilt customers from transactions: {rebuilt} rows")
+    return rebuilt
+
+
+if __name__ == "__main__":
+    # python customers.py rebuild | check
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "check"
+    if command == "rebuild":
+        print(f"{rebuild_customers()} customers")
+
+    # The Python and SQL normalisations must agree, or upserts and rebuilds
+    # would key the same person differently
+    samples = [
+        ("  أحمد   الخطيب ", "+963 991 234 567"),
+        ("إيمان", "00963991234567"),
+        ("Omar  Ali", "0991-234-567"),
+        ("آمنة ـ", None),
+        ("Sami", "963 991 234 567"),
+        ("Rami", "0963123456"),
+    ]
+    with engine.connect() as conn:
+        for name, mobile in samples:
+            sql_mobile, sql_name = conn.execute(text(
+                f"SELECT {MOBILE_SQL.format(column=':mobile')}, {NAME_KEY_SQL.format(column=':name')}"
+            ), {"mobile": mobile, "name": name}).one()
+            assert (sql_mobile, sql_name) == (normalize_mobile(mobile), normalize_name(name)), \
+                (name, mobile, sql_mobile, sql_name, normalize_mobile(mobile), normalize_name(name))
+            print(f"{name!r:24} {mobile!r:22} -> {sql_name!r} {sql_mobile!r}")
+    print("normalisation OK")
@@ -20,6 +20,24 @@ engine = create_engine(
 )
 # engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(autoflush=False, bind=engine)
+
+# Long read-only work (streamed exports, report job partitions, the analytics
+# snapshot) keeps a transaction open for as long as it takes. It connects under
+# its own application_name, so oldest_transaction_start can leave it out, and
+# read-only, so it cannot write anything that name would hide.
+READER_APPLICATION_NAME = "paymentdb-reader"
+reader_engine = create_engine(
+    DATABASE_URL,
+    pool_size=5,
+    max_overflow=10,
+    pool_timeout=30,
+    pool_recycle=1800,
+    connect_args={
+        "application_name": READER_APPLICATION_NAME,
+        "options": "-c default_transaction_read_only=on",
+    }
+)
+ReaderSessionLocal = sessionmaker(autoflush=False, bind=reader_engine)
 Base = declarative_base()
 
 # Dependency to get database session
@@ -30,14 +48,39 @@ def get_db():
     finally:
         db.close()
 
+def oldest_transaction_start(conn):
+    """Start of the oldest open client transaction that may write, this one included.
+
+    Rows stamped with now() by a transaction still in flight are at or after
+    it, so everything before it has committed. Read it in a statement of its
+    own, before the query it bounds (whose snapshot then sees those commits),
+    and early in the transaction: pg_stat_activity is read once per transaction.
+
+    Sessions from reader_engine are left out, so a long export does not hold
+    the bound back. Any other session left open (an idle-in-transaction psql,
+    a stuck worker) still does, until it ends; long-running read-only work
+    belongs on ReaderSessionLocal.
+    """
+    return conn.execute(text("""
+        SELECT coalesce(min(xact_start), now())::timestamp FROM pg_stat_activity
+        WHERE datname = current_database() AND backend_type = 'client backend' AND xact_start IS NOT NULL
+          AND application_name IS DISTINCT FROM :reader
+    """), {"reader": READER_APPLICATION_NAME}).scalar()
+
+def model_indexes():
+    from models import Base as ModelBase
+    return [index for table in ModelBase.metadata.sorted_tables for index in table.indexes]
+
 def reset_database():
+    from models import CURRENCIES, TRANSACTION_STATUSES
+
     with engine.connect() as cursor:
         # Create tables with all current columns
         cursor.execute(text("""
             CREATE TABLE branches (
                 id serial PRIMARY KEY,
-                branch_id TEXT UNIQUE,
-                name TEXT UNIQUE,
+                branch_id TEXT,  -- unique index ix_branches_branch_id comes from models.py
+                name TEXT,  -- unique index ix_branches_name comes from models.py
                 location TEXT,
                 governorate TEXT,
                 phone_number TEXT,
@@ -49,13 +92,13 @@ def reset_database():
             )
         """))
         
-        cursor.execute(text("""
+        cursor.execute(text(f"""
             CREATE TABLE branch_funds (
                 id serial PRIMARY KEY,
                 branch_id INTEGER,
                 amount REAL,
-                type TEXT CHECK(type IN ('allocation', 'deduction', 'refund')),
-                currency TEXT DEFAULT 'SYP',
+                type SMALLINT,  -- models.FUND_TYPES
+                currency SMALLINT DEFAULT {CURRENCIES['SYP']},  -- models.CURRENCIES
                 description TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (branch_id) REFERENCES branches(id) ON DELETE CASCADE
@@ -65,79 +108,407 @@ def reset_database():
         cursor.execute(text("""
             CREATE TABLE users (
                 id serial PRIMARY KEY,
-                username TEXT UNIQUE,
+                username TEXT,  -- unique index ix_users_username comes from models.py
                 password TEXT,
-                role TEXT CHECK(role IN ('director', 'branch_manager', 'employee')),
+                role SMALLINT,  -- models.USER_ROLES
                 branch_id INTEGER,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (branch_id) REFERENCES branches(id) ON DELETE SET NULL
             )
         """))
         
-        cursor.execute(text("""
+        cursor.execute(text(f"""
             CREATE TABLE transactions (
-                id serial PRIMARY KEY,
+                id UUID NOT NULL,
                 sender TEXT,
-                sender_mobile TEXT,
                 sender_governorate TEXT,
-                sender_location TEXT,
                 receiver TEXT,
-                receiver_mobile TEXT,
                 receiver_governorate TEXT,
-                receiver_location TEXT,
                 amount REAL,
                 base_amount REAL DEFAULT 0.0,
                 benefited_amount REAL DEFAULT 0.0,
                 tax_rate REAL DEFAULT 0.0,
                 tax_amount REAL DEFAULT 0.0,
-                currency TEXT DEFAULT 'SYP',
-                message TEXT,
+                currency SMALLINT DEFAULT {CURRENCIES['SYP']},
                 branch_id INTEGER,
                 destination_branch_id INTEGER,
                 employee_id INTEGER,
-                employee_name TEXT,
-                branch_governorate TEXT,
-                status TEXT DEFAULT 'pending',
+                status SMALLINT DEFAULT {TRANSACTION_STATUSES['processing']},  -- models.TRANSACTION_STATUSES
                 is_received BOOLEAN DEFAULT FALSE,
                 received_by INTEGER,
                 received_at TIMESTAMP,
-                date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                payout_claimed_by INTEGER,  -- payout lease, see payouts.py
+                payout_claim_expires TIMESTAMP,
+                version INTEGER NOT NULL DEFAULT 1,  -- compare-and-swap on status changes, see transitions.py
+                updated_at TIMESTAMP DEFAULT now(),  -- analytics export watermark, see analytics.py
+                date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, date),
                 FOREIGN KEY (branch_id) REFERENCES branches(id) ON DELETE SET NULL,
                 FOREIGN KEY (destination_branch_id) REFERENCES branches(id),
                 FOREIGN KEY (employee_id) REFERENCES users(id) ON DELETE SET NULL,
                 FOREIGN KEY (received_by) REFERENCES users(id) ON DELETE SET NULL
+            ) PARTITION BY RANGE (date)
+        """))
+
+        cursor.execute(text("""
+            CREATE TABLE transaction_details (
+                transaction_id UUID PRIMARY KEY,  -- 1:1 with transactions(id)
+                sender_mobile TEXT,
+                receiver_mobile TEXT,
+                sender_location TEXT,
+                receiver_location TEXT,
+                message TEXT,
+                employee_name TEXT,
+                branch_governorate TEXT
             )
         """))
         
+        cursor.execute(text("""
+            CREATE TABLE customers (
+                id serial PRIMARY KEY,
+                mobile TEXT NOT NULL DEFAULT '',
+                name_key TEXT NOT NULL,  -- unique with mobile: idx_customers_identity
+                name TEXT,
+                governorate TEXT,
+                location TEXT,
+                id_number TEXT,
+                sent_count INTEGER DEFAULT 0,
+                received_count INTEGER DEFAULT 0,
+                total_amount_syp REAL DEFAULT 0.0,
+                total_amount_usd REAL DEFAULT 0.0,
+                first_seen TIMESTAMP,
+                last_seen TIMESTAMP
+            )
+        """))
+
         cursor.execute(text("""
             CREATE TABLE notifications (
                 id serial PRIMARY KEY,
-                transaction_id TEXT,
+                transaction_id UUID,
+                branch_id INTEGER,
                 recipient_phone TEXT,
                 message TEXT,
                 status TEXT DEFAULT 'pending',
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (transaction_id) REFERENCES transactions(id) ON DELETE CASCADE
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMP,
+                sent_at TIMESTAMP,
+                last_error TEXT
             )
         """))
         
-        # Add indexes for better performance
-        cursor.execute(text("CREATE INDEX idx_transactions_id ON transactions(id);"))
-        cursor.execute(text("CREATE INDEX idx_transactions_sender ON transactions(sender);"))
-        cursor.execute(text("CREATE INDEX idx_transactions_receiver ON transactions(receiver);"))
-        cursor.execute(text("CREATE INDEX idx_transactions_status ON transactions(status);"))
-        cursor.execute(text("CREATE INDEX idx_transaction_date ON transactions(date);"))
-        cursor.execute(text("CREATE INDEX idx_transaction_branch ON transactions(branch_id);"))
-        cursor.execute(text("CREATE INDEX idx_transaction_currency ON transactions(currency);"))
-        cursor.execute(text("CREATE INDEX idx_transaction_dates ON transactions(date, branch_id, currency, status);"))
-        cursor.execute(text("CREATE INDEX idx_transaction_destination ON transactions(destination_branch_id);"))
-        cursor.execute(text("CREATE INDEX idx_transaction_employee ON transactions(employee_id);"))
-        cursor.execute(text("CREATE INDEX idx_transaction_received ON transactions(received_by);"))
-        cursor.execute(text("CREATE INDEX idx_transaction_composite ON transactions(branch_id, status, date);"))
+        cursor.execute(text("""
+            CREATE TABLE branch_profits (
+                id serial PRIMARY KEY,
+                branch_id INTEGER,
+                transaction_id UUID,
+                profit_amount REAL DEFAULT 0.0,
+                currency SMALLINT,
+                source_type SMALLINT,  -- models.PROFIT_SOURCES
+                date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (branch_id) REFERENCES branches(id) ON DELETE CASCADE
+            )
+        """))
+
+        cursor.execute(text("""
+            CREATE TABLE branch_profit_rollups (
+                branch_id INTEGER,
+                currency SMALLINT,
+                source_type SMALLINT,
+                month DATE,  -- first day of the month
+                entries INTEGER NOT NULL DEFAULT 0,
+                profit_sum DOUBLE PRECISION NOT NULL DEFAULT 0.0,
+                PRIMARY KEY (branch_id, currency, source_type, month)
+            )
+        """))
+
+        cursor.execute(text("""
+            CREATE TABLE branch_profit_top (
+                branch_id INTEGER,
+                transaction_id UUID,
+                profit_amount REAL NOT NULL,  -- as in branch_profits, so both rank alike
+                currency SMALLINT,
+                date TIMESTAMP,
+                PRIMARY KEY (branch_id, transaction_id)
+            )
+        """))
+
+        cursor.execute(text("""
+            CREATE TABLE idempotency_keys (
+                scope TEXT,
+                key TEXT,
+                fingerprint TEXT NOT NULL,
+                status_code INTEGER NOT NULL,
+                response JSONB NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (scope, key)
+            )
+        """))
+
+        # Indexes are defined once, in the models' __table_args__
+        for index in model_indexes():
+            index.create(bind=cursor)
         
         cursor.commit()
-        print("New database created with current schema")
+
+    # Monthly partitions for transactions (plus the DEFAULT catch-all)
+    from partitions import ensure_partitions
+    ensure_partitions(engine)
+    print("New database created with current schema")
+
+
+def coded_columns():
+    """(table, column) pairs stored as smallint codes, with their models.CodedString type"""
+    from models import Base as ModelBase, CodedString
+    return [
+        (table.name, column)
+        for table in ModelBase.metadata.sorted_tables
+        for column in table.columns
+        if isinstance(column.type, CodedString)
+    ]
+
+
+def convert_coded_column(conn, table: str, column) -> bool:
+    """Convert one free-text column to the smallint codes of its models.CodedString type.
+
+    Refuses to touch a column that holds a spelling models.py has no code for,
+    so nothing is silently nulled. Returns False when there was nothing to do.
+    """
+    data_type = conn.execute(text(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_schema = 'public' AND table_name = :table AND column_name = :column"
+    ), {"table": table, "column": column.name}).scalar()
+    if data_type is None or data_type == "smallint":
+        return False
+    coded = column.type
+    spellings = dict(coded.codes)
+    spellings.update((alias, spellings[value]) for alias, value in coded.aliases)
+    unknown = conn.execute(text(
+        f"SELECT DISTINCT {column.name} FROM {table} "
+        f"WHERE {column.name} IS NOT NULL AND {column.name} <> ALL(:spellings)"
+    ), {"spellings": list(spellings)}).scalars().all()
+    if unknown:
+        raise ValueError(f"{table}.{column.name} has values without a code: {unknown}")
+
+    # CHECK (role IN (...)) style constraints compare against text
+    for (constraint,) in conn.execute(text("""
+        SELECT c.conname FROM pg_constraint c
+        JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey)
+        WHERE c.contype = 'c' AND c.conrelid = to_regclass(:table) AND a.attname = :column
+    """), {"table": f"public.{table}", "column": column.name}).all():
+        conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{constraint}"'))
+    conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column.name} DROP DEFAULT"))
+    params = {}
+    cases = []
+    for i, (spelling, code) in enumerate(spellings.items()):
+        params[f"s{i}"] = spelling
+        cases.append(f"WHEN :s{i} THEN {code}")
+    conn.execute(text(
+        f"ALTER TABLE {table} ALTER COLUMN {column.name} TYPE smallint "
+        f"USING CASE {column.name} {' '.join(cases)} END"
+    ), params)
+    if column.default is not None and column.default.is_scalar:
+        code = coded.process_bind_param(column.default.arg, None)
+        conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column.name} SET DEFAULT {code}"))
+    return True
+
+
+def migrate_coded_columns(bind=engine):
+    """Convert the free-text status/currency/type/role columns to their smallint codes.
+
+    Runs in one transaction; changing a column's type rewrites the table and
+    its indexes under an exclusive lock.
+    """
+    with bind.begin() as conn:
+        for table, column in coded_columns():
+            convert_coded_column(conn, table, column)
+
+
+def move_transaction_details(conn, source: str = "transactions", drop: bool = True) -> int:
+    """Copy the cold columns of `source` into transaction_details (and drop them from it).
+
+    Only the columns `source` still has are moved, so this is a no-op once the
+    split is done. Returns the number of rows copied.
+    """
+    from ids import uuid_cast_sql
+    from models import DETAIL_COLUMNS, TransactionDetails
+
+    present = set(conn.execute(text(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = 'public' AND table_name = :table"
+    ), {"table": source}).scalars().all())
+    columns = [name for name in DETAIL_COLUMNS if name in present]
+    if not columns:
+        return 0
+    TransactionDetails.__table__.create(bind=conn, checkfirst=True)
+    copied = conn.execute(text(
+        f"INSERT INTO transaction_details (transaction_id, {', '.join(columns)}) "
+        f"SELECT {uuid_cast_sql('id')}, {', '.join(columns)} FROM {source} "
+        f"WHERE COALESCE({', '.join(columns)}) IS NOT NULL "
+        f"ON CONFLICT (transaction_id) DO NOTHING"
+    )).rowcount
+    if drop:
+        for name in columns:
+            conn.execute(text(f"ALTER TABLE {source} DROP COLUMN {name}"))
+    return copied
+
+
+def migrate_transaction_details(bind=engine) -> int:
+    """Move message, mobiles, locations, employee_name and branch_governorate to transaction_details.
+
+    DROP COLUMN only hides the old values; the space they took in the
+    transactions partitions is reclaimed as rows are rewritten (or at once with
+    VACUUM FULL on each partition during a maintenance window).
+    """
+    with bind.begin() as conn:
+        conn.execute(text("LOCK TABLE transactions IN ACCESS EXCLUSIVE MODE"))
+        return move_transaction_details(conn)
+
+
+def migrate_payout_leases(bind=engine):
+    """Add the payout lease columns to transactions (nullable without a default: no table rewrite)"""
+    with bind.begin() as conn:
+        conn.execute(text(
+            "ALTER TABLE transactions ADD COLUMN IF NOT EXISTS payout_claimed_by INTEGER, "
+            "ADD COLUMN IF NOT EXISTS payout_claim_expires TIMESTAMP"
+        ))
+
+
+def migrate_transaction_versions(bind=engine):
+    """Add transactions.version; a constant default is stored in the catalog, so no table rewrite either"""
+    with bind.begin() as conn:
+        conn.execute(text("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1"))
+
+
+def migrate_transaction_updated_at(bind=engine):
+    """Add transactions.updated_at. Existing rows stay NULL (the next snapshot
+    export is a full one anyway); the default applies to new rows only, so
+    there is no table rewrite. Build idx_transaction_updated_at with
+    'python indexes.py migrate'.
+    """
+    with bind.begin() as conn:
+        conn.execute(text("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP"))
+        conn.execute(text("ALTER TABLE transactions ALTER COLUMN updated_at SET DEFAULT now()"))
+
+
+def migrate_notification_delivery(bind=engine):
+    """Add the delivery columns and queue index used by the notification dispatch worker.
+
+    Notifications already marked 'sent' by a status change are stamped as
+    delivered so the worker does not pick them up again.
+    """
+    from models import Notification
+
+    with bind.begin() as conn:
+        conn.execute(text(
+            "ALTER TABLE notifications ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0, "
+            "ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP, "
+            "ADD COLUMN IF NOT EXISTS sent_at TIMESTAMP, "
+            "ADD COLUMN IF NOT EXISTS last_error TEXT"
+        ))
+        conn.execute(text("UPDATE notifications SET sent_at = created_at WHERE status = 'sent' AND sent_at IS NULL"))
+        for index in Notification.__table__.indexes:
+            index.create(bind=conn, checkfirst=True)
+
+
+def migrate_notification_branches(bind=engine) -> int:
+    """Add notifications.branch_id, copy it from the transfers, and create the feed indexes.
+
+    Also makes sure created_at defaults to now(): the feed pages on it and
+    needs it stamped by the database, not by the writer's clock.
+    """
+    from models import Notification
+
+    with bind.begin() as conn:
+        conn.execute(text("ALTER TABLE notifications ADD COLUMN IF NOT EXISTS branch_id INTEGER"))
+        conn.execute(text("ALTER TABLE notifications ALTER COLUMN created_at SET DEFAULT now()"))
+        copied = conn.execute(text(
+            "UPDATE notifications n SET branch_id = t.branch_id FROM transactions t "
+            "WHERE t.id = n.transaction_id AND n.branch_id IS NULL AND t.branch_id IS NOT NULL"
+        )).rowcount
+        for index in Notification.__table__.indexes:
+            index.create(bind=conn, checkfirst=True)
+    return copied
+
+
+def benchmark_coded_columns(rows: int = 1_000_000, repeat: int = 7):
+    """Text vs smallint status/currency: table size, index size and a grouped aggregate.
+
+    Parallel workers are disabled so the timing reflects per-row work rather
+    than how many cores happened to be free.
+    """
+    import time
+    from models import CURRENCIES, TRANSACTION_STATUSES
+
+    results = {}
+    with engine.connect() as conn:
+        for label, column_type, status_sql, currency_sql in (
+            ("text", "text",
+             f"(ARRAY{list(TRANSACTION_STATUSES)})[1 + g % {len(TRANSACTION_STATUSES)}]",
+             "(ARRAY['SYP', 'USD', 'ليرة سورية'])[1 + g % 3]"),
+            ("smallint", "smallint",
+             f"1 + g % {len(TRANSACTION_STATUSES)}",
+             f"1 + g % {len(CURRENCIES)}"),
+        ):
+            conn.execute(text("DROP TABLE IF EXISTS coded_bench"))
+            conn.execute(text(
+                f"CREATE TABLE coded_bench (branch_id integer, status {column_type}, "
+                f"currency {column_type}, amount real)"
+            ))
+            conn.execute(text(
+                f"INSERT INTO coded_bench SELECT g % 50, {status_sql}, {currency_sql}, g % 1000 "
+                f"FROM generate_series(1, {rows}) g"
+            ))
+            conn.execute(text("CREATE INDEX coded_bench_idx ON coded_bench (branch_id, status, currency)"))
+            conn.execute(text("ANALYZE coded_bench"))
+            conn.commit()
+            conn.execute(text("SET max_parallel_workers_per_gather = 0"))
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                conn.execute(text(
+                    "SELECT branch_id, status, currency, count(*), sum(amount) FROM coded_bench "
+                    "GROUP BY branch_id, status, currency"
+                )).all()
+                timings.append(time.perf_counter() - started)
+            results[label] = {
+                "table_bytes": conn.execute(text("SELECT pg_table_size('coded_bench')")).scalar(),
+                "index_bytes": conn.execute(text("SELECT pg_relation_size('coded_bench_idx')")).scalar(),
+                "group_by_seconds": min(timings),
+            }
+        conn.execute(text("DROP TABLE IF EXISTS coded_bench"))
+        conn.commit()
+    return results
 
 
 if __name__ == "__main__":
-    reset_database()
\ No newline at end of file
+    # python database.py [reset] | migrate-codes | bench-codes | split-details | payout-leases | versions | updated-at | notifications | notification-branches
+    import sys
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "reset"
+    if command == "migrate-codes":
+        migrate_coded_columns()
+        print("status, currency, type, source_type and role are stored as codes")
+    elif command == "split-details":
+        print(f"moved details of {migrate_transaction_details()} transactions to transaction_details")
+    elif command == "payout-leases":
+        migrate_payout_leases()
+        print("transactions have payout lease columns")
+    elif command == "versions":
+        migrate_transaction_versions()
+        print("transactions have a version column")
+    elif command == "updated-at":
+        migrate_transaction_updated_at()
+        print("transactions have an updated_at column")
+    elif command == "notifications":
+        migrate_notification_delivery()
+        print("notifications have delivery columns")
+    elif command == "notification-branches":
+        print(f"copied the branch of {migrate_notification_branches()} notifications")
+    elif command == "bench-codes":
+        for label, result in benchmark_coded_columns(int(os.getenv("CODES_BENCH_ROWS", "1000000"))).items():
+            print(f"{label:9s} table {result['table_bytes'] / 1024 / 1024:6.1f} MiB   "
+                  f"index {result['index_bytes'] / 1024 / 1024:6.1f} MiB   "
+                  f"group by {result['group_by_seconds'] * 1000:7.1f} ms")
+    else:
+        reset_database()
\ No newline at end of file
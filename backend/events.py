@@ -0,0 +1,148 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Optional, List, Dict, Any, Iterable, AsyncIterator
+
+from cache import cache
+from ids import uuid7
+
+logger = logging.getLogger(__name__)
+
+# Change events for dashboards, pushed over Server-Sent Events instead of
+# being discovered by polling /branches/ and /transactions/. Endpoints publish
+# after their commit; every API worker subscribes to EVENTS_CHANNEL on Redis
+# and hands each event to its own connected clients whose role and branch
+# allow it. Without Redis, events only reach clients of the worker that
+# published them.
+#
+# Events are hints ("transaction X of branches 2 and 3 is now completed"), not
+# a log: a client that reconnects, or that falls EVENT_QUEUE_SIZE events
+# behind and is dropped, fetches the current state once and goes on listening.
+
+EVENTS_CHANNEL = "events"
+EVENT_TOPICS = ("transactions", "branches", "funds")
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "256"))
+EVENTS_HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+
+
+def event(topic: str, event_type: str, branch_ids: Optional[Iterable[Optional[int]]] = None, **data) -> Dict[str, Any]:
+    """An event for the branches in branch_ids (None: for everyone)"""
+    return {
+        "id": uuid7(),
+        "topic": topic,
+        "type": event_type,
+        "branch_ids": None if branch_ids is None else sorted({branch for branch in branch_ids if branch is not None}),
+        "data": data,
+        "at": datetime.now().isoformat(),
+    }
+
+
+class Subscription:
+    """One connected client: its scope and a bounded queue on its event loop"""
+
+    def __init__(self, user: Dict[str, Any], topics: Iterable[str], loop: asyncio.AbstractEventLoop):
+        self.role = user["role"]
+        self.branch_id = user.get("branch_id")
+        self.topics = frozenset(topics)
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.overflowed = False
+
+    def wants(self, message: Dict[str, Any]) -> bool:
+        if message["topic"] not in self.topics:
+            return False
+        if self.role == "director" or message["branch_ids"] is None:
+            return True
+        return self.branch_id in message["branch_ids"]
+
+    def offer(self, message: Dict[str, Any]):
+        """Runs on the subscription's loop; a client that cannot keep up is cut off"""
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+
+class EventBroker:
+    def __init__(self, channel: str = EVENTS_CHANNEL):
+        self.channel = channel
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._subscribed = False
+        self.stats = {"published": 0, "delivered": 0, "dropped_clients": 0}
+
+    def _subscribe(self):
+        if not self._subscribed:
+            self._subscribed = cache.subscribe(self.channel, self._deliver, on_stopped=self._on_subscription_stopped)
+
+    def _on_subscription_stopped(self):
+        # Until the next publish subscribes again, events are delivered locally
+        self._subscribed = False
+
+    def publish(self, events: List[Dict[str, Any]]):
+        """Send events to every worker's clients, as one Redis message"""
+        if not events:
+            return
+        self._subscribe()
+        self.stats["published"] += len(events)
+        if not (self._subscribed and cache.publish(self.channel, events)):
+            # No Redis: this worker's clients are the only ones we can reach
+            self._deliver(events)
+
+    def emit(self, topic: str, event_type: str, branch_ids: Optional[Iterable[Optional[int]]] = None, **data):
+        self.publish([event(topic, event_type, branch_ids, **data)])
+
+    def _deliver(self, events: List[Dict[str, Any]]):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            for message in events:
+                if subscription.wants(message):
+                    self.stats["delivered"] += 1
+                    subscription.loop.call_soon_threadsafe(subscription.offer, message)
+
+    def subscribe(self, user: Dict[str, Any], topics: Iterable[str] = EVENT_TOPICS) -> Subscription:
+        """Register a client; call from the event loop that will read its queue"""
+        self._subscribe()
+        subscription = Subscription(user, topics, asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def clients(self) -> int:
+        with self._lock:
+            return len(self._subscriptions)
+
+    async def stream(self, subscription: Subscription, heartbeat: float = EVENTS_HEARTBEAT) -> AsyncIterator[str]:
+        """text/event-stream frames for a subscription, with a comment line as keep-alive when idle"""
+        try:
+            yield f"retry: 3000\nevent: ready\ndata: {json.dumps({'topics': sorted(subscription.topics)})}\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscription.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if message is None:
+                    self.stats["dropped_clients"] += 1
+                    yield "event: overflow\ndata: {}\n\n"
+                    return
+                payload = {name: message[name] for name in ("topic", "branch_ids", "data", "at")}
+                yield f"id: {message['id']}\nevent: {message['type']}\ndata: {json.dumps(payload, default=str)}\n\n"
+        finally:
+            self.unsubscribe(subscription)
+
+
+# Create a global event broker for this worker
+event_broker = EventBroker()
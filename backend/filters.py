@@ -0,0 +1,208 @@
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import func, or_, text, false
+from sqlalchemy.dialects import postgresql
+
+from branch_directory import branch_directory
+from ids import UUID_PATTERN, uuid_prefix_range
+from models import Transaction, coded_equals
+
+# Every predicate produced here compares an indexed column (or indexed
+# expression) against a constant: dates become half-open ranges, text searches
+# become prefix matches on lower(...), id prefixes become uuid ranges, status is
+# compared by its smallint code, and role scoping is an OR of two indexed
+# equality tests. Nothing casts a column, so the planner can always use an index.
+
+DATE_FORMATS = (("%Y-%m-%d", "day"), ("%Y-%m", "month"), ("%Y", "year"))
+
+
+def parse_date_range(value: str) -> Tuple[datetime, datetime]:
+    """'2024', '2024-03' or '2024-03-15' -> [start, end) covering that year, month or day"""
+    for fmt, unit in DATE_FORMATS:
+        try:
+            start = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if unit == "day":
+            return start, start + timedelta(days=1)
+        if unit == "month":
+            return start, (start + timedelta(days=32)).replace(day=1)
+        return start, start.replace(year=start.year + 1)
+    raise ValueError(value)
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def prefix_match(column, value: str) -> list:
+    """Case-insensitive prefix match served by a lower(column) text_pattern_ops index"""
+    return [func.lower(column).like(f"{_escape_like(value.lower())}%", escape="\\")]
+
+
+def id_match(value: str) -> list:
+    value = value.strip()
+    if UUID_PATTERN.match(value):
+        return [Transaction.id == value]
+    bounds = uuid_prefix_range(value)
+    if bounds is None:
+        # Not a hex prefix, so it cannot be the start of any id
+        return [false()]
+    # Ids are native uuids; a prefix is the contiguous range it spans in the primary key
+    return [Transaction.id.between(*bounds)]
+
+
+def role_scope(current_user: dict) -> list:
+    """Rows a user may see: employees their own and incoming ones, managers their branch's"""
+    if current_user["role"] == "employee":
+        return [or_(
+            Transaction.employee_id == current_user["user_id"],
+            Transaction.destination_branch_id == current_user["branch_id"]
+        )]
+    if current_user["role"] == "branch_manager":
+        return [or_(
+            Transaction.branch_id == current_user["branch_id"],
+            Transaction.destination_branch_id == current_user["branch_id"]
+        )]
+    return []
+
+
+def governorate_scope(current_user: dict, filter_type: str) -> list:
+    branch = branch_directory.get(current_user.get("branch_id"))
+    if not branch:
+        return []
+    if filter_type == "incoming":
+        return [Transaction.receiver_governorate == branch.governorate]
+    if filter_type == "outgoing":
+        return [Transaction.sender_governorate == branch.governorate]
+    if filter_type == "branch_related":
+        return [or_(
+            Transaction.sender_governorate == branch.governorate,
+            Transaction.receiver_governorate == branch.governorate
+        )]
+    return []
+
+
+def compile_transaction_filters(
+    current_user: dict,
+    branch_id: Optional[int] = None,
+    destination_branch_id: Optional[int] = None,
+    id: Optional[str] = None,
+    sender: Optional[str] = None,
+    receiver: Optional[str] = None,
+    status: Optional[str] = None,
+    date: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    filter_type: Optional[str] = None,
+    strict_dates: bool = True
+) -> List:
+    """Translate /transactions/ and /reports/transactions/ query parameters into predicates.
+
+    With strict_dates an unparseable start_date/end_date is a 400; otherwise it
+    is ignored, which is what /transactions/ has always done.
+    """
+    predicates = role_scope(current_user)
+    if branch_id:
+        predicates.append(Transaction.branch_id == branch_id)
+    if destination_branch_id:
+        predicates.append(Transaction.destination_branch_id == destination_branch_id)
+    if id:
+        predicates.extend(id_match(id))
+    if sender:
+        predicates.extend(prefix_match(Transaction.sender, sender))
+    if receiver:
+        predicates.extend(prefix_match(Transaction.receiver, receiver))
+    if status:
+        predicates.append(coded_equals(Transaction.status, status))
+    if date:
+        try:
+            day_start, day_end = parse_date_range(date)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY, YYYY-MM or YYYY-MM-DD")
+        predicates.extend([Transaction.date >= day_start, Transaction.date < day_end])
+    for name, value in (("start_date", start_date), ("end_date", end_date)):
+        if not value:
+            continue
+        try:
+            day = datetime.strptime(value, "%Y-%m-%d")
+        except ValueError:
+            if strict_dates:
+                raise HTTPException(status_code=400, detail=f"Invalid {name} format. Use YYYY-MM-DD")
+            continue
+        if name == "start_date":
+            predicates.append(Transaction.date >= day)
+        else:
+            # Whole end day, as a half-open range
+            predicates.append(Transaction.date < day + timedelta(days=1))
+    if filter_type:
+        predicates.extend(governorate_scope(current_user, filter_type))
+    return predicates
+
+
+def index_usage_check(db, query) -> List[str]:
+    """Plan `query` with sequential scans disabled and list the transactions scans
+    that are not driven by an index condition (empty when the filters are sargable)."""
+    sql = str(query.statement.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+    db.execute(text("SET LOCAL enable_seqscan = off"))
+    plan = db.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+    db.rollback()
+    problems = []
+
+    def walk(node):
+        relation = node.get("Relation Name", "")
+        if relation.startswith("transactions"):
+            if node["Node Type"] == "Seq Scan":
+                problems.append(f"seq scan on {relation}")
+            elif node["Node Type"] in ("Index Scan", "Index Only Scan") and "Index Cond" not in node:
+                problems.append(f"full scan of {node['Index Name']}")
+        for child in node.get("Plans", []):
+            walk(child)
+
+    walk(plan[0]["Plan"])
+    return problems
+
+
+if __name__ == "__main__":
+    # EXPLAIN checks: every supported filter, alone and under each role scope,
+    # must be answerable from an index.
+    import itertools
+    from database import SessionLocal
+
+    users = {
+        "director": {"role": "director", "branch_id": 1, "user_id": 1},
+        "branch_manager": {"role": "branch_manager", "branch_id": 2, "user_id": 2},
+        "employee": {"role": "employee", "branch_id": 3, "user_id": 3},
+    }
+    single_filters = {
+        "branch_id": {"branch_id": 2},
+        "destination_branch_id": {"destination_branch_id": 3},
+        "id": {"id": "0190a3c2-7b"},
+        "full id": {"id": "0190a3c2-7b1d-7cc3-9d2e-55d0c1a2b3c4"},
+        "sender": {"sender": "Ali"},
+        "receiver": {"receiver": "Omar"},
+        "date": {"date": "2024-03-15"},
+        "month": {"date": "2024-03"},
+        "date range": {"start_date": "2024-01-01", "end_date": "2024-03-31"},
+        "incoming": {"filter_type": "incoming"},
+        "outgoing": {"filter_type": "outgoing"},
+        "branch_related": {"filter_type": "branch_related"},
+        "status + date range": {"status": "completed", "start_date": "2024-01-01", "end_date": "2024-03-31"},
+    }
+    db = SessionLocal()
+    failures = []
+    try:
+        for (role, user), (label, params) in itertools.product(users.items(), single_filters.items()):
+            if params.get("filter_type") and not branch_directory.get(user["branch_id"]):
+                continue
+            query = db.query(Transaction.id).filter(*compile_transaction_filters(user, **params))
+            problems = index_usage_check(db, query)
+            print(f"{role:15s} {label:22s} {', '.join(problems) or 'index'}")
+            if problems:
+                failures.append((role, label))
+    finally:
+        db.close()
+    assert not failures, f"filters without a usable index: {failures}"
+    print("all filter combinations use an index")
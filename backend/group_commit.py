@@ -0,0 +1,389 @@
+import asyncio
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from typing import Optional, List, Dict, Any
+
+from sqlalchemy import insert, select
+
+from customers import upsert_customers, upsert_statements
+from models import Transaction, TransactionDetails, Notification, IdempotencyKey, DETAIL_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+# Opt-in: 0 keeps one commit per transfer. A few milliseconds is enough for
+# concurrent tellers' inserts to share a commit (and its WAL flush).
+GROUP_COMMIT_WINDOW_MS = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "0"))
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "200"))
+
+PendingWrite = namedtuple("PendingWrite", ["rows", "future"])
+
+
+def _split_details(transaction: Dict[str, Any]):
+    """(transactions row, transaction_details row) from a prepared transaction's values"""
+    values = dict(transaction)
+    detail = {name: values.pop(name, None) for name in DETAIL_COLUMNS}
+    return values, dict(detail, transaction_id=values["id"])
+
+
+def insert_transfers(conn, writes: List[Dict[str, Any]]):
+    """Insert prepared transfers (see server_improved.prepare_transaction_rows) on `conn`.
+
+    One multi-row INSERT per table, whatever the number of transfers.
+    """
+    transactions, details = [], []
+    for rows in writes:
+        values, detail = _split_details(rows["transaction"])
+        transactions.append(values)
+        details.append(detail)
+    conn.execute(insert(Transaction.__table__), transactions)
+    conn.execute(insert(TransactionDetails.__table__), details)
+    conn.execute(insert(Notification.__table__), [rows["notification"] for rows in writes])
+    keys = [rows["idempotency"] for rows in writes if rows.get("idempotency")]
+    if keys:
+        conn.execute(insert(IdempotencyKey.__table__), keys)
+    upsert_customers(conn, [customer for rows in writes for customer in rows["customers"]])
+
+
+def write_transfers(bind, writes: List[Dict[str, Any]]) -> List[Optional[Exception]]:
+    """Insert prepared transfers in one transaction; returns each one's error, None once written.
+
+    If the multi-row insert fails, the transfers are replayed one by one, each
+    inside its own savepoint, so only the offending ones fail.
+    """
+    try:
+        with bind.begin() as conn:
+            insert_transfers(conn, writes)
+        return [None] * len(writes)
+    except Exception as e:
+        if len(writes) == 1:
+            return [e]
+        logger.warning(f"Insert of {len(writes)} transfers failed, retrying one by one: {str(e)}")
+    errors: List[Optional[Exception]] = [None] * len(writes)
+    try:
+        with bind.begin() as conn:
+            for i, rows in enumerate(writes):
+                try:
+                    with conn.begin_nested():
+                        insert_transfers(conn, [rows])
+                except Exception as e:
+                    errors[i] = e
+    except Exception as e:
+        return [error or e for error in errors]
+    return errors
+
+
+def transfer_statement(rows: Dict[str, Any]):
+    """A prepared transfer as a single statement returning its id.
+
+    The transaction, its details, its notification and the customer upsert are
+    data-modifying CTEs of one SELECT. Run on an autocommit connection, that
+    statement is its own transaction: one round trip, no BEGIN or COMMIT.
+    """
+    values, detail = _split_details(rows["transaction"])
+    transaction = insert(Transaction.__table__).values(values).returning(Transaction.__table__.c.id).cte("new_transaction")
+    ctes = [
+        insert(TransactionDetails.__table__).values(detail).cte("new_details"),
+        insert(Notification.__table__).values(rows["notification"]).cte("new_notification"),
+    ]
+    if rows.get("idempotency"):
+        # A second attempt with the same key fails on its primary key, and takes the transfer down with it
+        ctes.append(insert(IdempotencyKey.__table__).values(rows["idempotency"]).cte("idempotency_key"))
+    # _merge leaves one row per customer key, so no two CTEs touch the same customers row
+    ctes.extend(
+        upsert.cte(f"customer_{i}") for i, upsert in enumerate(upsert_statements(rows["customers"]))
+    )
+    return select(transaction.c.id).add_cte(*ctes)
+
+
+class GroupCommitWriter:
+    """Collects concurrent transfer inserts and commits them together.
+
+    Callers submit prepared rows and wait on a future. One background thread
+    takes the first pending write, keeps collecting for `window_ms` (or until
+    `max_batch`), and writes the whole batch with write_transfers, so every
+    caller still gets its own outcome.
+    """
+
+    def __init__(self, bind, window_ms: float = GROUP_COMMIT_WINDOW_MS, max_batch: int = GROUP_COMMIT_MAX_BATCH):
+        self.bind = bind
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue: "queue.Queue[PendingWrite]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self._thread.start()
+
+    def submit(self, rows: Dict[str, Any]) -> Future:
+        """Queue one prepared transfer; the future resolves to its id once committed"""
+        self.start()
+        future: Future = Future()
+        self._queue.put(PendingWrite(rows, future))
+        return future
+
+    async def write(self, rows: Dict[str, Any]) -> str:
+        return await asyncio.wrap_future(self.submit(rows))
+
+    def _collect(self) -> List[PendingWrite]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self.flush(batch)
+            except Exception as e:
+                # flush settles every future itself; this only keeps the thread alive
+                logger.error(f"Group commit flush failed: {str(e)}")
+
+    def flush(self, batch: List[PendingWrite]):
+        errors = write_transfers(self.bind, [write.rows for write in batch])
+        for write, error in zip(batch, errors):
+            if error is None:
+                write.future.set_result(write.rows["transaction"]["id"])
+            else:
+                write.future.set_exception(error)
+
+
+_BENCH_MARKER = "group-commit-bench"
+
+
+def _bench_rows() -> Dict[str, Any]:
+    """A prepared transfer like prepare_transaction_rows builds, tagged for cleanup"""
+    from datetime import datetime
+    from customers import customer_row
+    from ids import uuid7
+
+    transaction_id = uuid7()
+    now = datetime.now()
+    transaction = {
+        "id": transaction_id, "sender": _BENCH_MARKER, "receiver": _BENCH_MARKER, "amount": 100.0,
+        "base_amount": 100.0, "benefited_amount": 0.0, "tax_rate": 0.0, "tax_amount": 0.0,
+        "currency": "SYP", "status": "processing", "is_received": False, "date": now,
+    }
+    transaction.update({name: None for name in DETAIL_COLUMNS})
+    return {
+        "transaction": transaction,
+        "notification": {"transaction_id": transaction_id, "recipient_phone": None,
+                         "message": _BENCH_MARKER, "status": "pending", "attempts": 0},
+        # distinct customers, so senders do not queue on one customers row
+        "customers": [
+            customer_row(_BENCH_MARKER, f"09{secrets.randbelow(10 ** 8):08d}", now, sent=1, amount=100.0, currency="SYP"),
+            customer_row(_BENCH_MARKER, f"09{secrets.randbelow(10 ** 8):08d}", now, received=1, amount=100.0, currency="SYP"),
+        ],
+    }
+
+
+def _bench_cleanup(bind):
+    from sqlalchemy import text
+    with bind.begin() as conn:
+        conn.execute(text(
+            "DELETE FROM notifications n USING transactions t "
+            "WHERE n.transaction_id = t.id AND t.sender = :marker; "
+            "DELETE FROM notifications WHERE message = :marker; "
+            "DELETE FROM transaction_details d USING transactions t "
+            "WHERE d.transaction_id = t.id AND t.sender = :marker; "
+            "DELETE FROM transactions WHERE sender = :marker; "
+            "DELETE FROM customers WHERE name = :marker"
+        ), {"marker": _BENCH_MARKER})
+
+
+def _percentiles(latencies: List[float]) -> Dict[str, float]:
+    latencies = sorted(latencies)
+    return {
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+
+def benchmark_group_commit(concurrency_levels=(1, 10, 100), per_sender: int = 50, window_ms: float = 2.0):
+    """Transfers/s and p50/p99 latency, one commit per transfer vs group commit.
+
+    Each sender thread inserts `per_sender` transfers back to back. Rows are
+    tagged and deleted afterwards; run against a scratch database.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from sqlalchemy import create_engine
+    from database import DATABASE_URL
+
+    results = []
+    for concurrency in concurrency_levels:
+        # Pooled like the API server's engine, so 100 senders share at most 30 connections
+        bind = create_engine(DATABASE_URL, pool_size=10, max_overflow=20)
+        writer = GroupCommitWriter(bind, window_ms=window_ms)
+
+        def direct(rows):
+            with bind.begin() as conn:
+                insert_transfers(conn, [rows])
+
+        def grouped(rows):
+            writer.submit(rows).result()
+
+        for label, write in (("commit per transfer", direct), (f"group commit {window_ms:g}ms", grouped)):
+            latencies: List[float] = []
+
+            def sender(_):
+                own = []
+                for _ in range(per_sender):
+                    rows = _bench_rows()
+                    started = time.perf_counter()
+                    write(rows)
+                    own.append(time.perf_counter() - started)
+                return own
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                for own in pool.map(sender, range(concurrency)):
+                    latencies.extend(own)
+            elapsed = time.perf_counter() - started
+            results.append(dict(
+                senders=concurrency, mode=label, per_second=len(latencies) / elapsed, **_percentiles(latencies)
+            ))
+        _bench_cleanup(bind)
+        bind.dispose()
+    return results
+
+
+def benchmark_single_transfer(transfers: int = 2000):
+    """p50/p99 of one transfer written the old way (ORM session, branch lookups,
+    commit) vs transfer_statement on an autocommit connection."""
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.orm import sessionmaker
+    from database import DATABASE_URL
+    from models import Branch
+
+    bind = create_engine(DATABASE_URL, pool_size=1)
+    Session = sessionmaker(autoflush=False, bind=bind)
+    statements = [0]
+    event.listen(bind, "before_cursor_execute", lambda *args: statements.__setitem__(0, statements[0] + 1))
+
+    def session_path(rows):
+        db = Session()
+        try:
+            db.query(Branch.tax_rate).filter(Branch.id == 1).scalar()
+            db.query(Branch.id).filter(Branch.id == 1).first()
+            values, detail = _split_details(rows["transaction"])
+            db.add(Transaction(**values, **{k: v for k, v in detail.items() if k != "transaction_id"}))
+            db.add(Notification(**rows["notification"]))
+            upsert_customers(db, rows["customers"])
+            db.commit()
+        finally:
+            db.close()
+
+    def single_statement(rows):
+        with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(transfer_statement(rows)).scalar_one()
+
+    results = []
+    for label, write in (("session + lookups", session_path), ("single statement", single_statement)):
+        write(_bench_rows())  # warm up the pool and statement caches
+        statements[0] = 0
+        latencies = []
+        for _ in range(transfers):
+            rows = _bench_rows()
+            started = time.perf_counter()
+            write(rows)
+            latencies.append(time.perf_counter() - started)
+        results.append(dict(
+            mode=label, statements=statements[0] / transfers,
+            per_second=transfers / sum(latencies), **_percentiles(latencies)
+        ))
+    _bench_cleanup(bind)
+    bind.dispose()
+    return results
+
+
+def benchmark_ingest(transfers: int = 2000):
+    """Transfers/s through the API: one POST /transactions/ per transfer vs
+    POST /transactions/batch/ and an NDJSON upload to /transactions/batch/upload/."""
+    import json
+    from fastapi.testclient import TestClient
+    from sqlalchemy import text
+    from security import create_jwt_token
+    import server_improved
+
+    with server_improved.engine.connect() as conn:
+        destination = conn.execute(text("SELECT id FROM branches WHERE id <> 0 ORDER BY id LIMIT 1")).scalar()
+    if destination is None:
+        raise SystemExit("the ingest benchmark needs at least one branch")
+    token = create_jwt_token({"username": _BENCH_MARKER, "role": "director", "branch_id": destination, "user_id": None})
+    headers = {"Authorization": f"Bearer {token}"}
+    items = [
+        {"sender": _BENCH_MARKER, "sender_mobile": f"09{secrets.randbelow(10 ** 8):08d}", "sender_governorate": "",
+         "receiver": _BENCH_MARKER, "receiver_mobile": f"09{secrets.randbelow(10 ** 8):08d}", "receiver_governorate": "",
+         "amount": 100.0, "base_amount": 100.0, "benefited_amount": 0.0, "tax_rate": 0.0, "tax_amount": 0.0,
+         "currency": "SYP", "message": "", "employee_name": "", "branch_governorate": "",
+         "destination_branch_id": destination}
+        for _ in range(transfers)
+    ]
+
+    def per_item(client):
+        for item in items:
+            assert client.post("/transactions/", json=item, headers=headers).status_code == 201
+        return transfers
+
+    def batch(client):
+        return client.post("/transactions/batch/", json=items, headers=headers).json()["created"]
+
+    def upload(client):
+        body = "\n".join(json.dumps(item) for item in items).encode("utf-8")
+        files = {"file": ("transfers.ndjson", body, "application/x-ndjson")}
+        return client.post("/transactions/batch/upload/", files=files, headers=headers).json()["created"]
+
+    results = []
+    with TestClient(server_improved.app) as client:
+        for label, run in (("POST per transfer", per_item), ("batch JSON", batch), ("batch NDJSON upload", upload)):
+            started = time.perf_counter()
+            created = run(client)
+            elapsed = time.perf_counter() - started
+            results.append(dict(mode=label, created=created, seconds=elapsed, per_second=created / elapsed))
+    _bench_cleanup(server_improved.engine)
+    return results
+
+
+if __name__ == "__main__":
+    # python group_commit.py [per_sender] [window_ms]   concurrent senders, group commit on/off
+    # python group_commit.py single [transfers]         one transfer's latency, old path vs one statement
+    # python group_commit.py ingest [transfers]         API throughput, one POST per transfer vs the batch endpoints
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "ingest":
+        transfers = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        for row in benchmark_ingest(transfers):
+            print(f"{row['mode']:20s} {row['created']:>6d} created in {row['seconds']:6.2f} s "
+                  f"{row['per_second']:>8.0f} transfers/s")
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "single":
+        transfers = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        for row in benchmark_single_transfer(transfers):
+            print(f"{row['mode']:20s} {row['statements']:4.1f} statements/transfer {row['per_second']:>8.0f} transfers/s   "
+                  f"p50 {row['p50_ms']:6.2f} ms   p99 {row['p99_ms']:6.2f} ms")
+        sys.exit(0)
+    per_sender = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    window_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+    for row in benchmark_group_commit(per_sender=per_sender, window_ms=window_ms):
+        print(f"{row['senders']:>4d} senders  {row['mode']:22s} {row['per_second']:>8.0f} transfers/s   "
+              f"p50 {row['p50_ms']:6.1f} ms   p99 {row['p99_ms']:6.1f} ms")
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from sqlalchemy import insert, select, delete
+
+from cache import cache
+from database import engine
+from models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+# A client that times out retries with the same Idempotency-Key header and gets
+# the first attempt's response back instead of a second transfer. Responses are
+# looked up in this worker's memory, then Redis; neither is needed for
+# correctness. The durable copy is a row in idempotency_keys written by the
+# same statement (or transaction) as the change itself, so when two attempts
+# race, its primary key lets exactly one of them through and the other replays
+# what the first one stored.
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+IDEMPOTENCY_LOCAL_SIZE = int(os.getenv("IDEMPOTENCY_LOCAL_SIZE", "10000"))
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyKeyTaken(Exception):
+    """The key's row already exists: another attempt of the same request got there first"""
+
+
+def request_fingerprint(payload: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def check_key(key: str) -> str:
+    key = key.strip()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"{IDEMPOTENCY_HEADER} must be 1 to {MAX_KEY_LENGTH} characters")
+    return key
+
+
+def is_key_conflict(e: Exception) -> bool:
+    return "idempotency_keys_pkey" in str(getattr(e, "orig", e))
+
+
+def replay(record: Dict[str, Any], fingerprint: str) -> JSONResponse:
+    """The stored response, or 422 when the key was used for a different request"""
+    if record["fingerprint"] != fingerprint:
+        raise HTTPException(
+            status_code=422,
+            detail=f"{IDEMPOTENCY_HEADER} was already used for a different request"
+        )
+    return JSONResponse(status_code=record["status_code"], content=record["response"],
+                        headers={"Idempotent-Replayed": "true"})
+
+
+class IdempotencyStore:
+    def __init__(self, bind=engine, ttl: int = IDEMPOTENCY_TTL, local_size: int = IDEMPOTENCY_LOCAL_SIZE):
+        self.bind = bind
+        self.ttl = ttl
+        self.local_size = local_size
+        self._local: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cache_key(scope: str, key: str) -> str:
+        return f"idempotency:{scope}:{key}"
+
+    def record(self, scope: str, key: str, fingerprint: str, status_code: int, response: Dict[str, Any]) -> Dict[str, Any]:
+        """The idempotency_keys row for a response, to be written with the change it describes"""
+        return {
+            "scope": scope, "key": key, "fingerprint": fingerprint,
+            "status_code": status_code, "response": response, "created_at": datetime.now(),
+        }
+
+    def insert_statement(self, record: Dict[str, Any]):
+        return insert(IdempotencyKey.__table__).values(record)
+
+    def remember(self, record: Dict[str, Any]):
+        """Keep a committed response in memory and in Redis"""
+        stored = {name: record[name] for name in ("fingerprint", "status_code", "response")}
+        with self._lock:
+            self._local[(record["scope"], record["key"])] = (time.monotonic() + self.ttl, stored)
+            self._local.move_to_end((record["scope"], record["key"]))
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+        cache.set(self._cache_key(record["scope"], record["key"]), stored, expire=self.ttl)
+
+    def lookup(self, scope: str, key: str) -> Optional[Dict[str, Any]]:
+        """A response already sent for this key, from memory or Redis; None means go ahead and write"""
+        with self._lock:
+            entry = self._local.get((scope, key))
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    return entry[1]
+                del self._local[(scope, key)]
+        stored = cache.get(self._cache_key(scope, key))
+        if stored is not None:
+            with self._lock:
+                self._local[(scope, key)] = (time.monotonic() + self.ttl, stored)
+        return stored
+
+    def load(self, scope: str, key: str) -> Optional[Dict[str, Any]]:
+        """The durable copy, after a write lost the race for the key"""
+        with self.bind.connect() as conn:
+            row = conn.execute(select(
+                IdempotencyKey.fingerprint, IdempotencyKey.status_code, IdempotencyKey.response
+            ).where(IdempotencyKey.scope == scope, IdempotencyKey.key == key)).first()
+        if row is None:
+            return None
+        record = {"scope": scope, "key": key, "fingerprint": row.fingerprint,
+                  "status_code": row.status_code, "response": row.response}
+        self.remember(record)
+        return record
+
+    def purge_expired(self) -> int:
+        """Delete keys older than the TTL, after which a retry counts as a new request"""
+        with self.bind.begin() as conn:
+            return conn.execute(delete(IdempotencyKey).where(
+                IdempotencyKey.created_at < datetime.now() - timedelta(seconds=self.ttl)
+            )).rowcount
+
+
+# Create a global idempotency store for this worker
+idempotency_store = IdempotencyStore()
+
+
+if __name__ == "__main__":
+    # python idempotency.py purge
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) > 1 and sys.argv[1] == "purge":
+        print(f"deleted {idempotency_store.purge_expired()} expired idempotency keys")
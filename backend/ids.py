@@ -0,0 +1,152 @@
+import hashlib
+import os
+import re
+import secrets
+import threading
+import time
+import uuid
+from typing import Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.types import TypeDecorator
+
+UUID_PATTERN = re.compile(
+    r"^[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}$", re.IGNORECASE
+)
+HEX_PREFIX_PATTERN = re.compile(r"^[0-9a-f]{1,32}$", re.IGNORECASE)
+
+_lock = threading.Lock()
+_last_ms = 0
+_sequence = 0
+
+
+def uuid7() -> str:
+    """Time-ordered UUID (RFC 9562 version 7) as a string.
+
+    48 bits of Unix milliseconds, then a 12-bit counter that keeps ids created
+    in the same millisecond by this process in order, then 62 random bits.
+    Consecutive ids land next to each other in the primary key index instead of
+    on a random leaf page.
+    """
+    global _last_ms, _sequence
+    with _lock:
+        ms = time.time_ns() // 1_000_000
+        if ms > _last_ms:
+            _last_ms = ms
+            _sequence = secrets.randbits(11)  # random start, with headroom to count up
+        else:
+            _sequence += 1
+            if _sequence > 0xFFF:
+                _last_ms += 1
+                _sequence = secrets.randbits(11)
+        ms, sequence = _last_ms, _sequence
+    value = (ms << 80) | (0x7 << 76) | (sequence << 64) | (0b10 << 62) | secrets.randbits(62)
+    return str(uuid.UUID(int=value))
+
+
+def normalize_transaction_id(value) -> Optional[str]:
+    """Canonical uuid text for any id a client may send.
+
+    Ids that were never uuids map to md5(id)::uuid, the same expression the
+    migration used, so every id issued before the column became uuid still
+    resolves (and garbage simply matches nothing instead of raising).
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    if UUID_PATTERN.match(value):
+        return str(uuid.UUID(value))
+    return str(uuid.UUID(hashlib.md5(value.encode("utf-8")).hexdigest()))
+
+
+def uuid_cast_sql(column: str) -> str:
+    """SQL that converts a text id column to uuid with the same rules as normalize_transaction_id"""
+    return (
+        f"CASE WHEN {column}::text ~* '{UUID_PATTERN.pattern}' THEN {column}::text::uuid "
+        f"ELSE md5({column}::text)::uuid END"
+    )
+
+
+def uuid_prefix_range(prefix: str) -> Optional[Tuple[str, str]]:
+    """Smallest and largest uuid starting with a (dash-insensitive) hex prefix"""
+    digits = prefix.replace("-", "").strip().lower()
+    if not HEX_PREFIX_PATTERN.match(digits):
+        return None
+    low = uuid.UUID(digits.ljust(32, "0"))
+    high = uuid.UUID(digits.ljust(32, "f"))
+    return str(low), str(high)
+
+
+class TransactionId(TypeDecorator):
+    """Native 16-byte uuid column that accepts and returns ids as strings"""
+
+    impl = UUID(as_uuid=False)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return normalize_transaction_id(value)
+
+
+# Columns holding transaction ids, converted together so joins keep matching
+TRANSACTION_ID_COLUMNS = (
+    ("transactions", "id"),
+    ("notifications", "transaction_id"),
+    ("branch_profits", "transaction_id"),
+    ("transaction_details", "transaction_id"),
+)
+
+
+def migrate_transaction_ids(bind=None):
+    """Convert transaction id columns from text to uuid in one transaction"""
+    if bind is None:
+        from database import engine as bind
+    with bind.begin() as conn:
+        for table, column in TRANSACTION_ID_COLUMNS:
+            data_type = conn.execute(text(
+                "SELECT data_type FROM information_schema.columns "
+                "WHERE table_schema = 'public' AND table_name = :table AND column_name = :column"
+            ), {"table": table, "column": column}).scalar()
+            if data_type is None or data_type == "uuid":
+                continue
+            conn.execute(text(
+                f"ALTER TABLE {table} ALTER COLUMN {column} TYPE uuid USING {uuid_cast_sql(column)}"
+            ))
+
+
+if __name__ == "__main__":
+    # python ids.py migrate | bench
+    # bench: insert throughput and primary key size, random text ids vs random uuid vs uuid7
+    import sys
+    from database import engine
+
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        migrate_transaction_ids(engine)
+        print("transaction id columns are uuid")
+        sys.exit(0)
+
+    rows = int(os.getenv("ID_BENCH_ROWS", "200000"))
+    batch = 5000
+    variants = (
+        ("uuid4 as text", "text", lambda: str(uuid.uuid4())),
+        ("uuid4 as uuid", "uuid", lambda: str(uuid.uuid4())),
+        ("uuid7 as uuid", "uuid", uuid7),
+    )
+    with engine.connect() as conn:
+        for label, column_type, make_id in variants:
+            conn.execute(text("DROP TABLE IF EXISTS id_bench"))
+            conn.execute(text(f"CREATE TABLE id_bench (id {column_type} PRIMARY KEY, payload text)"))
+            conn.commit()
+            ids = [make_id() for _ in range(rows)]
+            started = time.perf_counter()
+            for offset in range(0, rows, batch):
+                conn.execute(
+                    text("INSERT INTO id_bench (id, payload) VALUES (:id, 'x')"),
+                    [{"id": value} for value in ids[offset:offset + batch]]
+                )
+                conn.commit()
+            elapsed = time.perf_counter() - started
+            index_bytes = conn.execute(text("SELECT pg_relation_size('id_bench_pkey')")).scalar()
+            print(f"{label:14s} {rows / elapsed:>10.0f} rows/s   pk index {index_bytes / 1024 / 1024:6.1f} MiB")
+        conn.execute(text("DROP TABLE IF EXISTS id_bench"))
+        conn.commit()
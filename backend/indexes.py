@@ -0,0 +1,177 @@
+import logging
+import sys
+from typing import List, Dict, Any
+
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+
+from database import engine, model_indexes
+
+logger = logging.getLogger(__name__)
+
+# Indexes created by earlier schema versions that no query shape needs any more
+OBSOLETE_INDEXES = (
+    "idx_transactions_id",          # duplicate of the primary key
+    "ix_transactions_id",           # index=True on the primary key
+    "ix_users_id",
+    "ix_branches_id",
+    "ix_branch_funds_id",
+    "ix_notifications_id",
+    "ix_branch_profits_id",
+    "idx_transaction_date",         # leading column of idx_transaction_dates
+    "idx_transaction_branch",       # leading column of idx_transaction_composite
+    "idx_transaction_destination",  # leading column of idx_transaction_destination_status
+    "idx_transaction_currency",     # two distinct values, never selective
+    "idx_transaction_status",       # a handful of distinct values, never selective
+    "idx_transaction_received",
+    "idx_transactions_sender",      # superseded by idx_transaction_sender_prefix / _receiver_prefix
+    "idx_transactions_receiver",
+    "idx_branch_profits_branch_date",  # leading column of idx_branch_profits_ledger
+)
+
+
+def _index_definition(index) -> str:
+    """The '(columns) [INCLUDE (...)]' part of the index's CREATE INDEX statement"""
+    ddl = str(CreateIndex(index).compile(dialect=postgresql.dialect()))
+    return ddl.split(f" ON {index.table.name} ", 1)[1]
+
+
+def _partitions(conn, table: str) -> List[str]:
+    return conn.execute(text(
+        "SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = to_regclass(:table)"
+    ), {"table": f"public.{table}"}).scalars().all()
+
+
+def _index_is_valid(conn, name: str) -> bool:
+    """False when missing, or when a previous run stopped before every partition was attached"""
+    return bool(conn.execute(text(
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"
+    ), {"name": f"public.{name}"}).scalar())
+
+
+def _create_index(conn, index):
+    """CREATE INDEX CONCURRENTLY, one partition at a time for partitioned tables.
+
+    Postgres cannot build an index concurrently on a partitioned parent, so the
+    parent index is created ON ONLY (invalid and empty), each partition is
+    indexed concurrently and then attached; the parent becomes valid once every
+    partition is attached.
+    """
+    table = index.table.name
+    unique = "UNIQUE " if index.unique else ""
+    definition = _index_definition(index)
+    partitions = _partitions(conn, table)
+    if not partitions:
+        conn.execute(text(
+            f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {index.name} ON {table} {definition}"
+        ))
+        return
+    conn.execute(text(f"CREATE {unique}INDEX IF NOT EXISTS {index.name} ON ONLY {table} {definition}"))
+    for partition in partitions:
+        partition_index = f"{partition}_{index.name}"[:63]
+        conn.execute(text(
+            f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {partition_index} ON {partition} {definition}"
+        ))
+        already_attached = conn.execute(text(
+            "SELECT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(:child) "
+            "AND inhparent = to_regclass(:parent))"
+        ), {"child": f"public.{partition_index}", "parent": f"public.{index.name}"}).scalar()
+        if not already_attached:
+            conn.execute(text(f"ALTER INDEX {index.name} ATTACH PARTITION {partition_index}"))
+
+
+def apply_index_migration(bind=engine, drop_obsolete: bool = True) -> Dict[str, List[str]]:
+    """Bring an existing database's indexes in line with models.py without blocking writes"""
+    created, dropped = [], []
+    with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for index in model_indexes():
+            if _index_is_valid(conn, index.name):
+                continue
+            logger.info(f"Creating index {index.name} on {index.table.name}")
+            _create_index(conn, index)
+            created.append(index.name)
+        if drop_obsolete:
+            for name in OBSOLETE_INDEXES:
+                kind = conn.execute(text(
+                    "SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"
+                ), {"name": f"public.{name}"}).scalar()
+                if kind is None:
+                    continue
+                # Partitioned ('I') indexes cannot be dropped concurrently
+                concurrently = "" if kind == "I" else "CONCURRENTLY "
+                conn.execute(text(f"DROP INDEX {concurrently}IF EXISTS {name}"))
+                dropped.append(name)
+    logger.info(f"Index migration done: created {created}, dropped {dropped}")
+    return {"created": created, "dropped": dropped}
+
+
+def index_usage_report(bind=engine) -> Dict[str, Any]:
+    """Scan counts and sizes per index from pg_stat_user_indexes.
+
+    Partition indexes are rolled up into their parent index, so a partitioned
+    table shows one row per logical index. Counters are cumulative since the
+    last statistics reset; an index with no scans that does not enforce a
+    constraint only costs writes and is a candidate for dropping.
+    """
+    with bind.connect() as conn:
+        rows = conn.execute(text("""
+            WITH stats AS (
+                SELECT COALESCE(parent.relname, s.indexrelname) AS index_name,
+                       COALESCE(parent_table.relname, s.relname) AS table_name,
+                       s.idx_scan, s.idx_tup_read, s.idx_tup_fetch,
+                       pg_relation_size(s.indexrelid) AS size_bytes,
+                       x.indisunique, x.indisprimary
+                FROM pg_stat_user_indexes s
+                JOIN pg_index x ON x.indexrelid = s.indexrelid
+                LEFT JOIN pg_inherits i ON i.inhrelid = s.indexrelid
+                LEFT JOIN pg_class parent ON parent.oid = i.inhparent
+                LEFT JOIN pg_index parent_index ON parent_index.indexrelid = i.inhparent
+                LEFT JOIN pg_class parent_table ON parent_table.oid = parent_index.indrelid
+                WHERE s.schemaname = 'public'
+            )
+            SELECT table_name, index_name,
+                   sum(idx_scan) AS scans, sum(idx_tup_read) AS tuples_read,
+                   sum(idx_tup_fetch) AS tuples_fetched, sum(size_bytes) AS size_bytes,
+                   bool_or(indisunique) AS is_unique, bool_or(indisprimary) AS is_primary
+            FROM stats
+            GROUP BY table_name, index_name
+            ORDER BY sum(idx_scan), sum(size_bytes) DESC
+        """)).mappings().all()
+        stats_reset = conn.execute(text(
+            "SELECT stats_reset FROM pg_stat_database WHERE datname = current_database()"
+        )).scalar()
+
+    indexes = []
+    for row in rows:
+        enforces_constraint = row["is_unique"] or row["is_primary"]
+        indexes.append({
+            "table": row["table_name"],
+            "index": row["index_name"],
+            "scans": int(row["scans"] or 0),
+            "tuples_read": int(row["tuples_read"] or 0),
+            "tuples_fetched": int(row["tuples_fetched"] or 0),
+            "size_bytes": int(row["size_bytes"] or 0),
+            "unique": bool(enforces_constraint),
+            "unused": not enforces_constraint and not row["scans"],
+            "obsolete": row["index_name"] in OBSOLETE_INDEXES,
+        })
+    return {
+        "stats_since": stats_reset.isoformat() if stats_reset else None,
+        "indexes": indexes,
+        "unused_bytes": sum(index["size_bytes"] for index in indexes if index["unused"]),
+    }
+
+
+if __name__ == "__main__":
+    # python indexes.py migrate | report
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "report"
+    if command == "migrate":
+        print(apply_index_migration())
+    report = index_usage_report()
+    print(f"statistics since {report['stats_since']}")
+    for index in report["indexes"]:
+        flags = " ".join(flag for flag in ("unused", "obsolete", "unique") if index[flag])
+        print(f"{index['table']:18s} {index['index']:42s} {index['scans']:>10d} scans "
+              f"{index['size_bytes'] / 1024:>10.0f} KiB  {flags}")
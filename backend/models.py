@@ -1,17 +1,88 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, Float, Text, Index
+from sqlalchemy import Column, Integer, SmallInteger, String, ForeignKey, Date, DateTime, Boolean, Float, Text, Index, func, false, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
+from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.types import TypeDecorator
 from datetime import datetime
 
+from ids import TransactionId, uuid7
+
 Base = declarative_base()
 
+
+class CodedString(TypeDecorator):
+    """A string from a fixed vocabulary, stored as a 2-byte code.
+
+    The ORM and the API only ever see the strings; the table and every index
+    that includes the column hold the smallint. Codes are part of the on-disk
+    format: add new values with new codes, never renumber.
+    """
+
+    impl = SmallInteger
+    cache_ok = True
+
+    def __init__(self, codes, aliases=()):
+        super().__init__()
+        self.codes = tuple(codes)      # (value, code) pairs
+        self.aliases = tuple(aliases)  # (spelling, value) pairs
+        self._to_code = dict(self.codes)
+        self._to_value = {code: value for value, code in self.codes}
+        self._aliases = dict(self.aliases)
+
+    @property
+    def values(self):
+        return list(self._to_code)
+
+    def normalize(self, value):
+        """Canonical spelling of value, or None when it is not in the vocabulary"""
+        if value is None:
+            return None
+        value = self._aliases.get(value, value)
+        return value if value in self._to_code else None
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        canonical = self.normalize(value)
+        if canonical is None:
+            raise ValueError(f"{value!r} is not one of: {', '.join(self._to_code)}")
+        return self._to_code[canonical]
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else self._to_value.get(value)
+
+
+TRANSACTION_STATUSES = {"processing": 1, "pending": 2, "completed": 3, "cancelled": 4, "rejected": 5, "on_hold": 6}
+CURRENCIES = {"SYP": 1, "USD": 2}
+CURRENCY_ALIASES = {"ليرة سورية": "SYP"}
+FUND_TYPES = {"allocation": 1, "deduction": 2, "refund": 3, "deposit": 4}
+PROFIT_SOURCES = {"benefited_amount": 1, "tax": 2}
+USER_ROLES = {"director": 1, "branch_manager": 2, "employee": 3}
+
+TransactionStatusType = CodedString(TRANSACTION_STATUSES.items())
+CurrencyType = CodedString(CURRENCIES.items(), CURRENCY_ALIASES.items())
+FundType = CodedString(FUND_TYPES.items())
+ProfitSourceType = CodedString(PROFIT_SOURCES.items())
+UserRoleType = CodedString(USER_ROLES.items())
+
+
+def coded_equals(column, value):
+    """column == value, or a predicate that matches nothing when value is not a known code"""
+    canonical = column.type.normalize(value)
+    return false() if canonical is None else column == canonical
+
+
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        Index('idx_users_branch_role', 'branch_id', 'role'),
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     username = Column(String, unique=True, index=True)
     password = Column(String)
-    role = Column(String, default="employee")
+    role = Column(UserRoleType, default="employee")
     branch_id = Column(Integer, ForeignKey("branches.id"), nullable=True)
     created_at = Column(DateTime, default=datetime.now)
     
@@ -21,9 +92,9 @@ class User(Base):
 class Branch(Base):
     __tablename__ = "branches"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     branch_id = Column(String, unique=True, index=True)
-    name = Column(String, index=True)
+    name = Column(String, unique=True, index=True)
     location = Column(String)
     governorate = Column(String)
     phone_number = Column(String)  # رقم هاتف الفرع
@@ -43,41 +114,68 @@ class Branch(Base):
 
 class BranchFund(Base):
     __tablename__ = "branch_funds"
+    __table_args__ = (
+        # funds history is listed per branch, newest first
+        Index('idx_branch_funds_branch_created', 'branch_id', 'created_at'),
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     branch_id = Column(Integer, ForeignKey("branches.id"))
     amount = Column(Float)
-    type = Column(String)
-    currency = Column(String, default="SYP")  # Added currency field
+    type = Column(FundType)
+    currency = Column(CurrencyType, default="SYP")  # Added currency field
     description = Column(String)
     created_at = Column(DateTime, default=datetime.now)
     
     branch = relationship("Branch", back_populates="fund_history")
 
+# Columns only the transaction detail view needs. They live in
+# transaction_details so that list pages, counts and reports scan narrow rows.
+DETAIL_COLUMNS = (
+    "sender_mobile", "receiver_mobile", "sender_location", "receiver_location",
+    "message", "employee_name", "branch_governorate",
+)
+
+
+def _detail_proxy(name: str):
+    """Transaction.<name> reads and writes TransactionDetails.<name>, creating the row on first write"""
+    return association_proxy("details", name, creator=lambda value: TransactionDetails(**{name: value}))
+
+
 class Transaction(Base):
     __tablename__ = "transactions"
     
-    # Add indexes for commonly queried fields
+    # Indexes follow the query shapes in server_improved.py; see indexes.py
+    # for the migration and the usage report used to prune them.
     __table_args__ = (
-        Index('idx_transaction_date', 'date'),
-        Index('idx_transaction_branch', 'branch_id'),
-        Index('idx_transaction_currency', 'currency'),
-        Index('idx_transaction_status', 'status'),
-        Index('idx_transaction_dates', 'date', 'branch_id', 'currency', 'status')
+        # date-range reports; amount is included so totals can be index-only scans
+        Index('idx_transaction_dates', 'date', 'branch_id', 'currency', 'status',
+              postgresql_include=['amount']),
+        # outgoing lists and profit queries (branch_id + status = 'completed')
+        Index('idx_transaction_composite', 'branch_id', 'status', 'date'),
+        # incoming lists, payouts and the branch-manager OR filter
+        Index('idx_transaction_destination_status', 'destination_branch_id', 'status', 'date'),
+        # employees see their own transactions
+        Index('idx_transaction_employee', 'employee_id'),
+        # filter_type=incoming/outgoing/branch_related
+        Index('idx_transaction_receiver_governorate', 'receiver_governorate', 'date'),
+        Index('idx_transaction_sender_governorate', 'sender_governorate', 'date'),
+        # the analytics exporter re-reads what changed since its last run
+        Index('idx_transaction_updated_at', 'updated_at'),
+        # Monthly range partitions are managed by partitions.py
+        {'postgresql_partition_by': 'RANGE (date)'}
     )
 
-    id = Column(String, primary_key=True, index=True)
+    # The partition key has to be part of the primary key. Ids are uuid7 (see
+    # ids.py), so new rows append to the right edge of the index.
+    id = Column(TransactionId, primary_key=True, default=uuid7)
     sender = Column(String)
-    sender_mobile = Column(String)
     sender_governorate = Column(String)
-    sender_location = Column(String)
     receiver = Column(String)
-    receiver_mobile = Column(String)
     amount = Column(Float)  # Total amount
     base_amount = Column(Float, default=0.0)  # Added base amount
     benefited_amount = Column(Float, default=0.0)  # Added benefited amount
-    currency = Column(String, default="ليرة سورية")
-    message = Column(Text)
+    currency = Column(CurrencyType, default="SYP")
     
     # Branch relationships
     branch_id = Column(Integer, ForeignKey("branches.id"))
@@ -91,50 +189,189 @@ class Transaction(Base):
     employee_id = Column(Integer, ForeignKey("users.id"))
     received_by = Column(Integer, ForeignKey("users.id"))
     
-    employee_name = Column(String)
-    branch_governorate = Column(String)
-    status = Column(String, default="processing")
+    status = Column(TransactionStatusType, default="processing")
     is_received = Column(Boolean, default=False)
     received_at = Column(DateTime)
-    date = Column(DateTime, default=datetime.now)
+    date = Column(DateTime, primary_key=True, default=datetime.now)
     receiver_governorate = Column(String)
+    # Payout lease of the teller handling the transfer at the counter; see payouts.py
+    payout_claimed_by = Column(Integer)
+    payout_claim_expires = Column(DateTime)
+    # Bumped by every status change, which compares-and-swaps on it; see transitions.py
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    # Stamped by the database on insert and by every UPDATE; see analytics.py
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    # Cold columns, loaded on first access; list queries use selectinload(Transaction.details)
+    details = relationship(
+        "TransactionDetails",
+        primaryjoin="Transaction.id == foreign(TransactionDetails.transaction_id)",
+        uselist=False,
+        cascade="all, delete-orphan"
+    )
+    sender_mobile = _detail_proxy("sender_mobile")
+    receiver_mobile = _detail_proxy("receiver_mobile")
+    sender_location = _detail_proxy("sender_location")
+    receiver_location = _detail_proxy("receiver_location")
+    message = _detail_proxy("message")
+    employee_name = _detail_proxy("employee_name")
+    branch_governorate = _detail_proxy("branch_governorate")
     
     # Relationships
     branch = relationship("Branch", foreign_keys=[branch_id], back_populates="sent_transactions")
     destination_branch = relationship("Branch", foreign_keys=[destination_branch_id], back_populates="received_transactions")
     employee = relationship("User", foreign_keys=[employee_id])
     receiver_user = relationship("User", foreign_keys=[received_by])
-    profits = relationship("BranchProfits", back_populates="transaction")
+    profits = relationship(
+        "BranchProfits",
+        primaryjoin="Transaction.id == foreign(BranchProfits.transaction_id)",
+        back_populates="transaction"
+    )
+
+class TransactionDetails(Base):
+    """The rarely-read part of a transaction, 1:1 with transactions by id"""
+    __tablename__ = "transaction_details"
+
+    # No foreign key, for the same reason as Notification.transaction_id
+    transaction_id = Column(TransactionId, primary_key=True)
+    sender_mobile = Column(String)
+    receiver_mobile = Column(String)
+    sender_location = Column(String)
+    receiver_location = Column(String)
+    message = Column(Text)
+    employee_name = Column(String)
+    branch_governorate = Column(String)
+
+class Customer(Base):
+    """A sender or receiver, one row per normalised (mobile, name); maintained by customers.py"""
+    __tablename__ = "customers"
+    __table_args__ = (
+        Index('idx_customers_identity', 'mobile', 'name_key', unique=True),
+        # teller search and autocomplete are prefix probes
+        Index('idx_customers_name_prefix', 'name_key', postgresql_ops={'name_key': 'text_pattern_ops'}),
+        Index('idx_customers_mobile_prefix', 'mobile', postgresql_ops={'mobile': 'text_pattern_ops'}),
+    )
+
+    id = Column(Integer, primary_key=True)
+    mobile = Column(String, nullable=False, default="")  # digits, local 0 prefix; '' when unknown
+    name_key = Column(String, nullable=False)            # lower-cased, whitespace and alef forms folded
+    name = Column(String)                                # latest spelling seen
+    governorate = Column(String)
+    location = Column(String)
+    id_number = Column(String)
+    sent_count = Column(Integer, default=0)
+    received_count = Column(Integer, default=0)
+    total_amount_syp = Column(Float, default=0.0)
+    total_amount_usd = Column(Float, default=0.0)
+    first_seen = Column(DateTime)
+    last_seen = Column(DateTime)
 
 class Notification(Base):
     __tablename__ = "notifications"
+    __table_args__ = (
+        Index('idx_notification_transaction', 'transaction_id'),
+        # the notifications feed: everything, or one branch's, in (created_at, id) order
+        Index('idx_notification_feed', 'created_at', 'id'),
+        Index('idx_notification_branch_feed', 'branch_id', 'created_at', 'id'),
+        # the dispatch worker's queue: undelivered notifications, oldest first
+        Index('idx_notification_undelivered', 'id', 'next_attempt_at',
+              postgresql_where=text("status = 'pending' AND sent_at IS NULL")),
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
-    transaction_id = Column(String, ForeignKey("transactions.id"))
+    id = Column(Integer, primary_key=True)
+    # No foreign key: transactions(id) alone is not unique across partitions
+    transaction_id = Column(TransactionId)
+    branch_id = Column(Integer)  # the transfer's sending branch, copied so the feed needs no join
     recipient_phone = Column(String)
     message = Column(Text)
     status = Column(String, default="pending")
-    created_at = Column(DateTime, default=datetime.now)
+    # Stamped by the database (the inserting transaction's start), which is what the feed pages on
+    created_at = Column(DateTime, server_default=func.now())
+    # Delivery bookkeeping, written by notifications.py
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    next_attempt_at = Column(DateTime)  # NULL: due now; also the lease of a claimed batch
+    sent_at = Column(DateTime)
+    last_error = Column(Text)
 
-    transaction = relationship("Transaction", backref="notifications")
+    transaction = relationship(
+        "Transaction",
+        primaryjoin="foreign(Notification.transaction_id) == Transaction.id",
+        backref="notifications"
+    )
 
 class BranchProfits(Base):
     __tablename__ = "branch_profits"
+    __table_args__ = (
+        # profit listings and range totals read one branch's entries of one source by date
+        Index('idx_branch_profits_ledger', 'branch_id', 'source_type', 'date',
+              postgresql_include=['currency', 'profit_amount']),
+        Index('idx_branch_profits_transaction', 'transaction_id'),
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     branch_id = Column(Integer, ForeignKey("branches.id"))
-    transaction_id = Column(String, ForeignKey("transactions.id"))
+    transaction_id = Column(TransactionId)  # see Notification.transaction_id
     profit_amount = Column(Float, default=0.0)
-    currency = Column(String)
-    source_type = Column(String)  # 'benefited_amount', 'tax', etc.
+    currency = Column(CurrencyType)
+    source_type = Column(ProfitSourceType)  # 'benefited_amount' or 'tax'
     date = Column(DateTime, default=datetime.now)
     
     # Relationships
     branch = relationship("Branch", back_populates="profits")
-    transaction = relationship("Transaction", back_populates="profits")
+    transaction = relationship(
+        "Transaction",
+        primaryjoin="foreign(BranchProfits.transaction_id) == Transaction.id",
+        back_populates="profits"
+    )
+
+class BranchProfitRollup(Base):
+    """branch_profits totals per branch, currency, source and month; maintained by profits.py"""
+    __tablename__ = "branch_profit_rollups"
+
+    branch_id = Column(Integer, primary_key=True)
+    currency = Column(CurrencyType, primary_key=True)
+    source_type = Column(ProfitSourceType, primary_key=True)
+    month = Column(Date, primary_key=True)  # first day of the month
+    entries = Column(Integer, nullable=False, default=0)
+    profit_sum = Column(Float, nullable=False, default=0.0)
+
+class BranchProfitTop(Base):
+    """Each branch's largest profit entries (profits.PROFIT_TOP_N of them); maintained by profits.py"""
+    __tablename__ = "branch_profit_top"
+
+    branch_id = Column(Integer, primary_key=True)
+    transaction_id = Column(TransactionId, primary_key=True)
+    profit_amount = Column(Float, nullable=False)
+    currency = Column(CurrencyType)
+    date = Column(DateTime)
+
+class IdempotencyKey(Base):
+    """The response to a request sent with an Idempotency-Key, replayed to its retries; see idempotency.py"""
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        # idempotency.purge_expired
+        Index('idx_idempotency_keys_created', 'created_at'),
+    )
+
+    scope = Column(String, primary_key=True)  # endpoint and user
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)  # of the request body, so a reused key is caught
+    status_code = Column(Integer, nullable=False)
+    response = Column(JSONB, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+
+# Case-insensitive prefix search on sender/receiver (filters.prefix_match)
+Index('idx_transaction_sender_prefix', func.lower(Transaction.sender).label('sender_lower'),
+      postgresql_ops={'sender_lower': 'text_pattern_ops'})
+Index('idx_transaction_receiver_prefix', func.lower(Transaction.receiver).label('receiver_lower'),
+      postgresql_ops={'receiver_lower': 'text_pattern_ops'})
 
 # Add relationship to Branch class
 Branch.profits = relationship("BranchProfits", back_populates="branch")
 
 # Add relationship to Transaction class
-Transaction.profits = relationship("BranchProfits", back_populates="transaction")   
\ No newline at end of file
+Transaction.profits = relationship(
+    "BranchProfits",
+    primaryjoin="Transaction.id == foreign(BranchProfits.transaction_id)",
+    back_populates="transaction"
+)   
\ No newline at end of file
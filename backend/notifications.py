@@ -0,0 +1,477 @@
+import base64
+import importlib
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any, Tuple
+
+from sqlalchemy import func, or_, select, text, tuple_, update
+
+from customers import normalize_mobile
+from database import engine, oldest_transaction_start
+from models import Notification
+
+logger = logging.getLogger(__name__)
+
+# save_to_db (and the group commit writer) insert a 'pending' notification with
+# every transfer; delivering it is left to NotificationDispatcher, a background
+# thread in each API worker. It claims due notifications in batches with
+# FOR UPDATE SKIP LOCKED, so any number of workers share the queue without
+# waiting on each other, hands each batch to an SMS gateway under a rate limit,
+# and writes the outcome of the whole batch back in one UPDATE. Failed sends are
+# retried with exponential backoff up to NOTIFICATION_MAX_ATTEMPTS.
+#
+# status still follows the transfer (see NOTIFICATION_STATUS in the server);
+# sent_at is what records delivery, so a transfer moving back to 'pending' does
+# not send the same message twice.
+
+NOTIFICATION_BATCH_SIZE = int(os.getenv("NOTIFICATION_BATCH_SIZE", "100"))
+NOTIFICATION_RATE = float(os.getenv("NOTIFICATION_RATE", "50"))  # messages/s per worker, 0 = unlimited
+NOTIFICATION_POLL_INTERVAL = float(os.getenv("NOTIFICATION_POLL_INTERVAL", "1"))  # 0 disables the worker
+NOTIFICATION_MAX_ATTEMPTS = int(os.getenv("NOTIFICATION_MAX_ATTEMPTS", "5"))
+NOTIFICATION_RETRY_BASE = float(os.getenv("NOTIFICATION_RETRY_BASE", "30"))
+NOTIFICATION_RETRY_MAX = float(os.getenv("NOTIFICATION_RETRY_MAX", "3600"))
+# A claimed batch not written back within this long (the worker died) is due again
+NOTIFICATION_LEASE_SECONDS = int(os.getenv("NOTIFICATION_LEASE_SECONDS", "300"))
+NOTIFICATION_GATEWAY = os.getenv("NOTIFICATION_GATEWAY", "")  # "module:Class", default LocalSMSGateway
+NOTIFICATION_OUTBOX = os.getenv("NOTIFICATION_OUTBOX", "")
+METRICS_WINDOW = 60
+NOTIFICATION_FEED_LIMIT = 500
+
+
+class DeliveryError(Exception):
+    """A send that may succeed later (gateway down, throttled)"""
+    retryable = True
+
+
+class PermanentDeliveryError(DeliveryError):
+    """A send that will never succeed (no or malformed number); not retried"""
+    retryable = False
+
+
+class SMSGateway:
+    """Delivery backend.
+
+    send() gets one claimed batch (rows with id, recipient_phone and message)
+    and returns one entry per message, in order: None when it was accepted,
+    otherwise the exception describing why not. Anything other than a
+    PermanentDeliveryError is retried, as is the whole batch when send() raises.
+    """
+
+    def send(self, messages: list) -> List[Optional[Exception]]:
+        raise NotImplementedError
+
+
+class LocalSMSGateway(SMSGateway):
+    """Stand-in gateway: appends messages to a JSON-lines outbox file (or the log).
+
+    latency_ms and failure_rate simulate a remote provider's round trip and
+    transient errors, for trying out batching and retries.
+    """
+
+    def __init__(self, outbox: str = NOTIFICATION_OUTBOX, latency_ms: float = 0.0, failure_rate: float = 0.0):
+        self.outbox = outbox
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+        self._lock = threading.Lock()
+
+    def send(self, messages: list) -> List[Optional[Exception]]:
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        results, accepted = [], []
+        for message in messages:
+            number = normalize_mobile(message.recipient_phone)
+            if len(number) < 9:
+                results.append(PermanentDeliveryError("no valid recipient phone"))
+            elif self.failure_rate and random.random() < self.failure_rate:
+                results.append(DeliveryError("gateway unavailable"))
+            else:
+                results.append(None)
+                accepted.append({"id": message.id, "to": number, "message": message.message})
+        if accepted:
+            if self.outbox:
+                with self._lock, open(self.outbox, "a", encoding="utf-8") as outbox:
+                    outbox.writelines(json.dumps(line, ensure_ascii=False) + "\n" for line in accepted)
+            else:
+                for line in accepted:
+                    logger.debug(f"SMS to {line['to']}: {line['message']}")
+        return results
+
+
+def load_gateway(spec: str = NOTIFICATION_GATEWAY) -> SMSGateway:
+    """The gateway named by "module:Class", or the local stand-in"""
+    if not spec:
+        return LocalSMSGateway()
+    module_name, _, class_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class RateLimiter:
+    """Token bucket: `rate` messages per second, bursts of up to `burst`"""
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, limit: int) -> int:
+        """Wait for at least one token, then take up to `limit`"""
+        if self.rate <= 0:
+            return limit
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    taken = min(limit, int(self._tokens))
+                    self._tokens -= taken
+                    return taken
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def refund(self, tokens: int):
+        if self.rate > 0 and tokens > 0:
+            with self._lock:
+                self._tokens = min(self.burst, self._tokens + tokens)
+
+
+def undelivered_filters(max_attempts: int = NOTIFICATION_MAX_ATTEMPTS) -> list:
+    return [
+        Notification.status == "pending",
+        Notification.sent_at.is_(None),
+        Notification.attempts < max_attempts,
+    ]
+
+
+def claim_batch(conn, limit: int, lease_seconds: int = NOTIFICATION_LEASE_SECONDS,
+                max_attempts: int = NOTIFICATION_MAX_ATTEMPTS) -> list:
+    """Claim up to `limit` due notifications, oldest first, skipping rows other workers are claiming.
+
+    The claim pushes next_attempt_at out by the lease and counts the attempt;
+    it holds once the caller's transaction commits.
+    """
+    now = datetime.now()
+    due = select(Notification.id).where(
+        *undelivered_filters(max_attempts),
+        or_(Notification.next_attempt_at.is_(None), Notification.next_attempt_at <= now)
+    ).order_by(Notification.id).limit(limit).with_for_update(skip_locked=True).cte("due")
+    return conn.execute(
+        update(Notification).where(Notification.id == due.c.id).values(
+            attempts=Notification.attempts + 1,
+            next_attempt_at=now + timedelta(seconds=lease_seconds)
+        ).returning(
+            Notification.id, Notification.recipient_phone, Notification.message,
+            Notification.attempts, Notification.created_at
+        )
+    ).all()
+
+
+_WRITE_BACK = text("""
+    UPDATE notifications n SET
+        status = CASE WHEN u.status IS NOT NULL AND n.status = 'pending' THEN u.status ELSE n.status END,
+        sent_at = COALESCE(u.sent_at, n.sent_at),
+        next_attempt_at = u.next_attempt_at,
+        last_error = u.last_error
+    FROM unnest(CAST(:ids AS integer[]), CAST(:statuses AS text[]), CAST(:sent_at AS timestamp[]),
+                CAST(:next_attempt_at AS timestamp[]), CAST(:last_error AS text[]))
+         AS u(id, status, sent_at, next_attempt_at, last_error)
+    WHERE n.id = u.id
+""")
+
+
+def write_outcomes(conn, outcomes: List[Dict[str, Any]]):
+    """Write a batch's delivery results back in one statement.
+
+    A status change that happened meanwhile (transfer completed or cancelled)
+    wins over the worker's 'sent'/'failed'; sent_at is recorded either way.
+    """
+    if outcomes:
+        conn.execute(_WRITE_BACK, {
+            "ids": [outcome["id"] for outcome in outcomes],
+            "statuses": [outcome["status"] for outcome in outcomes],
+            **{column: [outcome[column] for outcome in outcomes]
+               for column in ("sent_at", "next_attempt_at", "last_error")},
+        })
+
+
+class NotificationDispatcher:
+    """Background thread that drains the notification queue through a gateway"""
+
+    def __init__(self, bind=engine, gateway: Optional[SMSGateway] = None,
+                 batch_size: int = NOTIFICATION_BATCH_SIZE, rate: float = NOTIFICATION_RATE,
+                 interval: float = NOTIFICATION_POLL_INTERVAL, max_attempts: int = NOTIFICATION_MAX_ATTEMPTS,
+                 retry_base: float = NOTIFICATION_RETRY_BASE, retry_max: float = NOTIFICATION_RETRY_MAX,
+                 lease_seconds: int = NOTIFICATION_LEASE_SECONDS):
+        self.bind = bind
+        self.gateway = gateway
+        self.batch_size = batch_size
+        self.limiter = RateLimiter(rate)
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.lease_seconds = lease_seconds
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._counters = {"batches": 0, "claimed": 0, "sent": 0, "retried": 0, "failed": 0, "errors": 0}
+        self._recent: deque = deque()  # (monotonic time, delivered, sum of delivery lag seconds)
+
+    def backoff(self, attempts: int) -> float:
+        """Seconds before the next attempt: doubling from retry_base, capped, with jitter"""
+        delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def dispatch_batch(self) -> int:
+        """Claim, send and write back one batch; the number of notifications claimed"""
+        if self.gateway is None:
+            self.gateway = load_gateway()
+        wanted = self.limiter.take(self.batch_size)
+        with self.bind.begin() as conn:
+            batch = claim_batch(conn, wanted, self.lease_seconds, self.max_attempts)
+        self.limiter.refund(wanted - len(batch))
+        if not batch:
+            return 0
+
+        try:
+            results = self.gateway.send(batch)
+            if len(results) != len(batch):
+                raise DeliveryError(f"gateway returned {len(results)} results for {len(batch)} messages")
+        except Exception as e:
+            logger.error(f"Notification gateway failed for a batch of {len(batch)}: {str(e)}")
+            results = [e] * len(batch)
+
+        now = datetime.now()
+        outcomes, delivered, lag, retried, failed = [], 0, 0.0, 0, 0
+        for message, error in zip(batch, results):
+            outcome = {"id": message.id, "status": None, "sent_at": None,
+                       "next_attempt_at": None, "last_error": None}
+            if error is None:
+                outcome.update(status="sent", sent_at=now)
+                delivered += 1
+                lag += (now - message.created_at).total_seconds() if message.created_at else 0.0
+            elif getattr(error, "retryable", True) and message.attempts < self.max_attempts:
+                outcome.update(next_attempt_at=now + timedelta(seconds=self.backoff(message.attempts)),
+                               last_error=str(error)[:500])
+                retried += 1
+            else:
+                outcome.update(status="failed", last_error=str(error)[:500])
+                failed += 1
+            outcomes.append(outcome)
+        with self.bind.begin() as conn:
+            write_outcomes(conn, outcomes)
+
+        with self._lock:
+            self._counters["batches"] += 1
+            self._counters["claimed"] += len(batch)
+            self._counters["sent"] += delivered
+            self._counters["retried"] += retried
+            self._counters["failed"] += failed
+            self._recent.append((time.monotonic(), delivered, lag))
+        return len(batch)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                claimed = self.dispatch_batch()
+            except Exception as e:
+                with self._lock:
+                    self._counters["errors"] += 1
+                logger.error(f"Notification dispatch failed: {str(e)}")
+                claimed = 0
+            # A full batch means there is probably more waiting
+            if claimed < self.batch_size:
+                self._stop.wait(self.interval)
+
+    def start(self) -> bool:
+        if self.interval <= 0 or self._thread is not None:
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="notification-dispatch", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def queue_stats(self) -> Dict[str, Any]:
+        """Undelivered notifications across all workers, and how long the oldest has waited"""
+        now = datetime.now()
+        with self.bind.connect() as conn:
+            row = conn.execute(select(
+                func.count(),
+                func.count().filter(or_(Notification.next_attempt_at.is_(None),
+                                        Notification.next_attempt_at <= now)),
+                func.min(Notification.created_at)
+            ).where(*undelivered_filters(self.max_attempts))).one()
+        return {
+            "queued": row[0],
+            "due": row[1],
+            "queue_lag_seconds": round((now - row[2]).total_seconds(), 3) if row[2] else 0.0,
+        }
+
+    def metrics(self) -> Dict[str, Any]:
+        """This worker's delivery counters and throughput over the last METRICS_WINDOW seconds, plus the queue"""
+        with self._lock:
+            horizon = time.monotonic() - METRICS_WINDOW
+            while self._recent and self._recent[0][0] < horizon:
+                self._recent.popleft()
+            delivered = sum(entry[1] for entry in self._recent)
+            lag = sum(entry[2] for entry in self._recent)
+            counters = dict(self._counters)
+        return {
+            "running": self._thread is not None,
+            **counters,
+            "sent_per_second": round(delivered / METRICS_WINDOW, 3),
+            "average_delivery_lag_seconds": round(lag / delivered, 3) if delivered else None,
+            **self.queue_stats(),
+        }
+
+
+def encode_cursor(notification) -> str:
+    """Opaque feed position: just after this notification"""
+    position = f"{notification.created_at.isoformat()}|{notification.id}"
+    return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """(created_at, id) of a cursor; ValueError when it was not made by encode_cursor"""
+    try:
+        position = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        created_at, notification_id = position.split("|")
+        return datetime.fromisoformat(created_at), int(notification_id)
+    except Exception:
+        raise ValueError("Invalid notifications cursor")
+
+
+def notification_feed(db, branch_id: Optional[int] = None, since: Optional[str] = None,
+                      limit: int = 100, columns=None) -> Tuple[List[Any], Optional[str], bool]:
+    """A page of the notifications feed: (notifications, next cursor, whether more are waiting).
+
+    Without `since`, the newest `limit` notifications, newest first, and a
+    cursor at the newest one. With it, the ones after the cursor, oldest first.
+    Both are range scans of idx_notification_feed (or the per-branch
+    idx_notification_branch_feed), so a poll reads only what it returns.
+    Given `columns` (which must include id and created_at), the page is rows
+    of those columns instead of Notification entities.
+
+    Only notifications stamped before the oldest open transaction started are
+    handed out. One still being written gets a created_at at or after that, and
+    could otherwise commit behind a cursor that has already moved past it.
+    """
+    limit = max(1, min(limit, NOTIFICATION_FEED_LIMIT))
+    settled = oldest_transaction_start(db)
+    query = db.query(*columns) if columns else db.query(Notification)
+    query = query.filter(Notification.created_at < settled)
+    if branch_id is not None:
+        query = query.filter(Notification.branch_id == branch_id)
+
+    if since is None:
+        notifications = query.order_by(Notification.created_at.desc(), Notification.id.desc()).limit(limit).all()
+        return notifications, encode_cursor(notifications[0]) if notifications else None, False
+
+    position = decode_cursor(since)
+    notifications = query.filter(
+        tuple_(Notification.created_at, Notification.id) > tuple_(*position)
+    ).order_by(Notification.created_at, Notification.id).limit(limit + 1).all()
+    has_more = len(notifications) > limit
+    notifications = notifications[:limit]
+    return notifications, encode_cursor(notifications[-1]) if notifications else since, has_more
+
+
+# Create a global notification dispatcher for this worker
+notification_dispatcher = NotificationDispatcher()
+
+
+def benchmark_dispatch(messages: int = 2000, worker_levels=(1, 4), batch_sizes=(1, 100),
+                       latency_ms: float = 20.0, failure_rate: float = 0.05):
+    """Notifications/s draining a queue, one message per gateway call vs batches.
+
+    The local gateway sleeps latency_ms per call (a provider round trip) and
+    fails failure_rate of messages transiently; those are retried after a short
+    backoff until the queue is empty. Duplicates are messages the gateway
+    accepted more than once. Rows are tagged and deleted afterwards; run
+    against a scratch database.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from sqlalchemy import create_engine, delete, insert
+    from database import DATABASE_URL
+
+    marker = "__notification_benchmark__"
+    bind = create_engine(DATABASE_URL, pool_size=10, max_overflow=10)
+
+    class CountingGateway(LocalSMSGateway):
+        def __init__(self):
+            super().__init__(outbox="", latency_ms=latency_ms, failure_rate=failure_rate)
+            self.accepted = []
+
+        def send(self, batch):
+            results = super().send(batch)
+            with self._lock:
+                self.accepted.extend(message.id for message, error in zip(batch, results) if error is None)
+            return results
+
+    results = []
+    for workers in worker_levels:
+        for batch_size in batch_sizes:
+            with bind.begin() as conn:
+                conn.execute(insert(Notification.__table__), [
+                    {"recipient_phone": "0991234567", "message": marker, "status": "pending"}
+                    for _ in range(messages)
+                ])
+            gateway = CountingGateway()
+            dispatchers = [
+                NotificationDispatcher(bind=bind, gateway=gateway, batch_size=batch_size, rate=0,
+                                       retry_base=0.05, retry_max=0.2, max_attempts=20)
+                for _ in range(workers)
+            ]
+
+            def drain(dispatcher):
+                while True:
+                    if dispatcher.dispatch_batch() == 0:
+                        if dispatcher.queue_stats()["queued"] == 0:
+                            return
+                        time.sleep(0.05)
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(drain, dispatchers))
+            elapsed = time.perf_counter() - started
+            results.append(dict(
+                workers=workers, batch_size=batch_size, per_second=len(gateway.accepted) / elapsed,
+                gateway_calls=sum(d._counters["batches"] for d in dispatchers),
+                retried=sum(d._counters["retried"] for d in dispatchers),
+                duplicates=len(gateway.accepted) - len(set(gateway.accepted)),
+                undelivered=messages - len(set(gateway.accepted)),
+            ))
+            with bind.begin() as conn:
+                conn.execute(delete(Notification).where(Notification.message == marker))
+    bind.dispose()
+    return results
+
+
+if __name__ == "__main__":
+    # python notifications.py [messages] | once | metrics
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "2000"
+    if command == "once":
+        print(f"dispatched {notification_dispatcher.dispatch_batch()} notifications")
+    elif command == "metrics":
+        print(json.dumps(notification_dispatcher.metrics(), indent=2))
+    else:
+        for row in benchmark_dispatch(int(command)):
+            print(f"{row['workers']:>2d} workers  batch {row['batch_size']:>4d}  {row['per_second']:>8.0f} sent/s   "
+                  f"{row['gateway_calls']:>5d} gateway calls  {row['retried']:>4d} retried   "
+                  f"{row['duplicates']} duplicates  {row['undelivered']} undelivered")
@@ -0,0 +1,284 @@
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+
+from database import engine, convert_coded_column, move_transaction_details
+from ids import uuid_cast_sql
+from models import CodedString, Transaction, TRANSACTION_STATUSES
+
+logger = logging.getLogger(__name__)
+
+# Monthly partitions are created this many months past the current one
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+PARTITION_MAINTENANCE_INTERVAL = 24 * 3600
+ARCHIVE_SCHEMA = os.getenv("PARTITION_ARCHIVE_SCHEMA", "archive")
+DEFAULT_PARTITION = "transactions_default"
+
+# Serialises partition DDL between workers that start at the same time
+_PARTITION_LOCK_KEY = 7301
+
+
+def _month_start(value: date) -> date:
+    return date(value.year, value.month, 1)
+
+
+def _next_month(value: date) -> date:
+    return (_month_start(value) + timedelta(days=32)).replace(day=1)
+
+
+def partition_name(month: date) -> str:
+    return f"transactions_{month.year:04d}_{month.month:02d}"
+
+
+def is_partitioned(conn) -> bool:
+    return bool(conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = 'transactions' AND c.relnamespace = 'public'::regnamespace"
+    )).scalar())
+
+
+def list_partitions(conn) -> List[Tuple[str, Optional[date], Optional[date]]]:
+    """Attached partitions as (name, lower bound, upper bound); None bounds for DEFAULT"""
+    rows = conn.execute(text("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'public.transactions'::regclass
+        ORDER BY c.relname
+    """)).all()
+    partitions = []
+    for name, bound in rows:
+        if bound == "DEFAULT":
+            partitions.append((name, None, None))
+            continue
+        # FOR VALUES FROM ('2024-01-01 00:00:00') TO ('2024-02-01 00:00:00')
+        lower, upper = [part.split("'")[1][:10] for part in bound.split(" TO ")]
+        partitions.append((name, date.fromisoformat(lower), date.fromisoformat(upper)))
+    return partitions
+
+
+def _create_month_partition(conn, month: date):
+    name = partition_name(month)
+    lower, upper = month.isoformat(), _next_month(month).isoformat()
+    has_default = conn.execute(text("SELECT to_regclass(:name)"), {"name": f"public.{DEFAULT_PARTITION}"}).scalar()
+    stray_rows = has_default and conn.execute(text(
+        f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE date >= :lower AND date < :upper)"
+    ), {"lower": lower, "upper": upper}).scalar()
+    if not stray_rows:
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF transactions "
+            f"FOR VALUES FROM ('{lower}') TO ('{upper}')"
+        ))
+        return
+    # Rows for this month already landed in the default partition; Postgres refuses
+    # to create the partition until they are moved out of it.
+    conn.execute(text(f"ALTER TABLE transactions DETACH PARTITION {DEFAULT_PARTITION}"))
+    conn.execute(text(
+        f"CREATE TABLE {name} PARTITION OF transactions FOR VALUES FROM ('{lower}') TO ('{upper}')"
+    ))
+    moved = conn.execute(text(
+        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE date >= :lower AND date < :upper RETURNING *) "
+        f"INSERT INTO transactions SELECT * FROM moved"
+    ), {"lower": lower, "upper": upper}).rowcount
+    conn.execute(text(f"ALTER TABLE transactions ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+    logger.info(f"Moved {moved} rows from {DEFAULT_PARTITION} into {name}")
+
+
+def ensure_partitions(bind=engine, months_ahead: int = PARTITION_MONTHS_AHEAD, since: Optional[date] = None) -> List[str]:
+    """Create monthly partitions from `since` (default: this month) through `months_ahead` months ahead.
+
+    A DEFAULT partition catches anything outside the created ranges, so an
+    insert never fails because maintenance fell behind.
+    """
+    created = []
+    with bind.begin() as conn:
+        if not is_partitioned(conn):
+            return created
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _PARTITION_LOCK_KEY})
+        existing = {name for name, _, _ in list_partitions(conn)}
+        if DEFAULT_PARTITION not in existing:
+            conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF transactions DEFAULT"))
+            created.append(DEFAULT_PARTITION)
+        month = _month_start(since or date.today())
+        last = _month_start(date.today())
+        for _ in range(months_ahead):
+            last = _next_month(last)
+        while month <= last:
+            if partition_name(month) not in existing:
+                _create_month_partition(conn, month)
+                created.append(partition_name(month))
+            month = _next_month(month)
+    if created:
+        logger.info(f"Created transaction partitions: {', '.join(created)}")
+    return created
+
+
+def migrate_to_partitioned(bind=engine, keep_old_table: bool = False):
+    """Rebuild an existing plain `transactions` table as a partitioned one.
+
+    Runs in a single transaction and holds an exclusive lock on transactions for
+    its whole duration, so schedule it in a maintenance window. Foreign keys that
+    point at transactions(id) are dropped: a unique key on a partitioned table
+    has to include the partition key, so transactions(id) alone cannot be
+    referenced any more.
+    """
+    with bind.begin() as conn:
+        if is_partitioned(conn):
+            logger.info("transactions is already partitioned")
+            return
+        conn.execute(text("LOCK TABLE transactions IN ACCESS EXCLUSIVE MODE"))
+        for table, constraint in conn.execute(text("""
+            SELECT conrelid::regclass::text, conname FROM pg_constraint
+            WHERE contype = 'f' AND confrelid = 'public.transactions'::regclass
+        """)).all():
+            conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{constraint}"'))
+
+        conn.execute(text("ALTER TABLE transactions RENAME TO transactions_unpartitioned"))
+        # Free the index and constraint names for the new table
+        for (index_name,) in conn.execute(text("""
+            SELECT i.relname FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+            WHERE x.indrelid = 'public.transactions_unpartitioned'::regclass
+              AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)
+        """)).all():
+            conn.execute(text(f'DROP INDEX "{index_name}"'))
+        for (constraint,) in conn.execute(text("""
+            SELECT conname FROM pg_constraint
+            WHERE conrelid = 'public.transactions_unpartitioned'::regclass AND contype IN ('p', 'u')
+        """)).all():
+            conn.execute(text(
+                f'ALTER TABLE transactions_unpartitioned RENAME CONSTRAINT "{constraint}" TO "{constraint}_old"'
+            ))
+
+        Transaction.__table__.create(bind=conn)
+        first = conn.execute(text("SELECT min(date) FROM transactions_unpartitioned")).scalar()
+        conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF transactions DEFAULT"))
+        month = _month_start(first.date() if first else date.today())
+        last = _month_start(date.today())
+        for _ in range(PARTITION_MONTHS_AHEAD):
+            last = _next_month(last)
+        while month <= last:
+            _create_month_partition(conn, month)
+            month = _next_month(month)
+
+        # Cold columns go to transaction_details; the copy below only takes the hot
+        # ones, with status/currency already in their smallint codes
+        move_transaction_details(conn, "transactions_unpartitioned", drop=False)
+        for column in Transaction.__table__.columns:
+            if isinstance(column.type, CodedString):
+                convert_coded_column(conn, "transactions_unpartitioned", column)
+
+        # Columns added since (payout lease, version) start at their defaults
+        present = set(conn.execute(text(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_schema = 'public' AND table_name = 'transactions_unpartitioned'"
+        )).scalars().all())
+        names = [column.name for column in Transaction.__table__.columns if column.name in present]
+        columns = ", ".join(names)
+        # date is part of the primary key now, so it can no longer be NULL; ids
+        # are converted to uuid on the way (see ids.migrate_transaction_ids)
+        select_columns = ", ".join(
+            "COALESCE(date, received_at, now())" if name == "date"
+            else uuid_cast_sql("id") if name == "id"
+            else name
+            for name in names
+        )
+        copied = conn.execute(text(
+            f"INSERT INTO transactions ({columns}) SELECT {select_columns} FROM transactions_unpartitioned"
+        )).rowcount
+        if not keep_old_table:
+            conn.execute(text("DROP TABLE transactions_unpartitioned"))
+    logger.info(f"Migrated {copied} transactions into the partitioned table")
+
+
+def archive_partitions(before: date, bind=engine) -> List[str]:
+    """Detach monthly partitions that end on or before `before` into the archive schema.
+
+    Archived months drop out of every query against transactions (and out of
+    its indexes); they stay queryable as archive.transactions_YYYY_MM. Export
+    the analytics snapshot before archiving if reports still need them.
+    """
+    archived = []
+    with bind.begin() as conn:
+        if not is_partitioned(conn):
+            return archived
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _PARTITION_LOCK_KEY})
+        conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}"))
+        for name, _, upper in list_partitions(conn):
+            if upper is None or upper > before:
+                continue
+            conn.execute(text(f"ALTER TABLE transactions DETACH PARTITION {name}"))
+            conn.execute(text(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}"))
+            archived.append(name)
+    if archived:
+        logger.info(f"Archived transaction partitions: {', '.join(archived)}")
+    return archived
+
+
+def scanned_partitions(sql: str, params: dict = None, bind=engine) -> List[str]:
+    """Names of the transactions partitions the planner keeps for a query (via EXPLAIN)"""
+    with bind.connect() as conn:
+        plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"), params or {}).scalar()
+    found = []
+
+    def walk(node):
+        relation = node.get("Relation Name")
+        if relation and relation.startswith("transactions_") and relation not in found:
+            found.append(relation)
+        for child in node.get("Plans", []):
+            walk(child)
+
+    walk(plan[0]["Plan"])
+    return found
+
+
+def start_partition_maintenance(bind=engine, interval: int = PARTITION_MAINTENANCE_INTERVAL) -> threading.Thread:
+    """Keep creating partitions ahead of time for as long as the worker runs"""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                ensure_partitions(bind)
+            except Exception as e:
+                logger.error(f"Partition maintenance failed: {str(e)}")
+
+    thread = threading.Thread(target=run, name="partition-maintenance", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    # python partitions.py migrate | ensure | archive YYYY-MM-DD | check
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "check"
+    if command == "migrate":
+        migrate_to_partitioned()
+    elif command == "ensure":
+        print(ensure_partitions())
+    elif command == "archive":
+        print(archive_partitions(date.fromisoformat(sys.argv[2])))
+
+    # Partition pruning checks: each date-filtered query shape the reports use
+    # must only touch the partitions for the requested months.
+    this_month = _month_start(date.today())
+    month_start = datetime.combine(this_month, datetime.min.time())
+    month_end = datetime.combine(_next_month(this_month), datetime.min.time())
+    expected = partition_name(this_month)
+    checks = {
+        "range": ("SELECT count(*) FROM transactions WHERE date >= :start AND date < :end", {}),
+        "between": ("SELECT count(*) FROM transactions WHERE date BETWEEN :start AND :end_inclusive", {}),
+        "range + branch": ("SELECT sum(amount) FROM transactions WHERE date >= :start AND date < :end AND branch_id = 1", {}),
+        "range + status": ("SELECT count(*) FROM transactions WHERE date >= :start AND date < :end AND status = :completed",
+                           {"completed": TRANSACTION_STATUSES["completed"]}),
+    }
+    for label, (sql, extra) in checks.items():
+        params = {"start": month_start, "end": month_end, "end_inclusive": month_end - timedelta(microseconds=1), **extra}
+        scanned = scanned_partitions(sql, params)
+        assert scanned == [expected], f"{label}: expected only {expected}, planner kept {scanned}"
+        print(f"{label:16s} -> {scanned}")
+    print("partition pruning OK")
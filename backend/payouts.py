@@ -0,0 +1,215 @@
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any
+
+from sqlalchemy import or_, select, update
+from sqlalchemy.orm import selectinload
+
+from models import Transaction
+
+logger = logging.getLogger(__name__)
+
+# Payout queue: transfers waiting at their destination branch (processing, not
+# yet received), oldest first, read from idx_transaction_destination_status.
+# A teller claims one before paying it out. The claim is a lease stored on the
+# transaction row (payout_claimed_by / payout_claim_expires), taken with
+# FOR UPDATE SKIP LOCKED so tellers working the same queue never wait on each
+# other, and it lapses on its own if the teller walks away.
+
+PAYOUT_LEASE_SECONDS = int(os.getenv("PAYOUT_LEASE_SECONDS", "120"))
+
+
+def waiting_filters(branch_id: int) -> list:
+    return [
+        Transaction.destination_branch_id == branch_id,
+        Transaction.status == "processing",
+        Transaction.is_received.is_(False),
+    ]
+
+
+def unclaimed(teller_id: Optional[int] = None):
+    """No live lease, or (for renewals) a lease held by teller_id"""
+    free = or_(Transaction.payout_claim_expires.is_(None), Transaction.payout_claim_expires <= datetime.now())
+    if teller_id is None:
+        return free
+    return or_(free, Transaction.payout_claimed_by == teller_id)
+
+
+def _lease(teller_id: int, lease_seconds: int) -> Dict[str, Any]:
+    return {
+        Transaction.payout_claimed_by: teller_id,
+        Transaction.payout_claim_expires: datetime.now() + timedelta(seconds=lease_seconds),
+    }
+
+
+def payout_queue(db, branch_id: int, limit: int = 50, include_claimed: bool = True) -> List[Transaction]:
+    """The branch's waiting transfers, oldest first"""
+    query = db.query(Transaction).filter(*waiting_filters(branch_id))
+    if not include_claimed:
+        query = query.filter(unclaimed())
+    return query.order_by(Transaction.date, Transaction.id).limit(limit).options(
+        selectinload(Transaction.details)
+    ).all()
+
+
+def claim_next(db, branch_id: int, teller_id: int, lease_seconds: int = PAYOUT_LEASE_SECONDS):
+    """Lease the oldest unclaimed transfer waiting at the branch; (id, date, expires) or None.
+
+    Rows another teller is claiming right now are skipped rather than waited
+    on. Runs in the caller's transaction; the lease holds once it commits.
+    """
+    candidate = select(Transaction.id, Transaction.date).where(
+        *waiting_filters(branch_id), unclaimed()
+    ).order_by(Transaction.date, Transaction.id).limit(1).with_for_update(skip_locked=True).cte("candidate")
+    return db.execute(
+        update(Transaction).where(
+            Transaction.id == candidate.c.id, Transaction.date == candidate.c.date
+        ).values(_lease(teller_id, lease_seconds)).returning(
+            Transaction.id, Transaction.date, Transaction.payout_claim_expires
+        )
+    ).first()
+
+
+def claim_transaction(db, transaction_id: str, branch_id: int, teller_id: int,
+                      lease_seconds: int = PAYOUT_LEASE_SECONDS):
+    """Lease a specific waiting transfer (or renew the teller's own lease); (id, date, expires) or None.
+
+    The UPDATE waits for a concurrent claim of the same row and then re-checks
+    the lease, so exactly one of two racing tellers gets it.
+    """
+    return db.execute(
+        update(Transaction).where(
+            Transaction.id == transaction_id, *waiting_filters(branch_id), unclaimed(teller_id)
+        ).values(_lease(teller_id, lease_seconds)).returning(
+            Transaction.id, Transaction.date, Transaction.payout_claim_expires
+        )
+    ).first()
+
+
+def release_claim(db, transaction_id: str, teller_id: Optional[int] = None) -> bool:
+    """Drop a lease early; teller_id=None releases whoever holds it"""
+    conditions = [Transaction.id == transaction_id, Transaction.payout_claimed_by.isnot(None)]
+    if teller_id is not None:
+        conditions.append(Transaction.payout_claimed_by == teller_id)
+    return db.execute(
+        update(Transaction).where(*conditions).values({
+            Transaction.payout_claimed_by: None,
+            Transaction.payout_claim_expires: None,
+        })
+    ).rowcount > 0
+
+
+def claimed_by_other(transaction: Transaction, teller_id: int) -> bool:
+    """Whether a live lease on the transaction as read belongs to someone else.
+
+    Leases are taken without bumping the version, so a writer that acts on this
+    check must also put unclaimed(teller_id) in its compare-and-swap.
+    """
+    return (
+        transaction.payout_claimed_by is not None
+        and transaction.payout_claimed_by != teller_id
+        and transaction.payout_claim_expires is not None
+        and transaction.payout_claim_expires > datetime.now()
+    )
+
+
+def benchmark_claims(tellers_levels=(1, 4, 16), transfers: int = 400):
+    """Payouts/s with concurrent tellers draining one branch's queue.
+
+    Every teller loops claim (commit) -> pay out (commit) until the queue is
+    empty; latency is that of the claim statement.
+    "SKIP LOCKED" is claim_next; "FOR UPDATE" is the same query without
+    SKIP LOCKED, where tellers queue on the oldest row and, once it is paid,
+    get nothing back for that attempt. Double payouts are counted from the
+    transfers each teller paid. Rows are tagged and deleted afterwards; run
+    against a scratch database.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.orm import sessionmaker
+    from database import DATABASE_URL
+    from group_commit import _BENCH_MARKER, _bench_rows, _bench_cleanup, _percentiles, insert_transfers
+
+    bind = create_engine(DATABASE_URL, pool_size=10, max_overflow=20)
+    Session = sessionmaker(autoflush=False, bind=bind)
+    with bind.connect() as conn:
+        branch_id = conn.execute(text("SELECT id FROM branches ORDER BY id LIMIT 1")).scalar()
+    if branch_id is None:
+        raise SystemExit("the claim benchmark needs at least one branch")
+
+    def blocking_claim(db, teller_id):
+        candidate = select(Transaction.id, Transaction.date).where(
+            *waiting_filters(branch_id), unclaimed()
+        ).order_by(Transaction.date, Transaction.id).limit(1).with_for_update().cte("candidate")
+        return db.execute(
+            update(Transaction).where(
+                Transaction.id == candidate.c.id, Transaction.date == candidate.c.date
+            ).values(_lease(teller_id, PAYOUT_LEASE_SECONDS)).returning(Transaction.id, Transaction.date)
+        ).first()
+
+    def skip_locked_claim(db, teller_id):
+        return claim_next(db, branch_id, teller_id)
+
+    results = []
+    for tellers in tellers_levels:
+        for label, claim in (("FOR UPDATE", blocking_claim), ("SKIP LOCKED", skip_locked_claim)):
+            writes = []
+            for _ in range(transfers):
+                rows = _bench_rows()
+                rows["transaction"]["destination_branch_id"] = branch_id
+                writes.append(rows)
+            with bind.begin() as conn:
+                insert_transfers(conn, writes)
+
+            def teller(teller_id):
+                paid, misses, latencies = [], 0, []
+                while True:
+                    db = Session()
+                    try:
+                        started = time.perf_counter()
+                        claimed = claim(db, teller_id)
+                        latencies.append(time.perf_counter() - started)
+                        if claimed is None:
+                            db.rollback()
+                            if db.query(Transaction.id).filter(
+                                *waiting_filters(branch_id), Transaction.sender == _BENCH_MARKER
+                            ).first() is None:
+                                return paid, misses, latencies
+                            misses += 1
+                            continue
+                        db.commit()
+                        # The payout itself, as a separate request would make it
+                        db.execute(update(Transaction).where(
+                            Transaction.id == claimed.id, Transaction.date == claimed.date
+                        ).values(status="completed", is_received=True, payout_claimed_by=None,
+                                 payout_claim_expires=None))
+                        db.commit()
+                        paid.append(claimed.id)
+                    finally:
+                        db.close()
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=tellers) as pool:
+                outcomes = list(pool.map(teller, range(1, tellers + 1)))
+            elapsed = time.perf_counter() - started
+            paid = [transaction_id for own, _, _ in outcomes for transaction_id in own]
+            results.append(dict(
+                tellers=tellers, mode=label, per_second=len(paid) / elapsed,
+                empty_claims=sum(misses for _, misses, _ in outcomes), double_payouts=len(paid) - len(set(paid)),
+                **_percentiles([latency for _, _, own in outcomes for latency in own])
+            ))
+            _bench_cleanup(bind)
+    bind.dispose()
+    return results
+
+
+if __name__ == "__main__":
+    # python payouts.py [transfers]   tellers draining one queue, FOR UPDATE vs SKIP LOCKED
+    transfers = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    for row in benchmark_claims(transfers=transfers):
+        print(f"{row['tellers']:>3d} tellers  {row['mode']:12s} {row['per_second']:>8.0f} payouts/s   "
+              f"claim p50 {row['p50_ms']:6.2f} ms  p99 {row['p99_ms']:7.2f} ms   "
+              f"{row['empty_claims']:>4d} empty claims   {row['double_payouts']} double payouts")
@@ -0,0 +1,308 @@
+import logging
+import os
+import sys
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Optional, List, Dict, Any
+
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from database import engine
+from models import (
+    BranchProfits, BranchProfitRollup, BranchProfitTop, PROFIT_SOURCES, TRANSACTION_STATUSES, coded_equals
+)
+
+logger = logging.getLogger(__name__)
+
+# branch_profits is the profit ledger: completing a transaction adds its entries,
+# cancelling or rejecting it removes them. Next to it, in the same database
+# transaction, two small tables are kept current so reads never aggregate the
+# ledger: monthly totals per branch/currency/source (branch_profit_rollups) and
+# each branch's largest profits (branch_profit_top).
+
+PROFIT_TOP_N = int(os.getenv("PROFIT_TOP_N", "10"))
+# The branch's own profit; 'tax' entries record the tax taken out of it
+BRANCH_PROFIT = "benefited_amount"
+# Advisory lock class for top-N maintenance, taken per branch with the branch id
+_TOP_LOCK = 0x7072
+
+
+def month_start(value: datetime) -> date:
+    return date(value.year, value.month, 1)
+
+
+def _apply_rollups(db, entries: List[BranchProfits], sign: int):
+    totals: Dict[tuple, List] = defaultdict(lambda: [0, 0.0])
+    for entry in entries:
+        if entry.branch_id is None or entry.currency is None:
+            continue
+        key = (entry.branch_id, entry.currency, entry.source_type, month_start(entry.date or datetime.now()))
+        totals[key][0] += sign
+        totals[key][1] += sign * (entry.profit_amount or 0.0)
+    if not totals:
+        return
+    # Fixed key order, so concurrent writers lock the rollup rows in the same order
+    rows = [
+        {"branch_id": branch_id, "currency": currency, "source_type": source_type, "month": month,
+         "entries": count, "profit_sum": profit_sum}
+        for (branch_id, currency, source_type, month), (count, profit_sum) in sorted(totals.items())
+    ]
+    stmt = insert(BranchProfitRollup).values(rows)
+    current = BranchProfitRollup.__table__.c
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["branch_id", "currency", "source_type", "month"],
+        set_={
+            "entries": current.entries + stmt.excluded.entries,
+            "profit_sum": current.profit_sum + stmt.excluded.profit_sum,
+        }
+    ))
+    if sign < 0:
+        db.query(BranchProfitRollup).filter(
+            BranchProfitRollup.branch_id.in_({row["branch_id"] for row in rows}),
+            BranchProfitRollup.entries <= 0
+        ).delete(synchronize_session=False)
+
+
+def _lock_top(db, branch_id: int):
+    db.execute(select(func.pg_advisory_xact_lock(_TOP_LOCK, branch_id)))
+
+
+def _trim_top(db, branch_id: int):
+    keep = select(BranchProfitTop.transaction_id).where(
+        BranchProfitTop.branch_id == branch_id
+    ).order_by(BranchProfitTop.profit_amount.desc(), BranchProfitTop.transaction_id).limit(PROFIT_TOP_N)
+    db.query(BranchProfitTop).filter(
+        BranchProfitTop.branch_id == branch_id,
+        BranchProfitTop.transaction_id.notin_(keep)
+    ).delete(synchronize_session=False)
+
+
+def _refill_top(db, branch_id: int):
+    """Top the branch back up to PROFIT_TOP_N from the ledger after an entry left it"""
+    candidates = select(
+        BranchProfits.branch_id, BranchProfits.transaction_id, BranchProfits.profit_amount,
+        BranchProfits.currency, BranchProfits.date
+    ).where(
+        BranchProfits.branch_id == branch_id,
+        BranchProfits.source_type == BRANCH_PROFIT
+    ).order_by(BranchProfits.profit_amount.desc(), BranchProfits.transaction_id).limit(PROFIT_TOP_N)
+    db.execute(insert(BranchProfitTop).from_select(
+        ["branch_id", "transaction_id", "profit_amount", "currency", "date"], candidates
+    ).on_conflict_do_nothing())
+    _trim_top(db, branch_id)
+
+
+def record_profits(db, entries: List[BranchProfits]):
+    """Update rollups and top-N for ledger entries added in the caller's transaction"""
+    entries = [entry for entry in entries if entry is not None]
+    _apply_rollups(db, entries, 1)
+    by_branch: Dict[int, List[BranchProfits]] = defaultdict(list)
+    for entry in entries:
+        if entry.branch_id is not None and entry.source_type == BRANCH_PROFIT:
+            by_branch[entry.branch_id].append(entry)
+    # Branches in id order, so concurrent writers take the advisory locks in the same order
+    for branch_id in sorted(by_branch):
+        _lock_top(db, branch_id)
+        db.execute(insert(BranchProfitTop).values([
+            {"branch_id": branch_id, "transaction_id": entry.transaction_id,
+             "profit_amount": entry.profit_amount or 0.0, "currency": entry.currency, "date": entry.date}
+            for entry in by_branch[branch_id]
+        ]).on_conflict_do_nothing())
+        _trim_top(db, branch_id)
+
+
+def remove_profits(db, transaction_ids: List[str]) -> int:
+    """Delete the ledger entries of transactions and take them out of rollups and top-N.
+
+    One DELETE for all of them; runs in the caller's transaction and returns
+    the number of entries removed.
+    """
+    if not transaction_ids:
+        return 0
+    entries = db.execute(
+        BranchProfits.__table__.delete().where(
+            BranchProfits.transaction_id.in_(transaction_ids)
+        ).returning(
+            BranchProfits.branch_id, BranchProfits.currency, BranchProfits.source_type,
+            BranchProfits.date, BranchProfits.profit_amount
+        )
+    ).all()
+    if not entries:
+        return 0
+    _apply_rollups(db, entries, -1)
+    for branch_id in sorted({entry.branch_id for entry in entries if entry.branch_id is not None}):
+        _lock_top(db, branch_id)
+        removed = db.query(BranchProfitTop).filter(
+            BranchProfitTop.branch_id == branch_id,
+            BranchProfitTop.transaction_id.in_(transaction_ids)
+        ).delete(synchronize_session=False)
+        if removed:
+            _refill_top(db, branch_id)
+    return len(entries)
+
+
+def remove_transaction_profits(db, transaction_id: str) -> int:
+    """remove_profits for a single transaction"""
+    return remove_profits(db, [transaction_id])
+
+
+def ledger_filters(
+    branch_id: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    currency: Optional[str] = None,
+    source_type: Optional[str] = BRANCH_PROFIT
+) -> list:
+    """Predicates over branch_profits answered by idx_branch_profits_ledger; end is exclusive.
+
+    source_type=None selects the tax entries as well.
+    """
+    predicates = [BranchProfits.branch_id == branch_id]
+    if source_type:
+        predicates.append(BranchProfits.source_type == source_type)
+    if start:
+        predicates.append(BranchProfits.date >= start)
+    if end:
+        predicates.append(BranchProfits.date < end)
+    if currency:
+        predicates.append(coded_equals(BranchProfits.currency, currency))
+    return predicates
+
+
+def rollup_totals(db, branch_id: int, since: Optional[date] = None) -> Dict[str, Dict[str, Any]]:
+    """{currency: {"entries", "profit_sum"}} of the branch's own profit, from the rollups"""
+    query = db.query(
+        BranchProfitRollup.currency,
+        func.sum(BranchProfitRollup.entries),
+        func.sum(BranchProfitRollup.profit_sum)
+    ).filter(
+        BranchProfitRollup.branch_id == branch_id,
+        BranchProfitRollup.source_type == BRANCH_PROFIT
+    )
+    if since:
+        query = query.filter(BranchProfitRollup.month >= month_start(since))
+    return {
+        currency: {"entries": int(entries or 0), "profit_sum": float(profit_sum or 0.0)}
+        for currency, entries, profit_sum in query.group_by(BranchProfitRollup.currency).all()
+    }
+
+
+def top_profits(db, branch_id: int, limit: int = PROFIT_TOP_N) -> List[BranchProfitTop]:
+    return db.query(BranchProfitTop).filter(
+        BranchProfitTop.branch_id == branch_id
+    ).order_by(BranchProfitTop.profit_amount.desc(), BranchProfitTop.transaction_id).limit(limit).all()
+
+
+def _rebuild_sql() -> Dict[str, str]:
+    completed = TRANSACTION_STATUSES["completed"]
+    benefited, tax = PROFIT_SOURCES["benefited_amount"], PROFIT_SOURCES["tax"]
+    return {
+        # The entries record_branch_profit writes, for completed transactions that have none
+        "backfill": f"""
+            INSERT INTO branch_profits (branch_id, transaction_id, profit_amount, currency, source_type, date)
+            SELECT t.branch_id, t.id, e.amount, t.currency, e.source_type, t.date
+            FROM transactions t
+            CROSS JOIN LATERAL (VALUES
+                ({benefited}, t.benefited_amount - t.benefited_amount * (t.tax_rate / 100)),
+                ({tax}, t.benefited_amount * (t.tax_rate / 100))
+            ) e(source_type, amount)
+            WHERE t.status = {completed} AND t.benefited_amount > 0 AND e.amount > 0
+              AND NOT EXISTS (SELECT 1 FROM branch_profits p WHERE p.transaction_id = t.id)
+        """,
+        "rollups": """
+            INSERT INTO branch_profit_rollups (branch_id, currency, source_type, month, entries, profit_sum)
+            SELECT branch_id, currency, source_type, date_trunc('month', date)::date, count(*), sum(profit_amount::float8)
+            FROM branch_profits
+            WHERE branch_id IS NOT NULL AND currency IS NOT NULL
+            GROUP BY 1, 2, 3, 4
+        """,
+        "top": f"""
+            INSERT INTO branch_profit_top (branch_id, transaction_id, profit_amount, currency, date)
+            SELECT branch_id, transaction_id, profit_amount, currency, date
+            FROM (
+                SELECT p.*, row_number() OVER (
+                    PARTITION BY branch_id ORDER BY profit_amount DESC, transaction_id
+                ) AS rank
+                FROM branch_profits p
+                WHERE branch_id IS NOT NULL AND source_type = {benefited}
+            ) ranked
+            WHERE rank <= {PROFIT_TOP_N}
+            ON CONFLICT DO NOTHING
+        """,
+    }
+
+
+def rebuild_profit_ledger(bind=engine, backfill: bool = True) -> Dict[str, int]:
+    """Recompute rollups and top-N from branch_profits (initial backfill or repair).
+
+    With backfill, completed transactions without ledger entries get them
+    first; pickups completed transactions without recording profits before the
+    ledger became the read path.
+    """
+    statements = _rebuild_sql()
+    counts = {}
+    with bind.begin() as conn:
+        # Writers touch the ledger before the rollups, so holding the ledger keeps them out
+        conn.execute(text("LOCK TABLE branch_profits IN SHARE ROW EXCLUSIVE MODE"))
+        counts["backfilled"] = conn.execute(text(statements["backfill"])).rowcount if backfill else 0
+        conn.execute(text("TRUNCATE branch_profit_rollups, branch_profit_top"))
+        counts["rollups"] = conn.execute(text(statements["rollups"])).rowcount
+        counts["top"] = conn.execute(text(statements["top"])).rowcount
+    logger.info(f"Rebuilt profit rollups: {counts}")
+    return counts
+
+
+def check_profit_ledger(bind=engine) -> List[str]:
+    """Differences between the maintained rollups/top-N and a fresh aggregate of the ledger"""
+    benefited = PROFIT_SOURCES["benefited_amount"]
+    problems = []
+    with bind.connect() as conn:
+        drift = conn.execute(text("""
+            SELECT COALESCE(l.branch_id, r.branch_id), COALESCE(l.currency, r.currency),
+                   COALESCE(l.source_type, r.source_type), COALESCE(l.month, r.month),
+                   l.entries, r.entries, l.profit_sum, r.profit_sum
+            FROM (
+                SELECT branch_id, currency, source_type, date_trunc('month', date)::date AS month,
+                       count(*) AS entries, sum(profit_amount::float8) AS profit_sum
+                FROM branch_profits WHERE branch_id IS NOT NULL AND currency IS NOT NULL
+                GROUP BY 1, 2, 3, 4
+            ) l
+            FULL JOIN branch_profit_rollups r USING (branch_id, currency, source_type, month)
+            WHERE l.entries IS DISTINCT FROM r.entries
+               OR abs(COALESCE(l.profit_sum, 0) - COALESCE(r.profit_sum, 0)) > 0.01
+        """)).all()
+        problems.extend(f"rollup {row[:4]}: ledger {row[4]}/{row[6]} rollup {row[5]}/{row[7]}" for row in drift)
+        top_drift = conn.execute(text(f"""
+            WITH ledger AS (
+                SELECT branch_id, array_agg(transaction_id ORDER BY profit_amount DESC, transaction_id) AS ids
+                FROM (
+                    SELECT branch_id, transaction_id, profit_amount, row_number() OVER (
+                        PARTITION BY branch_id ORDER BY profit_amount DESC, transaction_id
+                    ) AS rank
+                    FROM branch_profits WHERE branch_id IS NOT NULL AND source_type = {benefited}
+                ) ranked
+                WHERE rank <= {PROFIT_TOP_N}
+                GROUP BY branch_id
+            ), top AS (
+                SELECT branch_id, array_agg(transaction_id ORDER BY profit_amount DESC, transaction_id) AS ids
+                FROM branch_profit_top GROUP BY branch_id
+            )
+            SELECT branch_id, NULL FROM ledger FULL JOIN top USING (branch_id)
+            WHERE ledger.ids IS DISTINCT FROM top.ids
+        """)).all()
+        problems.extend(f"top-{PROFIT_TOP_N} of branch {branch_id} differs" for branch_id, _ in top_drift)
+    return problems
+
+
+if __name__ == "__main__":
+    # python profits.py rebuild | check
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "check"
+    if command == "rebuild":
+        print(rebuild_profit_ledger())
+    problems = check_profit_ledger()
+    for problem in problems:
+        print(problem)
+    assert not problems, f"{len(problems)} rollup/top-N rows differ from the ledger"
+    print("profit rollups and top-N match the ledger")
@@ -0,0 +1,396 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, date, timedelta
+from typing import Optional, Dict, Any, List, Tuple
+
+from sqlalchemy import func
+
+from branch_directory import branch_directory
+from cache import cache
+from database import ReaderSessionLocal, reader_engine
+from models import Transaction
+
+logger = logging.getLogger(__name__)
+
+REPORT_TYPES = ("daily", "branch", "currency", "tax_summary", "daily_summary")
+
+REPORT_JOB_WORKERS = int(os.getenv("REPORT_JOB_WORKERS", "2"))
+REPORT_ARTIFACT_DIR = os.getenv(
+    "REPORT_ARTIFACT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "report_artifacts")
+)
+# Reports whose range reaches today can still change; reuse them only briefly
+OPEN_RANGE_TTL = int(os.getenv("REPORT_OPEN_RANGE_TTL", "300"))
+JOB_STATUS_TTL = 7 * 24 * 3600
+JOB_STALE_AFTER = int(os.getenv("REPORT_JOB_STALE_AFTER", "900"))
+
+
+# ---------------------------------------------------------------------------
+# Partition work (runs inside the process pool)
+# ---------------------------------------------------------------------------
+
+def _init_pool_worker():
+    # Never reuse connections inherited from the parent process
+    reader_engine.dispose(close=False)
+
+
+def _scoped_query(query, report_type: str, filters: Dict[str, Any]):
+    branch_id = filters.get("branch_id")
+    if branch_id:
+        if report_type == "tax_summary":
+            query = query.filter(
+                (Transaction.branch_id == branch_id) | (Transaction.destination_branch_id == branch_id)
+            )
+        else:
+            query = query.filter(Transaction.branch_id == branch_id)
+    return query
+
+
+def compute_partition(report_type: str, start_iso: str, end_iso: str, filters: Dict[str, Any]) -> Dict[str, Any]:
+    """Aggregate one month of transactions into a partial result"""
+    start = datetime.fromisoformat(start_iso)
+    end = datetime.fromisoformat(end_iso)
+    db = ReaderSessionLocal()
+    try:
+        in_range = [Transaction.date >= start, Transaction.date < end]
+        if report_type in ("daily", "branch", "currency"):
+            key = {
+                "daily": func.to_char(Transaction.date, "YYYY-MM-DD"),
+                "branch": Transaction.branch_id,
+                "currency": Transaction.currency,
+            }[report_type]
+            query = db.query(
+                key.label("key"),
+                Transaction.currency,
+                func.coalesce(func.sum(Transaction.amount), 0.0),
+                func.count(Transaction.id)
+            ).filter(*in_range)
+            query = _scoped_query(query, report_type, filters)
+            rows = query.group_by(key, Transaction.currency).all()
+            return {"rows": [[k, currency, float(total), count] for k, currency, total, count in rows]}
+
+        if report_type == "daily_summary":
+            query = db.query(
+                Transaction.status,
+                func.count(Transaction.id),
+                func.coalesce(func.sum(Transaction.amount), 0.0),
+                func.coalesce(func.sum(Transaction.tax_amount), 0.0)
+            ).filter(*in_range)
+            query = _scoped_query(query, report_type, filters)
+            rows = query.group_by(Transaction.status).all()
+            return {"rows": [[s, count, float(amount), float(tax)] for s, count, amount, tax in rows]}
+
+        if report_type == "tax_summary":
+            query = db.query(
+                Transaction.id,
+                Transaction.date,
+                Transaction.amount,
+                Transaction.benefited_amount,
+                Transaction.tax_rate,
+                Transaction.tax_amount,
+                Transaction.currency,
+                Transaction.branch_id,
+                Transaction.destination_branch_id,
+                Transaction.status
+            ).filter(*in_range, Transaction.status == "completed")
+            query = _scoped_query(query, report_type, filters)
+            rows = query.order_by(Transaction.date).all()
+            return {"rows": [
+                [r.id, r.date.isoformat(), r.amount, r.benefited_amount, r.tax_rate, r.tax_amount,
+                 r.currency, r.branch_id, r.destination_branch_id, r.status]
+                for r in rows
+            ]}
+
+        raise ValueError(f"Unknown report type: {report_type}")
+    finally:
+        db.close()
+
+
+def month_partitions(start: datetime, end: datetime) -> List[Tuple[datetime, datetime]]:
+    """Split [start, end) into calendar-month ranges"""
+    partitions = []
+    cursor = start
+    while cursor < end:
+        next_month = (cursor.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        partitions.append((cursor, min(next_month, end)))
+        cursor = next_month
+    return partitions
+
+
+# ---------------------------------------------------------------------------
+# Merging partial results into the same shapes the synchronous endpoints return
+# ---------------------------------------------------------------------------
+
+def _merge_grouped(report_type: str, partials: List[Dict[str, Any]]) -> Dict[str, Any]:
+    if report_type == "currency":
+        data: Dict[Any, Dict[str, Any]] = {
+            "SYP": {"total": 0, "count": 0},
+            "USD": {"total": 0, "count": 0}
+        }
+        for partial in partials:
+            for key, _, total, count in partial["rows"]:
+                bucket = data.setdefault(key, {"total": 0, "count": 0})
+                bucket["total"] += total
+                bucket["count"] += count
+        return {"currency_report": data}
+
+    data = {}
+    for partial in partials:
+        for key, currency, total, count in partial["rows"]:
+            bucket = data.setdefault(key, {"total_syp": 0, "total_usd": 0, "count": 0})
+            if currency == "SYP":
+                bucket["total_syp"] += total
+            else:
+                bucket["total_usd"] += total
+            bucket["count"] += count
+    return {"daily_report": data} if report_type == "daily" else {"branch_report": data}
+
+
+def _merge_daily_summary(partials: List[Dict[str, Any]]) -> Dict[str, Any]:
+    counts: Dict[str, int] = {}
+    total_count = 0
+    total_amount = 0.0
+    total_tax = 0.0
+    for partial in partials:
+        for status, count, amount, tax in partial["rows"]:
+            counts[status] = counts.get(status, 0) + count
+            total_count += count
+            total_amount += amount
+            total_tax += tax
+    return {
+        "summary": {
+            "total_count": total_count,
+            "total_amount": total_amount,
+            "total_tax": total_tax,
+            "completed_count": counts.get("completed", 0),
+            "processing_count": counts.get("processing", 0),
+            "cancelled_count": counts.get("cancelled", 0),
+            "rejected_count": counts.get("rejected", 0),
+            "pending_count": counts.get("pending", 0)
+        }
+    }
+
+
+def _merge_tax_summary(params: Dict[str, Any], partials: List[Dict[str, Any]]) -> Dict[str, Any]:
+    total_amount = 0.0
+    total_benefited_amount = 0.0
+    total_tax_amount = 0.0
+    total_profit = 0.0
+    total_transactions = 0
+    branch_summary_dict: Dict[Any, Dict[str, Any]] = {}
+    tx_list = []
+    for partial in partials:
+        for (tx_id, tx_date, amount, benefited, tax_rate, tax_amount,
+             currency, b_id, dest_id, status) in partial["rows"]:
+            total_transactions += 1
+            total_amount += amount or 0
+            total_benefited_amount += benefited or 0
+            total_tax_amount += tax_amount or 0
+            # الربح: إذا كان الفرع هو المدير (id==0) الربح = benefited_amount
+            profit = (benefited or 0) if b_id == 0 else (benefited or 0) - (tax_amount or 0)
+            total_profit += profit
+            if b_id not in branch_summary_dict:
+                branch = branch_directory.get(b_id)
+                branch_summary_dict[b_id] = {
+                    "branch_id": b_id,
+                    "branch_name": branch.name if branch else str(b_id),
+                    "tax_rate": branch.tax_rate if branch else 0,
+                    "transaction_count": 0,
+                    "total_amount": 0.0,
+                    "benefited_amount": 0.0,
+                    "tax_amount": 0.0,
+                    "profit": 0.0,
+                    "currency": currency or "SYP"
+                }
+            summary = branch_summary_dict[b_id]
+            summary["transaction_count"] += 1
+            summary["total_amount"] += amount or 0
+            summary["benefited_amount"] += benefited or 0
+            summary["tax_amount"] += tax_amount or 0
+            summary["currency"] = currency or "SYP"
+            summary["profit"] += profit
+            tx_list.append({
+                "id": tx_id,
+                "date": tx_date[:10],
+                "amount": amount,
+                "benefited_amount": benefited,
+                "tax_rate": tax_rate,
+                "tax_amount": tax_amount,
+                "currency": currency,
+                "source_branch": branch_directory.name(b_id, str(b_id)),
+                "destination_branch": branch_directory.name(dest_id, str(dest_id)),
+                "status": status,
+                "profit": profit
+            })
+    return {
+        "start_date": params["start_date"],
+        "end_date": params["end_date"],
+        "total_amount": total_amount,
+        "total_benefited_amount": total_benefited_amount,
+        "total_tax_amount": total_tax_amount,
+        "total_transactions": total_transactions,
+        "total_profit": total_profit,
+        "branch_summary": list(branch_summary_dict.values()),
+        "transactions": tx_list
+    }
+
+
+def merge_partials(params: Dict[str, Any], partials: List[Dict[str, Any]]) -> Dict[str, Any]:
+    report_type = params["report_type"]
+    if report_type in ("daily", "branch", "currency"):
+        return _merge_grouped(report_type, partials)
+    if report_type == "daily_summary":
+        return _merge_daily_summary(partials)
+    return _merge_tax_summary(params, partials)
+
+
+# ---------------------------------------------------------------------------
+# Job bookkeeping
+# ---------------------------------------------------------------------------
+
+def job_id_for(params: Dict[str, Any]) -> str:
+    """Identical parameters (including the caller's scope) map to the same job and artifact"""
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+def is_closed_range(params: Dict[str, Any]) -> bool:
+    return datetime.strptime(params["end_date"], "%Y-%m-%d").date() < date.today()
+
+
+def artifact_path(job_id: str) -> str:
+    return os.path.join(REPORT_ARTIFACT_DIR, f"{job_id}.json")
+
+
+def params_path(job_id: str) -> str:
+    """The job's parameters, kept with its artifact so access checks outlive the status record"""
+    return os.path.join(REPORT_ARTIFACT_DIR, f"{job_id}.params.json")
+
+
+def _write_json(path: str, data: Any):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _read_params(job_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(params_path(job_id), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class ReportJobManager:
+    """Runs report jobs on a bounded process pool and tracks their status.
+
+    Status records live in Redis so any worker can answer a poll (with a local
+    fallback), and results are written as JSON artifacts on disk keyed by the
+    job id, which is a hash of the request parameters.
+    """
+
+    def __init__(self, max_workers: int = REPORT_JOB_WORKERS):
+        self._max_workers = max_workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+        # Merging and writing artifacts happens off the request path as well
+        self._coordinators = ThreadPoolExecutor(max_workers=max(2, max_workers), thread_name_prefix="report-job")
+        self._lock = threading.Lock()
+        self._local_status: Dict[str, Dict[str, Any]] = {}
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self._max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_pool_worker
+                )
+            return self._pool
+
+    def _set_status(self, job_id: str, record: Dict[str, Any]):
+        self._local_status[job_id] = record
+        cache.set(f"report_job:{job_id}", record, expire=JOB_STATUS_TTL)
+
+    def get_status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        record = cache.get(f"report_job:{job_id}") or self._local_status.get(job_id)
+        if record is None and os.path.exists(artifact_path(job_id)):
+            # Status expired but the artifact is still on disk
+            record = {"job_id": job_id, "status": "done", "params": _read_params(job_id)}
+        return record
+
+    def _artifact_is_fresh(self, job_id: str, params: Dict[str, Any]) -> bool:
+        path = artifact_path(job_id)
+        if not os.path.exists(path):
+            return False
+        if is_closed_range(params):
+            return True
+        return time.time() - os.path.getmtime(path) < OPEN_RANGE_TTL
+
+    def submit(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        job_id = job_id_for(params)
+        if self._artifact_is_fresh(job_id, params):
+            record = self.get_status(job_id) or {}
+            if record.get("status") != "done" or record.get("params") is None:
+                if not os.path.exists(params_path(job_id)):
+                    _write_json(params_path(job_id), params)
+                record = {"job_id": job_id, "status": "done", "params": params,
+                          "finished_at": datetime.fromtimestamp(os.path.getmtime(artifact_path(job_id))).isoformat()}
+                self._set_status(job_id, record)
+            return record
+
+        existing = self.get_status(job_id)
+        if existing and existing.get("status") in ("queued", "running"):
+            submitted_at = datetime.fromisoformat(existing.get("submitted_at") or datetime.now().isoformat())
+            # A job whose worker died would otherwise stay "running" forever
+            if datetime.now() - submitted_at < timedelta(seconds=JOB_STALE_AFTER):
+                return existing
+
+        start = datetime.strptime(params["start_date"], "%Y-%m-%d")
+        end = datetime.strptime(params["end_date"], "%Y-%m-%d") + timedelta(days=1)
+        partitions = month_partitions(start, end)
+        record = {
+            "job_id": job_id,
+            "status": "queued",
+            "params": params,
+            "partitions": len(partitions),
+            "submitted_at": datetime.now().isoformat()
+        }
+        self._set_status(job_id, record)
+
+        pool = self._get_pool()
+        filters = {"branch_id": params.get("branch_id")}
+        futures = [
+            pool.submit(compute_partition, params["report_type"], p_start.isoformat(), p_end.isoformat(), filters)
+            for p_start, p_end in partitions
+        ]
+        self._coordinators.submit(self._finish, job_id, params, futures)
+        return record
+
+    def _finish(self, job_id: str, params: Dict[str, Any], futures):
+        record = dict(self.get_status(job_id) or {"job_id": job_id, "params": params})
+        record["status"] = "running"
+        self._set_status(job_id, record)
+        try:
+            partials = [future.result() for future in futures]
+            result = merge_partials(params, partials)
+            # Parameters first: an artifact on disk always has them next to it
+            _write_json(params_path(job_id), params)
+            _write_json(artifact_path(job_id), result)
+            record.update(status="done", finished_at=datetime.now().isoformat())
+            logger.info(f"Report job {job_id} finished ({params['report_type']}, {len(futures)} partitions)")
+        except Exception as e:
+            logger.error(f"Report job {job_id} failed: {str(e)}")
+            record.update(status="failed", error=str(e), finished_at=datetime.now().isoformat())
+        self._set_status(job_id, record)
+
+
+# Create a global report job manager for this worker
+report_jobs = ReportJobManager()
@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import sys
+import time
+from datetime import date, datetime, time as dt_time
+from decimal import Decimal
+from typing import Any, Callable, Iterable, List, Sequence
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # the standard encoder below is the fallback
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# The app's JSON pipeline. Every response goes through FastJSONResponse, which
+# encodes with orjson (about ten times faster than json.dumps, and it writes
+# datetimes, UUIDs and numpy scalars itself). The list endpoints go further:
+# they select plain columns instead of ORM entities, turn the rows into dicts
+# with a row_mapper and return a FastJSONResponse directly, which skips
+# FastAPI's jsonable_encoder walk over every value. Bodies of at least
+# RESPONSE_GZIP_MIN_SIZE bytes are gzipped for clients that accept it.
+
+RESPONSE_GZIP_MIN_SIZE = int(os.getenv("RESPONSE_GZIP_MIN_SIZE", "1024"))
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "5"))
+
+
+def _default(value: Any) -> Any:
+    """Types neither encoder writes natively; the same output jsonable_encoder gave"""
+    if isinstance(value, (datetime, date, dt_time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(content: Any) -> bytes:
+        return orjson.dumps(content, default=_default, option=_OPTIONS)
+else:
+    def dumps(content: Any) -> bytes:
+        return json.dumps(
+            content, ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_default
+        ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse encoded with orjson; the app's default response class"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def row_mapper(columns: Sequence[str], **formatters: Callable[[Any], Any]) -> Callable[[Iterable[Sequence[Any]]], List[dict]]:
+    """Turn result rows into dicts keyed by `columns`, in order.
+
+    Rows are read positionally, so the query must select its columns in the
+    same order; extra trailing columns are ignored. A formatter rewrites one
+    column's non-null values (e.g. a datetime shown without its microseconds).
+    """
+    columns = tuple(columns)
+    if not formatters:
+        return lambda rows: [dict(zip(columns, row)) for row in rows]
+    unknown = set(formatters) - set(columns)
+    if unknown:
+        raise ValueError(f"Formatters for unknown columns: {sorted(unknown)}")
+
+    def to_dicts(rows):
+        items = []
+        for row in rows:
+            item = dict(zip(columns, row))
+            for name, formatter in formatters.items():
+                if item[name] is not None:
+                    item[name] = formatter(item[name])
+            items.append(item)
+        return items
+
+    return to_dicts
+
+
+def format_timestamp(value: datetime) -> str:
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def benchmark_serialization(rows: int = 1000, repeats: int = 20) -> List[dict]:
+    """Milliseconds to turn `rows` /transactions/ results into a response body.
+
+    "entities" is the old path: a dict built by hand from each ORM object, then
+    jsonable_encoder and json.dumps. "rows" is the new one: row_mapper over
+    plain result tuples, then one orjson call. Rows are synthetic transient
+    entities and tuples, so only serialisation is measured, not the query.
+    """
+    from fastapi.encoders import jsonable_encoder
+    from models import Transaction, TransactionDetails
+    from ids import uuid7
+    import server_improved
+
+    fields = list(server_improved.TRANSACTION_LIST_FIELDS)
+    now = datetime.now()
+    values = [{
+        "id": uuid7(), "sender": f"sender {i}", "sender_mobile": "0991234567", "sender_governorate": "Damascus",
+        "receiver": f"receiver {i}", "receiver_mobile": "0997654321", "receiver_governorate": "Aleppo",
+        "amount": 1000.0 + i, "base_amount": 990.0 + i, "benefited_amount": 10.0, "tax_rate": 1.5,
+        "tax_amount": 0.15, "currency": "SYP", "message": "", "employee_name": "employee",
+        "branch_governorate": "Damascus", "branch_id": 2, "destination_branch_id": 3, "employee_id": 4,
+        "status": "processing", "date": now, "is_received": False,
+        "sending_branch_name": "Branch 2", "destination_branch_name": "Branch 3",
+    } for i in range(rows)]
+    detail_names = set(server_improved.TRANSACTION_DETAIL_FIELDS)
+    entities = []
+    for value in values:
+        transaction = Transaction(**{name: value[name] for name in fields
+                                     if name not in detail_names and not name.endswith("_branch_name")})
+        transaction.details = TransactionDetails(**{name: value[name] for name in detail_names})
+        entities.append((transaction, value["sending_branch_name"], value["destination_branch_name"]))
+    tuples = [tuple(value[name] for name in fields) for value in values]
+    to_dicts = row_mapper(fields)
+
+    def from_entities():
+        items = [{name: getattr(transaction, name) for name in fields if not name.endswith("_branch_name")}
+                 | {"sending_branch_name": sending, "destination_branch_name": destination}
+                 for transaction, sending, destination in entities]
+        content = jsonable_encoder({"items": items, "total": rows})
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+    def from_rows():
+        return dumps({"items": to_dicts(tuples), "total": rows})
+
+    results = []
+    for label, build in (("entities + jsonable_encoder + json", from_entities), ("rows + row_mapper + orjson", from_rows)):
+        body = build()
+        started = time.perf_counter()
+        for _ in range(repeats):
+            build()
+        elapsed = (time.perf_counter() - started) / repeats
+        results.append(dict(path=label, ms_per_1000=elapsed * 1000 * 1000 / rows, bytes=len(body)))
+    return results
+
+
+if __name__ == "__main__":
+    # python serialization.py [rows] [repeats]   response serialisation cost, old vs new path
+    logging.disable(logging.INFO)
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    if orjson is None:
+        print("orjson is not installed; the new path falls back to json.dumps")
+    for row in benchmark_serialization(rows, repeats):
+        print(f"{row['path']:36s} {row['ms_per_1000']:8.2f} ms/1000 rows  {row['bytes']:9d} bytes")
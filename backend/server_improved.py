@@ -1,5 +1,8 @@
 import logging
 from logging.handlers import RotatingFileHandler
+import csv
+import itertools
+import json
 import os
 import time
 
@@ -17,27 +20,54 @@ if not root_logger.hasHandlers():
 
 logger = logging.getLogger(__name__)
 
-from fastapi import FastAPI, HTTPException, Depends, status, Request
-from sqlalchemy import create_engine, func, and_, or_, desc
-from sqlalchemy.orm import sessionmaker, Session, joinedload, aliased
-from models import User, Branch, Base, BranchFund, Notification, Transaction, BranchProfits
+from fastapi import FastAPI, HTTPException, Depends, Header, status, Request, Response, Query
+from sqlalchemy import create_engine, func, and_, or_, desc, cast, Float, Date, case, select
+from sqlalchemy.orm import sessionmaker, Session, joinedload, selectinload, aliased
+from models import User, Branch, Base, BranchFund, Notification, Transaction, BranchProfits, TransactionDetails, Customer
+from models import CurrencyType, TransactionStatusType, UserRoleType, coded_equals
 from pydantic import BaseModel, field_validator, ValidationError
-import uuid
 from datetime import datetime, timedelta
 from security import hash_password, verify_password, create_jwt_token, SECRET_KEY, ALGORITHM
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from typing import Optional, List, Dict, Any
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware, DEFAULT_EXCLUDED_CONTENT_TYPES
 import sqlalchemy.exc
 from functools import lru_cache
+from collections import defaultdict
 import logging
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 import shutil
 from fastapi import UploadFile, File
 import os
 from starlette.background import BackgroundTask
 from cache import cache, cache_result, get_branch_cache_key, get_transaction_cache_key, get_branch_transactions_cache_key
+from branch_directory import branch_directory
+from exports import streaming_export, EXPORT_FORMATS, EXPORT_BATCH_SIZE
+from serialization import FastJSONResponse, row_mapper, format_timestamp, RESPONSE_GZIP_MIN_SIZE, RESPONSE_GZIP_LEVEL
+from report_jobs import report_jobs, REPORT_TYPES, artifact_path, merge_partials
+from analytics import analytics_snapshot, snapshot_exporter
+from database import ReaderSessionLocal
+from partitions import ensure_partitions, is_partitioned, start_partition_maintenance
+from indexes import index_usage_report
+from filters import compile_transaction_filters
+from ids import uuid7, normalize_transaction_id
+from group_commit import GroupCommitWriter, transfer_statement, write_transfers
+from transitions import compare_and_set, STATUS_UPDATE_RETRIES
+from idempotency import (
+    idempotency_store, IdempotencyKeyTaken, IDEMPOTENCY_HEADER, check_key, is_key_conflict, replay, request_fingerprint
+)
+from payouts import payout_queue, waiting_filters, claim_next, claim_transaction, release_claim, claimed_by_other, unclaimed
+from notifications import notification_dispatcher, notification_feed
+from events import event, event_broker, EVENT_TOPICS
+from versions import resource_versions, conditional_get, branch_version, transactions_changed
+from profits import record_profits, remove_profits, remove_transaction_profits, ledger_filters, rollup_totals, top_profits
+from customers import (
+    customer_row, upsert_customers, customer_dict,
+    search_filters as customer_search_filters, autocomplete_filter as customer_autocomplete_filter
+)
 from fastapi.requests import Request
 from fastapi.exception_handlers import RequestValidationError
 from fastapi.exceptions import RequestValidationError as FastAPIRequestValidationError
@@ -45,7 +75,7 @@ from starlette.exceptions import HTTPException as StarletteHTTPException
 import traceback
 from fastapi import APIRouter
 
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -55,6 +85,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Exports gzip themselves (and set Content-Encoding, which this skips); XLSX is already deflated
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=RESPONSE_GZIP_MIN_SIZE,
+    compresslevel=RESPONSE_GZIP_LEVEL,
+    exclude_content_types=DEFAULT_EXCLUDED_CONTENT_TYPES + (EXPORT_FORMATS["xlsx"], "application/octet-stream"),
+)
+
 # Get database URL from environment variable with fallback
 DATABASE_URL = os.getenv(
     "DATABASE_URL",
@@ -78,6 +116,19 @@ SessionLocal = sessionmaker(autoflush=False, bind=engine)
 # Create the database tables if they don't exist
 Base.metadata.create_all(bind=engine)
 
+# A freshly created transactions table has no partitions yet; make sure the
+# current and upcoming months exist before the first insert.
+with engine.connect() as connection:
+    transactions_partitioned = is_partitioned(connection)
+if transactions_partitioned:
+    ensure_partitions(engine)
+else:
+    logger.warning("transactions is not partitioned; run 'python partitions.py migrate' to convert it")
+
+
+# Opt-in (GROUP_COMMIT_WINDOW_MS): concurrent transfers share one commit
+transaction_writer = GroupCommitWriter(engine)
+
 
 def get_db():
     db = SessionLocal()
@@ -87,6 +138,15 @@ def get_db():
         db.close()
 
 
+@app.on_event("startup")
+def start_background_workers():
+    start_partition_maintenance(engine)
+    if snapshot_exporter.start():
+        logger.info("Analytics snapshot exporter started")
+    if notification_dispatcher.start():
+        logger.info("Notification dispatcher started")
+
+
 # Data models
 class TransactionSchema(BaseModel):
     sender: Optional[str] = None
@@ -139,10 +199,12 @@ class TransactionSchema(BaseModel):
 
     @field_validator('currency')
     def currency_valid(cls, v):
-        allowed = ["SYP", "USD", "ليرة سورية"]
-        if v not in allowed:
+        # 'ليرة سورية' and 'SYP' are the same currency; store one spelling
+        currency = CurrencyType.normalize(v)
+        if currency is None:
+            allowed = ["SYP", "USD", "ليرة سورية"]
             raise ValueError(f"العملة غير مدعومة. استخدم: {', '.join(allowed)}")
-        return v
+        return currency
 
 class TransactionReceived(BaseModel):
     transaction_id: str
@@ -157,6 +219,15 @@ class TransactionStatus(BaseModel):
     transaction_id: str
     status: str
 
+    @field_validator('status')
+    def status_valid(cls, v):
+        if TransactionStatusType.normalize(v) is None:
+            raise ValueError(f"Invalid status. Use: {', '.join(TransactionStatusType.values)}")
+        return v
+
+class TransactionStatusBulk(BaseModel):
+    updates: List[TransactionStatus]
+
 class LoginRequest(BaseModel):
     username: str
     password: str
@@ -204,6 +275,12 @@ class UserUpdate(BaseModel):
     role: Optional[str] = None
     branch_id: Optional[int] = None
 
+    @field_validator('role')
+    def role_valid(cls, v):
+        if v is not None and UserRoleType.normalize(v) is None:
+            raise ValueError(f"Invalid role. Use: {', '.join(UserRoleType.values)}")
+        return v
+
     class Config:
         from_attributes = True 
         
@@ -212,6 +289,12 @@ class UserCreate(BaseModel):
     password: str
     role: str = "employee"
     branch_id: Optional[int] = None
+
+    @field_validator('role')
+    def role_valid(cls, v):
+        if UserRoleType.normalize(v) is None:
+            raise ValueError(f"Invalid role. Use: {', '.join(UserRoleType.values)}")
+        return v
     
 class BranchCreate(BaseModel):
     branch_id: str
@@ -241,7 +324,12 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
         raise credentials_exception        
         
 
-def save_to_db(transaction: TransactionSchema, branch_id=None, employee_id=None, db: Session = None):
+def prepare_transaction_rows(transaction: TransactionSchema, branch_id=None, employee_id=None,
+                             transaction_id=None, idempotency=None) -> Dict[str, Any]:
+    """Validate a new transfer and build its transaction, notification and customer rows.
+
+    idempotency is an idempotency_keys row (IdempotencyStore.record) written with the transfer.
+    """
     # Use the date from the transaction if provided, otherwise use now
     if hasattr(transaction, 'date') and transaction.date:
         try:
@@ -250,94 +338,134 @@ def save_to_db(transaction: TransactionSchema, branch_id=None, employee_id=None,
             transaction_date = datetime.now()
     else:
         transaction_date = datetime.now()
-    transaction_id = str(uuid.uuid4())
-    
+    transaction_id = transaction_id or uuid7()
+
+    # --- Get tax_rate from sending branch (branch_id) ---
+    tax_rate = branch_directory.tax_rate(branch_id)
+    # استخدم benefited_amount كما هو من الإدخال
+    benefited_amount = transaction.benefited_amount
+    tax_amount = benefited_amount * (tax_rate / 100)
+
+    # Override values in transaction
+    transaction.tax_rate = tax_rate
+    transaction.tax_amount = tax_amount
+    transaction.benefited_amount = benefited_amount
+
+    # Whether the destination branch exists is left to the foreign key (see transfer_integrity_error)
+    if transaction.destination_branch_id is None:
+        raise HTTPException(status_code=404, detail="Destination branch not found")
+
+    # عند إنشاء سجل Transaction، إذا كان branch_id == 0 (مدير النظام) احفظ None لتجاوز قيد المفتاح الأجنبي
+    transaction_branch_id = None if branch_id == 0 else branch_id
+    notification_message = f"Hello {transaction.receiver}, you have a new money transfer of {transaction.amount} {transaction.currency} waiting. Please visit your nearest branch to collect it."
+    return {
+        "transaction": {
+            "id": transaction_id,
+            "sender": transaction.sender,
+            "sender_mobile": transaction.sender_mobile,
+            "sender_governorate": transaction.sender_governorate,
+            "receiver": transaction.receiver,
+            "receiver_mobile": transaction.receiver_mobile,
+            "receiver_governorate": transaction.receiver_governorate,
+            "amount": transaction.amount,
+            "base_amount": transaction.base_amount,
+            "benefited_amount": benefited_amount,
+            "tax_rate": tax_rate,
+            "tax_amount": tax_amount,
+            "currency": transaction.currency,
+            "message": transaction.message or "",
+            "branch_id": transaction_branch_id,
+            "destination_branch_id": transaction.destination_branch_id,
+            "employee_id": employee_id,
+            "employee_name": transaction.employee_name,
+            "branch_governorate": transaction.branch_governorate,
+            "status": "processing",
+            "is_received": False,
+            "date": transaction_date
+        },
+        "notification": {
+            "transaction_id": transaction_id,
+            "branch_id": transaction_branch_id,
+            "recipient_phone": transaction.receiver_mobile,
+            "message": notification_message,
+            "status": "pending",
+            # explicit: column defaults are not applied inside transfer_statement's CTEs.
+            # created_at is left to the database's now(): the feed pages on it
+            "attempts": 0
+        },
+        "customers": [
+            customer_row(
+                transaction.sender, transaction.sender_mobile, transaction_date,
+                governorate=transaction.sender_governorate, sent=1,
+                amount=transaction.amount, currency=transaction.currency
+            ),
+            customer_row(
+                transaction.receiver, transaction.receiver_mobile, transaction_date,
+                governorate=transaction.receiver_governorate, received=1,
+                amount=transaction.amount, currency=transaction.currency
+            ),
+        ],
+        "idempotency": idempotency
+    }
+
+def transfer_integrity_error(e: sqlalchemy.exc.IntegrityError) -> HTTPException:
+    if "destination_branch_id" in str(e.orig):
+        return HTTPException(status_code=404, detail="Destination branch not found")
+    return HTTPException(status_code=400, detail=f"Database integrity error: {str(e)}")
+
+def transfer_created_event(rows: Dict[str, Any]) -> Dict[str, Any]:
+    transaction = rows["transaction"]
+    return event(
+        "transactions", "transaction.created", [transaction["branch_id"], transaction["destination_branch_id"]],
+        transaction_id=transaction["id"], status=transaction["status"],
+        amount=transaction["amount"], currency=transaction["currency"]
+    )
+
+def save_to_db(transaction: TransactionSchema, branch_id=None, employee_id=None, transaction_id=None, idempotency=None):
+    """Write a new transfer in one database round trip.
+
+    Tax rate comes from the branch directory and the transfer is a single
+    statement (group_commit.transfer_statement) on an autocommit connection,
+    which makes it its own transaction. Dashboards hear about it as a
+    transaction.created event.
+    """
+    rows = prepare_transaction_rows(transaction, branch_id, employee_id, transaction_id, idempotency)
     try:
-        # --- Get tax_rate from sending branch (branch_id) ---
-        sending_branch = db.query(Branch).filter(Branch.id == branch_id).first()
-        if sending_branch:
-            tax_rate = sending_branch.tax_rate or 0.0
-        else:
-            tax_rate = 0.0
-        # استخدم benefited_amount كما هو من الإدخال
-        benefited_amount = transaction.benefited_amount
-        tax_amount = benefited_amount * (tax_rate / 100)
-
-        # Override values in transaction
-        transaction.tax_rate = tax_rate
-        transaction.tax_amount = tax_amount
-        transaction.benefited_amount = benefited_amount
-
-        # Verify destination branch exists (all transfers are now open without restrictions)
-        destination_branch = db.query(Branch).filter(Branch.id == transaction.destination_branch_id).first()
-        
-        if not destination_branch:
-            raise HTTPException(status_code=404, detail="Destination branch not found")
-        
-        # عند إنشاء سجل Transaction، إذا كان branch_id == 0 (مدير النظام) احفظ None لتجاوز قيد المفتاح الأجنبي
-        transaction_branch_id = None if branch_id == 0 else branch_id
-        new_transaction = Transaction(
-            id=transaction_id,
-            sender=transaction.sender,
-            sender_mobile=transaction.sender_mobile,
-            sender_governorate=transaction.sender_governorate,
-            receiver=transaction.receiver,
-            receiver_mobile=transaction.receiver_mobile,
-            receiver_governorate=transaction.receiver_governorate,
-            amount=transaction.amount,
-            base_amount=transaction.base_amount,
-            benefited_amount=benefited_amount,
-            tax_rate=tax_rate,
-            tax_amount=tax_amount,
-            currency=transaction.currency,
-            message=transaction.message or "",
-            branch_id=transaction_branch_id,
-            destination_branch_id=transaction.destination_branch_id,
-            employee_id=employee_id,
-            employee_name=transaction.employee_name,
-            branch_governorate=transaction.branch_governorate,
-            status="processing",
-            is_received=False,
-            date=transaction_date
-        )
-        db.add(new_transaction)
-        
-        # Create notification
-        notification_message = f"Hello {transaction.receiver}, you have a new money transfer of {transaction.amount} {transaction.currency} waiting. Please visit your nearest branch to collect it."
-        notification = Notification(
-            transaction_id=transaction_id,
-            recipient_phone=transaction.receiver_mobile,
-            message=notification_message,
-            status="pending"
-        )
-        db.add(notification)
-        
-        try:
-            db.commit()
-            return transaction_id
-        except sqlalchemy.exc.IntegrityError as e:
-            db.rollback()
-            raise HTTPException(
-                status_code=400,
-                detail=f"Database integrity error: {str(e)}"
-            )
-        except sqlalchemy.exc.SQLAlchemyError as e:
-            db.rollback()
-            raise HTTPException(
-                status_code=500,
-                detail=f"Database error: {str(e)}"
-            )
-        
-    except HTTPException:
-        db.rollback()
-        raise
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            transaction_id = conn.execute(transfer_statement(rows)).scalar_one()
+    except sqlalchemy.exc.IntegrityError as e:
+        if is_key_conflict(e):
+            raise IdempotencyKeyTaken()
+        raise transfer_integrity_error(e)
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
     except Exception as e:
-        db.rollback()
         print(f"Error in save_to_db: {e}")
         raise HTTPException(
             status_code=500,
             detail=f"Unexpected error: {str(e)}"
         )
+    event_broker.publish([transfer_created_event(rows)])
+    transactions_changed([rows["transaction"]["branch_id"], rows["transaction"]["destination_branch_id"]])
+    return transaction_id
+
+async def write_transaction(transaction: TransactionSchema, branch_id=None, employee_id=None,
+                            transaction_id=None, idempotency=None):
+    """save_to_db, or a share of a group commit when GROUP_COMMIT_WINDOW_MS is set"""
+    if not transaction_writer.enabled:
+        return save_to_db(transaction, branch_id, employee_id, transaction_id, idempotency)
+    rows = prepare_transaction_rows(transaction, branch_id, employee_id, transaction_id, idempotency)
+    try:
+        transaction_id = await transaction_writer.write(rows)
+    except sqlalchemy.exc.IntegrityError as e:
+        if is_key_conflict(e):
+            raise IdempotencyKeyTaken()
+        raise transfer_integrity_error(e)
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    event_broker.publish([transfer_created_event(rows)])
+    transactions_changed([rows["transaction"]["branch_id"], rows["transaction"]["destination_branch_id"]])
+    return transaction_id
 
 @app.delete("/branches/{branch_id}/allocations/")
 def reset_allocations(
@@ -370,6 +498,9 @@ def reset_allocations(
         # Update legacy field for backward compatibility
         branch.allocated_amount = 0.0
         db.commit()
+        cache.delete(get_branch_cache_key(branch_id))
+        resource_versions.bump("branches", branch_version(branch_id))
+        event_broker.emit("funds", "branch.funds", [branch_id], branch_id=branch_id, reset="SYP")
         
         return {"status": "success", "message": "SYP allocations reset"}
     
@@ -387,6 +518,9 @@ def reset_allocations(
         
         branch.allocated_amount_usd = 0.0
         db.commit()
+        cache.delete(get_branch_cache_key(branch_id))
+        resource_versions.bump("branches", branch_version(branch_id))
+        event_broker.emit("funds", "branch.funds", [branch_id], branch_id=branch_id, reset="USD")
         
         return {"status": "success", "message": "USD allocations reset"}
     
@@ -419,6 +553,9 @@ def reset_allocations(
         # Update legacy field for backward compatibility
         branch.allocated_amount = 0.0
         db.commit()
+        cache.delete(get_branch_cache_key(branch_id))
+        resource_versions.bump("branches", branch_version(branch_id))
+        event_broker.emit("funds", "branch.funds", [branch_id], branch_id=branch_id, reset="all")
         
         return {"status": "success", "message": "All allocations reset"}
     
@@ -453,9 +590,11 @@ def update_branch(
     try:
         db.commit()
         db.refresh(branch)
+        branch_directory.publish_change()
+        event_broker.emit("branches", "branch.updated", branch_id=branch.id)
         # حذف الكاش بعد التعديل
-        from cache import get_branch_cache_key, cache
         cache.delete(get_branch_cache_key(branch.id))
+        resource_versions.bump("branches")
         return {
             "status": "success",
             "branch": {
@@ -479,87 +618,46 @@ def get_customers(
     id_number: Optional[str] = None,
     governorate: Optional[str] = None,
     user_type: Optional[str] = None,  # 'sender' or 'receiver'
+    page: int = 1,
+    per_page: int = 20,
+    current_user: dict = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    # Build base query
-    query = db.query(
-        Transaction.sender.label('sender_name'),
-        Transaction.sender_mobile,
-        Transaction.sender_governorate,
-        Transaction.sender_location,
-        Transaction.sender_id,
-        Transaction.receiver.label('receiver_name'),
-        Transaction.receiver_mobile,
-        Transaction.receiver_governorate,
-        Transaction.receiver_location,
-        Transaction.receiver_id
-    )
-
-    # Apply filters
-    if name:
-        query = query.filter(
-            (Transaction.sender.ilike(f"%{name}%")) | 
-            (Transaction.receiver.ilike(f"%{name}%"))
-        )
-    if mobile:
-        query = query.filter(
-            (Transaction.sender_mobile.ilike(f"%{mobile}%")) | 
-            (Transaction.receiver_mobile.ilike(f"%{mobile}%"))
-        )
-    if id_number:
-        query = query.filter(
-            (Transaction.sender_id.ilike(f"%{id_number}%")) | 
-            (Transaction.receiver_id.ilike(f"%{id_number}%"))
-        )
-    if governorate:
-        query = query.filter(
-            (Transaction.sender_governorate.ilike(f"%{governorate}%")) | 
-            (Transaction.receiver_governorate.ilike(f"%{governorate}%"))
-        )
-    if user_type:
-        if user_type == "sender":
-            query = query.filter(Transaction.sender.isnot(None))
-        elif user_type == "receiver":
-            query = query.filter(Transaction.receiver.isnot(None))
-
-    # Group by to get unique customers
-    query = query.group_by(
-        Transaction.sender,
-        Transaction.sender_mobile,
-        Transaction.sender_governorate,
-        Transaction.sender_location,
-        Transaction.sender_id,
-        Transaction.receiver,
-        Transaction.receiver_mobile,
-        Transaction.receiver_governorate,
-        Transaction.receiver_location,
-        Transaction.receiver_id
-    )
-
-    # Execute query
-    customers = query.all()
-
-    # Format results
-    customer_list = []
-    for cust in customers:
-        customer_list.append({
-            "sender_name": cust.sender_name or "",
-            "sender_mobile": cust.sender_mobile or "",
-            "sender_governorate": cust.sender_governorate or "",
-            "sender_location": cust.sender_location or "",
-            "sender_id": cust.sender_id or "",
-            "receiver_name": cust.receiver_name or "",
-            "receiver_mobile": cust.receiver_mobile or "",
-            "receiver_governorate": cust.receiver_governorate or "",
-            "receiver_location": cust.receiver_location or "",
-            "receiver_id": cust.receiver_id or "",
-            "user_type": user_type or ""
-        })
+    """Customer directory search; name and mobile match by prefix"""
+    query = db.query(Customer).filter(*customer_search_filters(
+        name=name, mobile=mobile, id_number=id_number, governorate=governorate, user_type=user_type
+    ))
+    total = query.count()
+    customers = query.order_by(Customer.last_seen.desc(), Customer.id.desc()) \
+        .offset((page - 1) * per_page).limit(per_page).all()
+    return {
+        "items": [customer_dict(customer) for customer in customers],
+        "total": total,
+        "page": page,
+        "per_page": per_page,
+        "total_pages": (total + per_page - 1) // per_page
+    }
 
-    return {"customers": customer_list}
+@app.get("/customers/autocomplete/")
+def autocomplete_customers(
+    q: str,
+    limit: int = 10,
+    current_user: dict = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Suggestions for the sender/receiver fields: a name or mobile prefix, most active first"""
+    if not q.strip():
+        return []
+    customers = db.query(Customer).filter(customer_autocomplete_filter(q)).order_by(
+        (Customer.sent_count + Customer.received_count).desc(), Customer.last_seen.desc()
+    ).limit(min(max(limit, 1), 50)).all()
+    return [customer_dict(customer) for customer in customers]
 
 @app.get("/check-initialization/")
-def check_initialization(db: Session = Depends(get_db)):
+def check_initialization(request: Request, response: Response, db: Session = Depends(get_db)):
+    not_modified = conditional_get(request, response, ["users"])
+    if not_modified:
+        return not_modified
     admin_exists = db.query(User).filter(User.role == "director").first()
     return {"is_initialized": admin_exists is not None}
 
@@ -592,6 +690,8 @@ def initialize_system(user: UserCreate, db: Session = Depends(get_db)):
         db.add(db_branch)
 
     db.commit()
+    branch_directory.publish_change()
+    resource_versions.bump("users", "branches")
     return {"status": "success", "message": "تم إنشاء مدير النظام بنجاح"} 
 
 @app.get("/branches/{branch_id}/funds-history")
@@ -616,18 +716,61 @@ def get_funds_history(
         "description": record.description
     } for record in history]
     
+def idempotent_request(endpoint: str, idempotency_key: Optional[str], payload: Dict[str, Any], current_user: dict):
+    """(scope, key, fingerprint, stored response or None) for a request with an Idempotency-Key header"""
+    key = check_key(idempotency_key)
+    scope = f"{endpoint}:{current_user.get('user_id')}"
+    fingerprint = request_fingerprint(payload)
+    return scope, key, fingerprint, idempotency_store.lookup(scope, key)
+
+def replay_stored(scope: str, key: str, fingerprint: str) -> JSONResponse:
+    """Replay what the attempt that won the key stored"""
+    record = idempotency_store.load(scope, key)
+    if record is None:
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+    return replay(record, fingerprint)
+
 @app.post("/send-money/")
-async def send_money(transaction: TransactionSchema, current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
+async def send_money(
+    transaction: TransactionSchema,
+    current_user: dict = Depends(get_current_user),
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)
+):
+    if idempotency_key is not None:
+        scope, key, fingerprint, stored = idempotent_request("send-money", idempotency_key, transaction.model_dump(), current_user)
+        if stored is not None:
+            return replay(stored, fingerprint)
     branch_id = current_user.get("branch_id")
     employee_id = current_user.get("user_id")
     # منع استقبال حوالات للفرع الرئيسي
     if transaction.destination_branch_id == 0:
         raise HTTPException(status_code=400, detail="لا يمكن إرسال حوالة إلى الفرع الرئيسي (الفرع الرئيسي للإرسال فقط)")
-    transaction_id = save_to_db(transaction, branch_id, employee_id, db)
-    return {"status": "success", "message": "Transaction saved!", "transaction_id": transaction_id}
+    transaction_id = uuid7()
+    response = {"status": "success", "message": "Transaction saved!", "transaction_id": transaction_id}
+    record = None
+    if idempotency_key is not None:
+        record = idempotency_store.record(scope, key, fingerprint, 200, response)
+    try:
+        await write_transaction(transaction, branch_id, employee_id, transaction_id, record)
+    except IdempotencyKeyTaken:
+        return replay_stored(scope, key, fingerprint)
+    if record is not None:
+        idempotency_store.remember(record)
+    return response
 
 @app.post("/transactions/", status_code=201)
-async def create_transaction(transaction: TransactionSchema, current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_transaction(
+    transaction: TransactionSchema,
+    current_user: dict = Depends(get_current_user),
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)
+):
+    # A retry of a request that already went through gets the same answer, without writing again
+    if idempotency_key is not None:
+        scope, key, fingerprint, stored = idempotent_request("transactions", idempotency_key, transaction.model_dump(), current_user)
+        if stored is not None:
+            return replay(stored, fingerprint)
     try:
         if transaction.amount <= 0:
             raise HTTPException(status_code=400, detail="المبلغ يجب أن يكون أكبر من صفر")
@@ -640,24 +783,41 @@ async def create_transaction(transaction: TransactionSchema, current_user: dict
         # منع استقبال حوالات للفرع الرئيسي
         if transaction.destination_branch_id == 0:
             raise HTTPException(status_code=400, detail="لا يمكن إرسال حوالة إلى الفرع الرئيسي (الفرع الرئيسي للإرسال فقط)")
+        transaction_id = uuid7()
+        response = {
+            "status": "success",
+            "message": "تم إنشاء التحويل بنجاح",
+            "transaction_id": transaction_id
+        }
+        record = None
+        if idempotency_key is not None:
+            record = idempotency_store.record(scope, key, fingerprint, 201, response)
         try:
-            transaction_id = save_to_db(transaction, branch_id, employee_id, db)
-            # Invalidate relevant caches
-            cache.clear_pattern(f"branch_transactions:{transaction.branch_id}:*")
-            cache.clear_pattern(f"branch_transactions:{transaction.destination_branch_id}:*")
-            cache.delete(get_branch_cache_key(transaction.branch_id))
-            cache.delete(get_branch_cache_key(transaction.destination_branch_id))
-            return {
-                "status": "success",
-                "message": "تم إنشاء التحويل بنجاح",
-                "transaction_id": transaction_id
-            }
+            try:
+                await write_transaction(transaction, branch_id, employee_id, transaction_id, record)
+            except IdempotencyKeyTaken:
+                return replay_stored(scope, key, fingerprint)
+            if record is not None:
+                idempotency_store.remember(record)
+            # Invalidate relevant caches, in one Redis round trip
+            cache.invalidate(
+                keys=[get_branch_cache_key(branch_id), get_branch_cache_key(transaction.destination_branch_id)],
+                patterns=[
+                    f"branch_transactions:{branch_id}:*",
+                    f"branch_transactions:{transaction.destination_branch_id}:*"
+                ]
+            )
+            return response
+        except HTTPException:
+            raise
         except Exception as e:
             print(f"[ERROR] Error saving transaction: {e}")
             print(f"[ERROR] Transaction data: {transaction.dict()}")
             import traceback
             traceback.print_exc()
             raise HTTPException(status_code=500, detail=str(e))
+    except HTTPException:
+        raise
     except ValidationError as e:
         print(f"[ERROR] Validation error: {e}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -667,6 +827,161 @@ async def create_transaction(transaction: TransactionSchema, current_user: dict
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+TRANSACTION_BATCH_CHUNK = int(os.getenv("TRANSACTION_BATCH_CHUNK", "500"))
+
+def batch_item_error(e: Exception) -> str:
+    if isinstance(e, ValidationError):
+        return "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+    if isinstance(e, HTTPException):
+        return str(e.detail)
+    if isinstance(e, sqlalchemy.exc.IntegrityError):
+        return str(transfer_integrity_error(e).detail)
+    return str(e)
+
+def ingest_transactions(items, current_user: dict) -> Dict[str, Any]:
+    """Validate and insert many transfers, with one result per item in input order.
+
+    Every item is checked on its own (schema, destination branch from the
+    branch directory) and the valid ones are written TRANSACTION_BATCH_CHUNK
+    at a time with group_commit.write_transfers: one multi-row INSERT per table
+    and one commit per chunk. Caches are invalidated once for all branches touched.
+    """
+    results = []
+    branches = set()
+    unknown_destinations = set()
+    created_events = []
+
+    def flush(chunk):
+        errors = write_transfers(engine, [rows for _, rows in chunk])
+        for (index, rows), error in zip(chunk, errors):
+            if error is not None:
+                results.append({"index": index, "status": "error", "detail": batch_item_error(error)})
+                continue
+            branches.update((rows["transaction"]["branch_id"], rows["transaction"]["destination_branch_id"]))
+            created_events.append(transfer_created_event(rows))
+            results.append({"index": index, "status": "created", "transaction_id": rows["transaction"]["id"]})
+
+    chunk = []
+    for index, item in enumerate(items):
+        try:
+            if isinstance(item, Exception):
+                raise item  # a line the upload could not parse
+            transaction = TransactionSchema.model_validate(item)
+            destination_id = transaction.destination_branch_id
+            # منع استقبال حوالات للفرع الرئيسي
+            if destination_id == 0:
+                raise HTTPException(status_code=400, detail="لا يمكن إرسال حوالة إلى الفرع الرئيسي (الفرع الرئيسي للإرسال فقط)")
+            # Caught here so one bad destination does not send its whole chunk
+            # down the row-by-row path; the directory reloads once per unknown id
+            if destination_id in unknown_destinations or not branch_directory.get(destination_id, reload_on_miss=True):
+                unknown_destinations.add(destination_id)
+                raise HTTPException(status_code=404, detail="Destination branch not found")
+            branch_id = transaction.branch_id
+            if branch_id is None:
+                branch_id = current_user.get("branch_id")
+            rows = prepare_transaction_rows(transaction, branch_id, current_user.get("user_id"))
+        except Exception as e:
+            results.append({"index": index, "status": "error", "detail": batch_item_error(e)})
+            continue
+        chunk.append((index, rows))
+        if len(chunk) >= TRANSACTION_BATCH_CHUNK:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+
+    branches.discard(None)
+    if branches:
+        cache.invalidate(
+            keys=[get_branch_cache_key(branch) for branch in branches],
+            patterns=[f"branch_transactions:{branch}:*" for branch in branches]
+        )
+    event_broker.publish(created_events)
+    transactions_changed(branches)
+    results.sort(key=lambda result: result["index"])
+    created = sum(1 for result in results if result["status"] == "created")
+    return {"total": len(results), "created": created, "failed": len(results) - created, "results": results}
+
+def _upload_lines(file: UploadFile, bad_lines: set):
+    """The upload's lines as text, decoded one at a time so a bad byte only spoils its own line"""
+    for line_number, raw in enumerate(iter(file.file.readline, b""), start=1):
+        try:
+            yield raw.decode("utf-8-sig" if line_number == 1 else "utf-8")
+        except UnicodeDecodeError:
+            bad_lines.add(line_number)
+            yield raw.decode("utf-8", errors="replace")
+
+def iter_upload_transactions(file: UploadFile):
+    """Transfers from an uploaded CSV (header row of TransactionSchema fields) or NDJSON file, read lazily.
+
+    A line that is not UTF-8, valid JSON or valid CSV becomes a ValueError item
+    reported for that line; the rest of the file is still read.
+    """
+    name = (file.filename or "").lower()
+    content_type = (file.content_type or "").split(";")[0].strip()
+    bad_lines = set()
+    lines = _upload_lines(file, bad_lines)
+    if name.endswith(".csv") or content_type == "text/csv":
+        fields = TransactionSchema.model_fields
+        reader = csv.DictReader(lines)
+        try:
+            reader.fieldnames
+        except csv.Error as e:
+            raise HTTPException(status_code=400, detail=f"Invalid CSV header: {str(e)}")
+        if bad_lines:
+            raise HTTPException(status_code=400, detail="The uploaded file is not UTF-8 text")
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                bad_lines.clear()
+                yield ValueError(f"Invalid CSV on line {reader.line_num}: {str(e)}")
+                continue
+            if bad_lines:
+                # The record spans the lines read since the previous one
+                yield ValueError(f"Invalid UTF-8 on line {min(bad_lines)}")
+                bad_lines.clear()
+                continue
+            # An empty cell leaves an optional field at its default (branch_id, date, ...)
+            yield {
+                key: value for key, value in row.items()
+                if key and value is not None and (value != "" or key not in fields or fields[key].is_required())
+            }
+    elif name.endswith((".ndjson", ".jsonl")) or content_type in ("application/x-ndjson", "application/jsonl"):
+        for line_number, line in enumerate(lines, start=1):
+            if line_number in bad_lines:
+                yield ValueError(f"Invalid UTF-8 on line {line_number}")
+                continue
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield ValueError(f"Invalid JSON on line {line_number}: {str(e)}")
+    else:
+        raise HTTPException(status_code=400, detail="Unsupported file type, upload a .csv or .ndjson file")
+
+@app.post("/transactions/batch/")
+def create_transactions_batch(items: List[Dict[str, Any]], current_user: dict = Depends(get_current_user)):
+    """Create many transfers in one request; each item succeeds or fails on its own"""
+    if current_user["role"] != "director":
+        raise HTTPException(status_code=403, detail="Director access required")
+    return ingest_transactions(items, current_user)
+
+@app.post("/transactions/batch/upload/")
+def upload_transactions_batch(file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
+    """Create transfers from a CSV or NDJSON file without reading it into memory first"""
+    if current_user["role"] != "director":
+        raise HTTPException(status_code=403, detail="Director access required")
+    items = iter_upload_transactions(file)
+    try:
+        first = next(items)
+    except StopIteration:
+        raise HTTPException(status_code=400, detail="The uploaded file contains no transfers")
+    return ingest_transactions(itertools.chain([first], items), current_user)
+
 class TransactionReceived(BaseModel):
     transaction_id: str
     receiver: str
@@ -678,37 +993,77 @@ class TransactionReceived(BaseModel):
 @app.post("/mark-transaction-received/")
 def mark_transaction_received(received_data: TransactionReceived, current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
     try:
-        # Verify transaction exists and belongs to current branch (الفرع المستلم)
-        transaction = db.query(Transaction).filter(
-            Transaction.id == received_data.transaction_id,
-            Transaction.destination_branch_id == current_user["branch_id"]
-        ).first()
-        
-        if not transaction:
-            raise HTTPException(status_code=404, 
-                             detail="Transaction not found or not authorized for this branch")
-        
-        # Update transaction
-        transaction.is_received = True
-        transaction.received_by = current_user["user_id"]
-        transaction.received_at = datetime.now()
-        transaction.receiver = received_data.receiver
-        transaction.receiver_mobile = received_data.receiver_mobile
-        transaction.receiver_id = received_data.receiver_id
-        transaction.receiver_address = received_data.receiver_address
-        transaction.receiver_governorate = received_data.receiver_governorate
-        transaction.status = 'completed'
-        
-        # Update notification
-        notification = db.query(Notification).filter(
-            Notification.transaction_id == received_data.transaction_id
-        ).first()
-        if notification:
-            notification.status = 'sent'
+        for attempt in range(STATUS_UPDATE_RETRIES + 1):
+            # Verify transaction exists and belongs to current branch (الفرع المستلم)
+            transaction = db.query(Transaction).filter(
+                Transaction.id == received_data.transaction_id,
+                Transaction.destination_branch_id == current_user["branch_id"]
+            ).first()
+            
+            if not transaction:
+                raise HTTPException(status_code=404, 
+                                 detail="Transaction not found or not authorized for this branch")
+            # Of two tellers paying the same transfer, the compare-and-swap below lets one
+            # through; the other starts over and stops here
+            if transaction.is_received:
+                raise HTTPException(status_code=409, detail="Transaction already received")
+            if claimed_by_other(transaction, current_user["user_id"]):
+                raise HTTPException(status_code=409, detail="Transaction is claimed by another teller")
+            old_status = transaction.status
+            received_at = datetime.now()
+
+            # Cold column, written to transaction_details
+            transaction.receiver_mobile = received_data.receiver_mobile
+            
+            # Update notification
+            db.query(Notification).filter(
+                Notification.transaction_id == transaction.id
+            ).update({Notification.status: "sent"}, synchronize_session=False)
+
+            # The receiver as identified at the counter; counted when the transfer was created
+            upsert_customers(db, [customer_row(
+                received_data.receiver, received_data.receiver_mobile, received_at,
+                governorate=received_data.receiver_governorate, location=received_data.receiver_address,
+                id_number=received_data.receiver_id
+            )])
+
+            # A pickup completes the transfer, so it books the profit like a status update does
+            if old_status == 'processing':
+                record_branch_profit(db, transaction)
+
+            # Update transaction; a lease taken since the read above doesn't bump the
+            # version, so the swap also re-checks that nobody else holds one
+            if compare_and_set(
+                db, transaction, unclaimed(current_user["user_id"]),
+                is_received=True,
+                received_by=current_user["user_id"],
+                received_at=received_at,
+                receiver=received_data.receiver,
+                receiver_governorate=received_data.receiver_governorate,
+                status='completed',
+                payout_claimed_by=None,
+                payout_claim_expires=None
+            ):
+                break
+            db.rollback()
+        else:
+            raise HTTPException(
+                status_code=409,
+                detail="Transaction was modified by another request, please try again"
+            )
         
+        received_event = event(
+            "transactions", "transaction.received", [transaction.branch_id, transaction.destination_branch_id],
+            transaction_id=transaction.id, status="completed", old_status=old_status
+        )
         db.commit()
+        invalidate_transaction_caches([received_event["data"]["transaction_id"]], received_event["branch_ids"])
+        event_broker.publish([received_event])
         return {"status": "success", "message": "Transaction marked as received"}
         
+    except HTTPException:
+        db.rollback()
+        raise
     except Exception as e:
         db.rollback()
         print(f"Error in mark_transaction_received: {e}")
@@ -717,6 +1072,86 @@ def mark_transaction_received(received_data: TransactionReceived, current_user:
             detail=f"Unexpected error: {str(e)}"
         )
 
+def payout_item(transaction: Transaction) -> Dict[str, Any]:
+    return {
+        "id": transaction.id,
+        "sender": transaction.sender,
+        "receiver": transaction.receiver,
+        "receiver_mobile": transaction.receiver_mobile,
+        "receiver_governorate": transaction.receiver_governorate,
+        "amount": transaction.amount,
+        "currency": transaction.currency,
+        "message": transaction.message,
+        "date": transaction.date.strftime("%Y-%m-%d %H:%M:%S") if transaction.date else None,
+        "branch_id": transaction.branch_id,
+        "sending_branch_name": branch_directory.name(transaction.branch_id),
+        "claimed_by": transaction.payout_claimed_by,
+        "claim_expires_at": transaction.payout_claim_expires.strftime("%Y-%m-%d %H:%M:%S")
+        if transaction.payout_claim_expires else None,
+    }
+
+@app.get("/branches/{branch_id}/payout-queue/")
+def get_payout_queue(
+    branch_id: int,
+    limit: int = 50,
+    unclaimed_only: bool = False,
+    current_user: dict = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Transfers waiting to be paid out at the branch, oldest first, with their leases"""
+    if current_user["role"] != "director" and current_user["branch_id"] != branch_id:
+        raise HTTPException(status_code=403, detail="Not authorized to view this branch's payout queue")
+    transactions = payout_queue(db, branch_id, limit=max(1, min(limit, 200)), include_claimed=not unclaimed_only)
+    return {"branch_id": branch_id, "transactions": [payout_item(transaction) for transaction in transactions]}
+
+def claimed_payout(db: Session, claimed) -> Dict[str, Any]:
+    """Commit a claim and return the leased transfer"""
+    transaction = db.query(Transaction).filter(
+        Transaction.id == claimed.id, Transaction.date == claimed.date
+    ).options(selectinload(Transaction.details)).one()
+    item = payout_item(transaction)
+    db.commit()
+    return item
+
+@app.post("/payout-queue/claim/")
+def claim_next_payout(current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Lease the oldest unclaimed transfer waiting at the teller's branch"""
+    claimed = claim_next(db, current_user["branch_id"], current_user["user_id"])
+    if claimed is None:
+        db.rollback()
+        raise HTTPException(status_code=404, detail="No transfers waiting to be claimed")
+    return claimed_payout(db, claimed)
+
+@app.post("/transactions/{transaction_id}/claim/")
+def claim_payout(transaction_id: str, current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Lease a specific waiting transfer, or renew the teller's own lease on it"""
+    claimed = claim_transaction(db, transaction_id, current_user["branch_id"], current_user["user_id"])
+    if claimed is None:
+        db.rollback()
+        waiting = db.query(Transaction.id).filter(
+            Transaction.id == transaction_id, *waiting_filters(current_user["branch_id"])
+        ).first()
+        if waiting is None:
+            raise HTTPException(status_code=404, detail="Transaction is not waiting for payout at this branch")
+        raise HTTPException(status_code=409, detail="Transaction is claimed by another teller")
+    return claimed_payout(db, claimed)
+
+@app.delete("/transactions/{transaction_id}/claim/")
+def release_payout_claim(transaction_id: str, current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Give a lease back early; directors and branch managers can release any teller's lease"""
+    teller_id = None if current_user["role"] in ["director", "branch_manager"] else current_user["user_id"]
+    if current_user["role"] == "branch_manager":
+        # ...but only on transfers waiting at their own branch
+        if db.query(Transaction.id).filter(
+            Transaction.id == transaction_id, Transaction.destination_branch_id == current_user["branch_id"]
+        ).first() is None:
+            raise HTTPException(status_code=404, detail="Transaction not found or not authorized for this branch")
+    released = release_claim(db, transaction_id, teller_id)
+    db.commit()
+    if not released:
+        raise HTTPException(status_code=404, detail="No claim to release")
+    return {"status": "success", "message": "Claim released"}
+
 @app.post("/login/")
 async def login(user: LoginRequest, db: Session = Depends(get_db)):
     db_user = db.query(User).filter(User.username == user.username).first() 
@@ -795,6 +1230,7 @@ def register_user(user: UserCreate, token: str = Depends(oauth2_scheme)):
             db.add(db_user)
             db.commit()
             db.refresh(db_user)
+            resource_versions.bump("users")
             
             branch_name = None
             if db_user.branch_id:
@@ -851,6 +1287,7 @@ def create_user(user: UserCreate, db: Session = Depends(get_db), current_user: d
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    resource_versions.bump("users")
     
     branch_name = None
     if db_user.branch_id:
@@ -889,22 +1326,25 @@ def create_branch(branch: BranchCreate, db: Session = Depends(get_db), current_u
         db.add(db_branch)
         db.commit()
         db.refresh(db_branch)
+        branch_directory.publish_change()
+        event_broker.emit("branches", "branch.created", branch_id=db_branch.id)
+        resource_versions.bump("branches")
         
         return {"id": db_branch.id, "branch_id": db_branch.branch_id, "name": db_branch.name, "location": db_branch.location, "governorate": db_branch.governorate}
     
     except sqlalchemy.exc.IntegrityError as e:
         db.rollback()
         # Handle specific integrity errors with user-friendly messages
-        if "UNIQUE constraint failed: branches.name" in str(e):
+        if any(name in str(e) for name in ("UNIQUE constraint failed: branches.name", "ix_branches_name", "branches_name_key")):
             raise HTTPException(status_code=400, detail="A branch with this name already exists. Please use a different name.")
-        elif "UNIQUE constraint failed: branches.branch_id" in str(e):
+        elif any(name in str(e) for name in ("UNIQUE constraint failed: branches.branch_id", "ix_branches_branch_id", "branches_branch_id_key")):
             raise HTTPException(status_code=400, detail="A branch with this ID already exists. Please use a different branch ID.")
         else:
             # For other integrity errors
             raise HTTPException(status_code=400, detail=f"Database integrity error: {str(e)}")
 
 @app.get("/branches/")
-def get_branches(request: Request, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+def get_branches(request: Request, response: Response, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
     try:
         include_employee_count = request.query_params.get('include_employee_count', 'false').lower() == 'true'
         user_role = current_user["role"]
@@ -927,6 +1367,13 @@ def get_branches(request: Request, db: Session = Depends(get_db), current_user:
                 branch_data['employee_count'] = employee_count
             branch_list.append(branch_data)
         return {"branches": branch_list}
+    # Balances are shown for the user's own branch only, so the body depends on who asks
+    not_modified = conditional_get(
+        request, response, ["branches", "users"] if include_employee_count else ["branches"],
+        user_role, user_branch_id, include_employee_count
+    )
+    if not_modified:
+        return not_modified
     branches = db.query(Branch).all()
     branch_list = []
     for branch in branches:
@@ -960,12 +1407,23 @@ def get_branches(request: Request, db: Session = Depends(get_db), current_user:
     return {"branches": branch_list}
 
 @app.get("/branches/{branch_id}")
-def get_branch(branch_id: int, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    # Try to get from cache first
+def get_branch(branch_id: int, request: Request, response: Response, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+    # Authorization check; the System Manager branch (ID 0) is open to everyone
+    if current_user["role"] == "branch_manager" and branch_id != 0 and current_user["branch_id"] != branch_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to view this branch")
+
+    not_modified = conditional_get(request, response, ["branches", branch_version(branch_id)])
+    if not_modified:
+        return not_modified
+
+    # Try to get from cache first. The copy carries the ETag it was built under and
+    # is only served while that is still current, so a write that bumped the
+    # versions never has its old body sent under the new ETag
+    etag = response.headers.get("ETag")
     cache_key = get_branch_cache_key(branch_id)
     cached_result = cache.get(cache_key)
-    if cached_result:
-        return cached_result
+    if cached_result and cached_result.get("etag") == etag and "body" in cached_result:
+        return cached_result["body"]
 
     # Special handling for System Manager branch (ID 0)
     if branch_id == 0:
@@ -989,12 +1447,8 @@ def get_branch(branch_id: int, db: Session = Depends(get_db), current_user: dict
                 "total_received": 0.0
             }
         }
-        cache.set(cache_key, result, expire=300)
+        cache.set(cache_key, {"etag": etag, "body": result}, expire=300)
         return result
-    
-    # Authorization check
-    if current_user["role"] == "branch_manager" and current_user["branch_id"] != branch_id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to view this branch")
 
     branch = db.query(Branch).filter(Branch.id == branch_id).first()
     if not branch:
@@ -1052,7 +1506,7 @@ def get_branch(branch_id: int, db: Session = Depends(get_db), current_user: dict
     }
 
     # Cache the result
-    cache.set(cache_key, result, expire=300)
+    cache.set(cache_key, {"etag": etag, "body": result}, expire=300)
     
     return result
 
@@ -1083,16 +1537,12 @@ def get_users(
     users = query.all()
     user_list = []
     for user in users:
-        branch_name = None
-        if user.branch_id:
-            branch = db.query(Branch).filter(Branch.id == user.branch_id).first()
-            branch_name = branch.name if branch else None
         user_list.append({
             "id": user.id,
             "username": user.username,
             "role": user.role,
             "branch_id": user.branch_id,
-            "branch_name": branch_name,
+            "branch_name": branch_directory.name(user.branch_id),
             "created_at": user.created_at.strftime("%Y-%m-%d %H:%M:%S") if user.created_at else None
         })
     return {
@@ -1129,18 +1579,12 @@ def get_employees(db: Session = Depends(get_db), current_user: dict = Depends(ge
     # Get branch names for each employee
     employee_list = []
     for employee in employees:
-        branch_name = None
-        if employee.branch_id:
-            branch = db.query(Branch).filter(Branch.id == employee.branch_id).first()
-            if branch:
-                branch_name = branch.name
-        
         employee_list.append({
             "id": employee.id,
             "username": employee.username,
             "role": employee.role,
             "branch_id": employee.branch_id,
-            "branch_name": branch_name,
+            "branch_name": branch_directory.name(employee.branch_id),
             "created_at": employee.created_at.strftime("%Y-%m-%d %H:%M:%S") if employee.created_at else None
         })
     
@@ -1176,6 +1620,62 @@ def get_branch_employees(branch_id: int, db: Session = Depends(get_db), current_
     
     return employee_list
 
+# Fields of a transaction listing row, in response order. Transaction columns
+# come from the page query itself; details and branch names are joined onto
+# the page afterwards, so they cost one lookup per returned row instead of
+# widening the scan over every matching one.
+TRANSACTION_LIST_FIELDS = (
+    "id", "sender", "sender_mobile", "sender_governorate", "receiver", "receiver_mobile", "receiver_governorate",
+    "amount", "base_amount", "benefited_amount", "tax_rate", "tax_amount", "currency", "message",
+    "employee_name", "branch_governorate", "branch_id", "destination_branch_id", "employee_id",
+    "status", "date", "is_received", "sending_branch_name", "destination_branch_name"
+)
+TRANSACTION_DETAIL_FIELDS = ("sender_mobile", "receiver_mobile", "message", "employee_name", "branch_governorate")
+TRANSACTION_BRANCH_NAME_FIELDS = {"sending_branch_name": "branch_id", "destination_branch_name": "destination_branch_id"}
+
+def transaction_page(db: Session, filters, fields, offset: int, limit: int, unknown_branch: Optional[str] = None):
+    """One page of transactions, newest first, as row tuples with `fields` in order"""
+    keys = ["date", "id"] + [TRANSACTION_BRANCH_NAME_FIELDS[field] for field in fields if field in TRANSACTION_BRANCH_NAME_FIELDS]
+    own = [field for field in fields if field not in TRANSACTION_DETAIL_FIELDS and field not in TRANSACTION_BRANCH_NAME_FIELDS]
+    page = select(*(getattr(Transaction, name) for name in dict.fromkeys(own + keys))).where(*filters).order_by(
+        Transaction.date.desc(), Transaction.id.desc()
+    ).offset(offset).limit(limit).subquery()
+
+    source = page
+    if any(field in TRANSACTION_DETAIL_FIELDS for field in fields):
+        source = source.outerjoin(TransactionDetails, TransactionDetails.transaction_id == page.c.id)
+    columns = []
+    for field in fields:
+        if field in TRANSACTION_DETAIL_FIELDS:
+            columns.append(getattr(TransactionDetails, field))
+        elif field in TRANSACTION_BRANCH_NAME_FIELDS:
+            branch = aliased(Branch)
+            source = source.outerjoin(branch, branch.id == page.c[TRANSACTION_BRANCH_NAME_FIELDS[field]])
+            columns.append(branch.name if unknown_branch is None else func.coalesce(branch.name, unknown_branch))
+        else:
+            columns.append(page.c[field])
+    return db.execute(
+        select(*columns).select_from(source).order_by(page.c.date.desc(), page.c.id.desc())
+    ).all()
+
+def parse_fields(fields: Optional[str], allowed) -> tuple:
+    """A sparse fieldset (comma separated) as a subset of `allowed`, in its order; all of them when not given"""
+    if fields is None:
+        return tuple(allowed)
+    wanted = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = wanted - set(allowed)
+    if unknown or not wanted:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields: {', '.join(sorted(unknown))}" if unknown else "fields must name at least one field"
+        )
+    return tuple(field for field in allowed if field in wanted)
+
+def count_transactions(db: Session, filters) -> int:
+    return db.execute(select(func.count()).select_from(Transaction).where(*filters)).scalar()
+
+transaction_list_rows = row_mapper(TRANSACTION_LIST_FIELDS)
+
 @app.get("/transactions/")
 def get_transactions(
     db: Session = Depends(get_db), 
@@ -1192,125 +1692,42 @@ def get_transactions(
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     page: int = 1,
-    per_page: int = 20
+    per_page: int = 20,
+    fields: Optional[str] = None
 ):
-    # Generate cache key based on parameters (ignore for paginated for now)
-    # ... existing code ...
-    SendingBranch = aliased(Branch)
-    DestinationBranch = aliased(Branch)
-    query = db.query(
-        Transaction,
-        SendingBranch.name.label('sending_branch_name'),
-        DestinationBranch.name.label('destination_branch_name')
-    ).outerjoin(
-        SendingBranch, Transaction.branch_id == SendingBranch.id
-    ).outerjoin(
-        DestinationBranch, Transaction.destination_branch_id == DestinationBranch.id
+    """A page of transactions, newest first.
+
+    `fields` (comma separated, e.g. id,amount,status,date) limits each item to
+    those fields. Only their columns are read, and the details and branch
+    tables are joined only when one of their fields is asked for.
+    """
+    selected = parse_fields(fields, TRANSACTION_LIST_FIELDS)
+    filters = compile_transaction_filters(
+        current_user,
+        branch_id=branch_id,
+        destination_branch_id=destination_branch_id,
+        id=id,
+        sender=sender,
+        receiver=receiver,
+        status=status,
+        date=date,
+        start_date=start_date,
+        end_date=end_date,
+        filter_type=filter_type,
+        strict_dates=False
     )
 
-    # Base security filtering
-    if current_user["role"] == "employee":
-        query = query.filter(
-            (Transaction.employee_id == current_user["user_id"]) | 
-            (Transaction.destination_branch_id == current_user["branch_id"])
-        )
-    elif current_user["role"] == "branch_manager":
-        query = query.filter(
-            (Transaction.branch_id == current_user["branch_id"]) | 
-            (Transaction.destination_branch_id == current_user["branch_id"])
-        )
-
-    # Apply filters
-    if branch_id:
-        query = query.filter(Transaction.branch_id == branch_id)
-    if destination_branch_id:
-        query = query.filter(Transaction.destination_branch_id == destination_branch_id)
-    if id:
-        query = query.filter(Transaction.id.ilike(f"%{id}%"))
-    if sender:
-        query = query.filter(Transaction.sender.ilike(f"%{sender}%"))
-    if receiver:
-        query = query.filter(Transaction.receiver.ilike(f"%{receiver}%"))
-    if status:
-        query = query.filter(Transaction.status == status)
-    if date:
-        query = query.filter(Transaction.date.ilike(f"%{date}%"))
-    # إضافة فلترة التاريخ بدقة
-    from datetime import datetime
-    if start_date:
-        try:
-            start = datetime.strptime(start_date, "%Y-%m-%d")
-            query = query.filter(Transaction.date >= start)
-        except ValueError:
-            pass
-    if end_date:
-        try:
-            end = datetime.strptime(end_date, "%Y-%m-%d")
-            end = end.replace(hour=23, minute=59, second=59)
-            query = query.filter(Transaction.date <= end)
-        except ValueError:
-            pass
-
-    # Apply type filter if specified
-    if filter_type:
-        branch = db.query(Branch).filter(Branch.id == current_user["branch_id"]).first()
-        if branch:
-            if filter_type == "incoming":
-                query = query.filter(Transaction.receiver_governorate == branch.governorate)
-            elif filter_type == "outgoing":
-                query = query.filter(Transaction.sender_governorate == branch.governorate)
-            elif filter_type == "branch_related":
-                query = query.filter(
-                    (Transaction.sender_governorate == branch.governorate) | 
-                    (Transaction.receiver_governorate == branch.governorate)
-                )
-
-    # Count total before pagination
-    total = query.count()
-
-    # Apply sorting and pagination
-    query = query.order_by(Transaction.date.desc())
-    query = query.offset((page - 1) * per_page).limit(per_page)
-
     try:
-        results = query.all()
-        transaction_list = []
-        for transaction, sending_branch_name, destination_branch_name in results:
-            transaction_dict = {
-                "id": transaction.id,
-                "sender": transaction.sender,
-                "sender_mobile": transaction.sender_mobile,
-                "sender_governorate": transaction.sender_governorate,
-                "receiver": transaction.receiver,
-                "receiver_mobile": transaction.receiver_mobile,
-                "receiver_governorate": transaction.receiver_governorate,
-                "amount": transaction.amount,
-                "base_amount": transaction.base_amount,
-                "benefited_amount": transaction.benefited_amount,
-                "tax_rate": transaction.tax_rate,
-                "tax_amount": transaction.tax_amount,
-                "currency": transaction.currency,
-                "message": transaction.message,
-                "employee_name": transaction.employee_name,
-                "branch_governorate": transaction.branch_governorate,
-                "branch_id": transaction.branch_id,
-                "destination_branch_id": transaction.destination_branch_id,
-                "employee_id": transaction.employee_id,
-                "status": transaction.status,
-                "date": transaction.date,
-                "is_received": transaction.is_received,
-                "sending_branch_name": sending_branch_name,
-                "destination_branch_name": destination_branch_name
-            }
-            transaction_list.append(transaction_dict)
-
-        return {
-            "items": transaction_list,
+        total = count_transactions(db, filters)
+        rows = transaction_page(db, filters, selected, (page - 1) * per_page, per_page)
+        to_dicts = transaction_list_rows if fields is None else row_mapper(selected)
+        return FastJSONResponse({
+            "items": to_dicts(rows),
             "total": total,
             "page": page,
             "per_page": per_page,
             "total_pages": (total + per_page - 1) // per_page
-        }
+        })
 
     except sqlalchemy.exc.SQLAlchemyError as e:
         raise HTTPException(
@@ -1323,6 +1740,45 @@ def get_transactions(
             detail=f"Unexpected error occurred: {str(e)}"
         )
 
+def transaction_report_filters(
+    current_user: dict,
+    start_date: str = None,
+    end_date: str = None,
+    branch_id: int = None,
+    destination_branch_id: int = None,
+    status: str = None
+):
+    """The role checks and filters shared by the transaction report and its export"""
+    # Authorization check
+    if current_user["role"] not in ["director", "branch_manager"]:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+
+    # Branch managers can only access their branch's data
+    if current_user["role"] == "branch_manager":
+        # إذا كان يبحث عن صادر (branch_id)، يجب أن يكون فرعه فقط
+        if branch_id is not None:
+            if branch_id != current_user["branch_id"]:
+                raise HTTPException(status_code=403, detail="Can only access your branch's data")
+            branch_id = current_user["branch_id"]
+
+    return compile_transaction_filters(
+        current_user,
+        branch_id=branch_id,
+        destination_branch_id=destination_branch_id,
+        status=status,
+        start_date=start_date,
+        end_date=end_date
+    )
+
+EXPORT_COLUMNS = [
+    "id", "sender", "receiver", "amount", "currency", "date", "status",
+    "branch_id", "destination_branch_id", "employee_name",
+    "sending_branch_name", "destination_branch_name", "branch_governorate",
+    "is_received", "tax_amount", "tax_rate", "benefited_amount"
+]
+
+transaction_report_rows = row_mapper(EXPORT_COLUMNS)
+
 @app.get("/reports/transactions/")
 def get_transactions_report(
     db: Session = Depends(get_db),
@@ -1336,97 +1792,19 @@ def get_transactions_report(
     per_page: int = 10
 ):
     try:
-        # Authorization check
-        if current_user["role"] not in ["director", "branch_manager"]:
-            raise HTTPException(status_code=403, detail="Not enough permissions")
-
-        # Branch managers can only access their branch's data
-        if current_user["role"] == "branch_manager":
-            # إذا كان يبحث عن صادر (branch_id)، يجب أن يكون فرعه فقط
-            if branch_id is not None:
-                if branch_id != current_user["branch_id"]:
-                    raise HTTPException(status_code=403, detail="Can only access your branch's data")
-                branch_id = current_user["branch_id"]
-
-        # Calculate offset for pagination
-        offset = (page - 1) * per_page
-
-        # Build base query with joins for branch names
-        SendingBranch = aliased(Branch)
-        DestinationBranch = aliased(Branch)
-        
-        query = db.query(
-            Transaction,
-            SendingBranch.name.label('sending_branch_name'),
-            DestinationBranch.name.label('destination_branch_name')
-        ).outerjoin(
-            SendingBranch, Transaction.branch_id == SendingBranch.id
-        ).outerjoin(
-            DestinationBranch, Transaction.destination_branch_id == DestinationBranch.id
+        filters = transaction_report_filters(
+            current_user, start_date, end_date, branch_id, destination_branch_id, status
         )
+        total = count_transactions(db, filters)
+        rows = transaction_page(db, filters, EXPORT_COLUMNS, (page - 1) * per_page, per_page, unknown_branch="غير معروف")
 
-        # Add filters
-        if branch_id:
-            query = query.filter(Transaction.branch_id == branch_id)
-        if destination_branch_id:
-            query = query.filter(Transaction.destination_branch_id == destination_branch_id)
-        if status:
-            query = query.filter(Transaction.status == status)
-        if start_date:
-            try:
-                start = datetime.strptime(start_date, "%Y-%m-%d")
-                query = query.filter(Transaction.date >= start)
-            except ValueError:
-                raise HTTPException(status_code=400, detail="Invalid start_date format. Use YYYY-MM-DD")
-        if end_date:
-            try:
-                end = datetime.strptime(end_date, "%Y-%m-%d")
-                end = end.replace(hour=23, minute=59, second=59)
-                query = query.filter(Transaction.date <= end)
-            except ValueError:
-                raise HTTPException(status_code=400, detail="Invalid end_date format. Use YYYY-MM-DD")
-
-        # Get total count for pagination
-        total = query.count()
-
-        # Add sorting and pagination
-        query = query.order_by(Transaction.date.desc())
-        query = query.offset(offset).limit(per_page)
-
-        # Execute query
-        results = query.all()
-
-        # Format results
-        transactions = []
-        for transaction, sending_branch_name, destination_branch_name in results:
-            transaction_dict = {
-                "id": transaction.id,
-                "sender": transaction.sender,
-                "receiver": transaction.receiver,
-                "amount": transaction.amount,
-                "currency": transaction.currency,
-                "date": transaction.date.isoformat(),
-                "status": transaction.status,
-                "branch_id": transaction.branch_id,
-                "destination_branch_id": transaction.destination_branch_id,
-                "employee_name": transaction.employee_name,
-                "sending_branch_name": sending_branch_name or "غير معروف",
-                "destination_branch_name": destination_branch_name or "غير معروف",
-                "branch_governorate": transaction.branch_governorate,
-                "is_received": transaction.is_received,
-                "tax_amount": transaction.tax_amount,
-                "tax_rate": transaction.tax_rate,
-                "benefited_amount": transaction.benefited_amount
-            }
-            transactions.append(transaction_dict)
-
-        return {
-            "items": transactions,
+        return FastJSONResponse({
+            "items": transaction_report_rows(rows),
             "total": total,
             "page": page,
             "per_page": per_page,
             "total_pages": (total + per_page - 1) // per_page
-        }
+        })
 
     except HTTPException:
         raise
@@ -1437,6 +1815,75 @@ def get_transactions_report(
             detail=f"Internal server error: {str(e)}"
         )
 
+@app.get("/reports/transactions/export/")
+def export_transactions_report(
+    request: Request,
+    current_user: dict = Depends(get_current_user),
+    format: str = "csv",
+    start_date: str = None,
+    end_date: str = None,
+    branch_id: int = None,
+    destination_branch_id: int = None,
+    status: str = None
+):
+    """Stream the filtered transaction report as CSV, NDJSON or XLSX.
+
+    Rows are read through a server-side cursor and encoded as they arrive, so
+    memory use does not depend on the size of the export.
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format. Use: {', '.join(EXPORT_FORMATS)}")
+
+    # The request-scoped session is closed before the body is sent, so the
+    # stream owns its own (read-only) session; filters are applied (and validated)
+    # here so permission and date errors are raised before streaming starts
+    db = ReaderSessionLocal()
+    try:
+        query = db.query(
+            Transaction.id,
+            Transaction.sender,
+            Transaction.receiver,
+            Transaction.amount,
+            Transaction.currency,
+            Transaction.date,
+            Transaction.status,
+            Transaction.branch_id,
+            Transaction.destination_branch_id,
+            TransactionDetails.employee_name,
+            TransactionDetails.branch_governorate,
+            Transaction.is_received,
+            Transaction.tax_amount,
+            Transaction.tax_rate,
+            Transaction.benefited_amount
+        ).outerjoin(TransactionDetails, TransactionDetails.transaction_id == Transaction.id)
+        query = query.filter(*transaction_report_filters(
+            current_user, start_date, end_date, branch_id, destination_branch_id, status
+        ))
+    except Exception:
+        db.close()
+        raise
+
+    def rows():
+        try:
+            for tx in query.order_by(Transaction.date.desc(), Transaction.id.desc()).yield_per(EXPORT_BATCH_SIZE):
+                yield (
+                    tx.id, tx.sender, tx.receiver, tx.amount, tx.currency, tx.date, tx.status,
+                    tx.branch_id, tx.destination_branch_id, tx.employee_name,
+                    branch_directory.name(tx.branch_id, "غير معروف"),
+                    branch_directory.name(tx.destination_branch_id, "غير معروف"),
+                    tx.branch_governorate, tx.is_received, tx.tax_amount, tx.tax_rate, tx.benefited_amount
+                )
+        finally:
+            db.close()
+
+    filename = f"transactions_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    response = streaming_export(
+        EXPORT_COLUMNS, rows(), format, filename, request.headers.get("accept-encoding", "")
+    )
+    # Also release the session if the client goes away before streaming starts
+    response.background = BackgroundTask(db.close)
+    return response
+
 @app.get("/reports/employees/")
 def get_employees_report(
     db: Session = Depends(get_db),
@@ -1463,7 +1910,7 @@ def get_employees_report(
         if branch_id:
             query = query.filter(User.branch_id == branch_id)
         if role:
-            query = query.filter(User.role == role)
+            query = query.filter(coded_equals(User.role, role))
         # Only filter by is_active if status is not None
         if status is not None:
             # Some databases may not have is_active, so use getattr with default True
@@ -1479,13 +1926,12 @@ def get_employees_report(
 
         employee_list = []
         for employee in employees:
-            branch = db.query(Branch).filter(Branch.id == employee.branch_id).first()
             employee_dict = {
                 "id": employee.id,
                 "username": employee.username,
                 "role": employee.role,
                 "branch_id": employee.branch_id,
-                "branch_name": branch.name if branch else "غير معروف",
+                "branch_name": branch_directory.name(employee.branch_id, "غير معروف"),
                 "created_at": employee.created_at.isoformat() if employee.created_at else None,
                 "is_active": getattr(employee, 'is_active', True)
             }
@@ -1553,6 +1999,7 @@ async def update_user(
 
     db.commit()
     db.refresh(db_user)
+    resource_versions.bump("users")
     
     return {
         "id": db_user.id,
@@ -1561,130 +2008,188 @@ async def update_user(
         "branch_id": db_user.branch_id
     }
 
-# Add this function to handle profit recording
+def branch_profit_entries(transaction: Transaction) -> List[BranchProfits]:
+    """The ledger entries a completed transaction books: its profit and the tax on it."""
+    # Important: We only calculate profits based on benefited_amount, not the total amount
+    if transaction.benefited_amount <= 0:
+        logger.info(f"No benefited amount for transaction {transaction.id}, skipping profit calculation")
+        return []
+
+    entries = []
+
+    # Calculate profit from benefited amount only
+    tax_on_benefited = transaction.benefited_amount * (transaction.tax_rate / 100)
+    profit_from_benefited = transaction.benefited_amount - tax_on_benefited
+
+    # Create profit record for benefited amount
+    if profit_from_benefited > 0:
+        entries.append(BranchProfits(
+            branch_id=transaction.branch_id,
+            transaction_id=transaction.id,
+            profit_amount=profit_from_benefited,
+            currency=transaction.currency,
+            source_type='benefited_amount',
+            date=transaction.date
+        ))
+
+    # Record tax amount as separate profit
+    if tax_on_benefited > 0:
+        entries.append(BranchProfits(
+            branch_id=transaction.branch_id,
+            transaction_id=transaction.id,
+            profit_amount=tax_on_benefited,
+            currency=transaction.currency,
+            source_type='tax',
+            date=transaction.date
+        ))
+
+    # Add audit log entry
+    logger.info(
+        f"Transaction {transaction.id} profits:"
+        f"\nTotal Amount: {transaction.amount} {transaction.currency}"
+        f"\nBenefited Amount: {transaction.benefited_amount} {transaction.currency}"
+        f"\nTax Rate: {transaction.tax_rate}%"
+        f"\nTax on Benefited: {tax_on_benefited} {transaction.currency}"
+        f"\nProfit from Benefited: {profit_from_benefited} {transaction.currency}"
+    )
+    return entries
+
+def record_branch_profits(db: Session, transactions: List[Transaction]):
+    """Book the profits of completed transactions in the caller's transaction (committed with it).
+
+    The ledger rows go out as one bulk INSERT, followed by one rollup upsert
+    and one top-N update per branch.
+    """
+    entries = [entry for transaction in transactions for entry in branch_profit_entries(transaction)]
+    if not entries:
+        return
+    db.add_all(entries)
+    db.flush()
+    # Rollups and top-N change in the same transaction as the ledger
+    record_profits(db, entries)
+
 def record_branch_profit(db: Session, transaction: Transaction):
     """Record profit for a completed transaction."""
-    try:
-        # Important: We only calculate profits based on benefited_amount, not the total amount
-        if transaction.benefited_amount <= 0:
-            logger.info(f"No benefited amount for transaction {transaction.id}, skipping profit calculation")
-            return
-
-        # Calculate profit from benefited amount only
-        tax_on_benefited = transaction.benefited_amount * (transaction.tax_rate / 100)
-        profit_from_benefited = transaction.benefited_amount - tax_on_benefited
-        
-        # Create profit record for benefited amount
-        if profit_from_benefited > 0:
-            benefited_profit = BranchProfits(
-                branch_id=transaction.branch_id,
-                transaction_id=transaction.id,
-                profit_amount=profit_from_benefited,
-                currency=transaction.currency,
-                source_type='benefited_amount',
-                date=transaction.date
-            )
-            db.add(benefited_profit)
-            logger.info(f"Recorded profit from benefited amount: {profit_from_benefited} {transaction.currency}")
-        
-        # Record tax amount as separate profit
-        if tax_on_benefited > 0:
-            tax_profit = BranchProfits(
-                branch_id=transaction.branch_id,
-                transaction_id=transaction.id,
-                profit_amount=tax_on_benefited,
-                currency=transaction.currency,
-                source_type='tax',
-                date=transaction.date
-            )
-            db.add(tax_profit)
-            logger.info(f"Recorded profit from tax: {tax_on_benefited} {transaction.currency}")
-        
-        # Add audit log entry
-        logger.info(
-            f"Transaction {transaction.id} profits:"
-            f"\nTotal Amount: {transaction.amount} {transaction.currency}"
-            f"\nBenefited Amount: {transaction.benefited_amount} {transaction.currency}"
-            f"\nTax Rate: {transaction.tax_rate}%"
-            f"\nTax on Benefited: {tax_on_benefited} {transaction.currency}"
-            f"\nProfit from Benefited: {profit_from_benefited} {transaction.currency}"
-        )
-        
-        db.commit()
-    except Exception as e:
-        logger.error(f"Error recording branch profit: {str(e)}")
-        db.rollback()
-        raise
+    record_branch_profits(db, [transaction])
+
+# Notification state that follows each transaction status
+NOTIFICATION_STATUS = {
+    "completed": "sent",
+    "cancelled": "failed",
+    "rejected": "failed",
+    "processing": "pending",
+    "pending": "pending"
+}
+
+def profit_transition(old_status: str, new_status: str) -> Optional[str]:
+    """'record' or 'remove' when a status change books or reverses a transaction's profits"""
+    if old_status == "processing" and new_status == "completed":
+        return "record"
+    if old_status in ["processing", "completed"] and new_status in ["cancelled", "rejected"]:
+        return "remove"
+    return None
+
+def invalidate_transaction_caches(transaction_ids, branch_ids):
+    """Drop the cached transactions and their branches' entries, in one Redis round trip, and bump their versions"""
+    branch_ids = set(branch_ids)
+    cache.invalidate(
+        keys=[get_branch_cache_key(branch) for branch in branch_ids]
+        + [get_transaction_cache_key(transaction_id) for transaction_id in transaction_ids],
+        patterns=[f"branch_transactions:{branch}:*" for branch in branch_ids]
+    )
+    transactions_changed(branch_ids)
 
 @app.post("/update-transaction-status/")
 def update_transaction_status(
     status_update: TransactionStatus, 
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)
 ):
+    """Change a transaction's status, with compare-and-swap on its version (see transitions.py).
+
+    Nothing is locked while profits are booked or reversed; the status is
+    written last, and if another request changed the transaction in between,
+    the whole update is rolled back and tried again on a fresh read.
+    """
+    response = {"status": "success", "message": "Status updated successfully"}
+    record = None
+    if idempotency_key is not None:
+        scope, key, fingerprint, stored = idempotent_request(
+            "update-transaction-status", idempotency_key, status_update.model_dump(), current_user
+        )
+        if stored is not None:
+            return replay(stored, fingerprint)
+        record = idempotency_store.record(scope, key, fingerprint, 200, response)
     try:
-        transaction = db.query(Transaction).filter(
-            Transaction.id == status_update.transaction_id
-        ).with_for_update().first()
-        
-        if not transaction:
-            raise HTTPException(status_code=404, detail="Transaction not found")
-        
-        branch_id = transaction.branch_id
-        amount = transaction.amount
-        old_status = transaction.status
-        dest_branch_id = transaction.destination_branch_id
-        new_status = status_update.status
-
-        # Authorization check
-        if current_user["role"] == "branch_manager":
-            if branch_id != current_user["branch_id"] and dest_branch_id != current_user["branch_id"]:
-                raise HTTPException(
-                    status_code=403,
-                    detail="Not authorized to modify this transaction"
-                )
-
-        # Handle profits
-        if old_status == "processing" and new_status == "completed":
-            # Record profits when transaction is completed
-            record_branch_profit(db, transaction)
-        elif (
-            (old_status == "processing" and new_status in ["cancelled", "rejected"]) or
-            (old_status == "completed" and new_status in ["cancelled", "rejected"])
-        ):
-            # Remove profit records if transaction is cancelled/rejected
-            db.query(BranchProfits).filter(
-                BranchProfits.transaction_id == transaction.id
-            ).delete()
-
-        # Update transaction status
-        transaction.status = new_status
-
-        # Update notification status
-        notification_status = {
-            "completed": "sent",
-            "cancelled": "failed",
-            "rejected": "failed",
-            "processing": "pending",
-            "pending": "pending"
-        }.get(new_status, "pending")
-        
-        notification = db.query(Notification).filter(
-            Notification.transaction_id == status_update.transaction_id
-        ).first()
-        if notification:
-            notification.status = notification_status
+        for attempt in range(STATUS_UPDATE_RETRIES + 1):
+            transaction = db.query(Transaction).filter(
+                Transaction.id == status_update.transaction_id
+            ).first()
+            
+            if not transaction:
+                raise HTTPException(status_code=404, detail="Transaction not found")
+            
+            branch_id = transaction.branch_id
+            old_status = transaction.status
+            dest_branch_id = transaction.destination_branch_id
+            new_status = status_update.status
+
+            # Authorization check
+            if current_user["role"] == "branch_manager":
+                if branch_id != current_user["branch_id"] and dest_branch_id != current_user["branch_id"]:
+                    raise HTTPException(
+                        status_code=403,
+                        detail="Not authorized to modify this transaction"
+                    )
+
+            if record is not None:
+                # Taken first, so a concurrent retry waits here and then replays this response
+                try:
+                    db.execute(idempotency_store.insert_statement(record))
+                except sqlalchemy.exc.IntegrityError as e:
+                    if not is_key_conflict(e):
+                        raise
+                    db.rollback()
+                    return replay_stored(scope, key, fingerprint)
+
+            # Handle profits
+            transition = profit_transition(old_status, new_status)
+            if transition == "record":
+                # Record profits when transaction is completed
+                record_branch_profit(db, transaction)
+            elif transition == "remove":
+                # Remove profit records if transaction is cancelled/rejected
+                remove_transaction_profits(db, transaction.id)
+
+            # Update notification status
+            db.query(Notification).filter(
+                Notification.transaction_id == transaction.id
+            ).update({Notification.status: NOTIFICATION_STATUS.get(new_status, "pending")}, synchronize_session=False)
+
+            # Update transaction status, unless someone else got there first
+            if compare_and_set(db, transaction, status=new_status):
+                break
+            db.rollback()
+            logger.info(f"Status update of {status_update.transaction_id} lost a race (attempt {attempt + 1})")
+        else:
+            raise HTTPException(
+                status_code=409,
+                detail="Transaction was modified by another request, please try again"
+            )
 
         try:
             db.commit()
-            # Invalidate relevant caches
-            cache.clear_pattern(f"branch_transactions:{branch_id}:*")
-            cache.clear_pattern(f"branch_transactions:{dest_branch_id}:*")
-            cache.delete(get_branch_cache_key(branch_id))
-            cache.delete(get_branch_cache_key(dest_branch_id))
-            cache.delete(get_transaction_cache_key(status_update.transaction_id))
+            if record is not None:
+                idempotency_store.remember(record)
+            invalidate_transaction_caches([status_update.transaction_id], [branch_id, dest_branch_id])
+            event_broker.emit(
+                "transactions", "transaction.status", [branch_id, dest_branch_id],
+                transaction_id=normalize_transaction_id(status_update.transaction_id),
+                status=new_status, old_status=old_status
+            )
             
-            return {"status": "success", "message": "Status updated successfully"}
+            return response
         except Exception as e:
             db.rollback()
             raise HTTPException(
@@ -1703,6 +2208,118 @@ def update_transaction_status(
             detail=f"Unexpected error: {str(e)}"
         )
 
+# Transactions changed by one bulk status update
+BULK_STATUS_MAX = int(os.getenv("BULK_STATUS_MAX", "500"))
+
+@app.post("/update-transaction-status/bulk/")
+def update_transaction_status_bulk(
+    bulk: TransactionStatusBulk,
+    current_user: dict = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Apply many status changes in one database transaction.
+
+    Like the single update, profits are booked first and the statuses are
+    compare-and-swapped last, here in id order so overlapping bulk updates
+    take their row locks in the same order. If any of the transactions changed
+    in between, the batch is rolled back and retried on a fresh read. Missing
+    or unauthorized items are reported and skipped; everything else commits
+    together, followed by a single cache invalidation.
+    """
+    if len(bulk.updates) > BULK_STATUS_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_STATUS_MAX} transactions per request")
+
+    duplicates = {}
+    requested = {}
+    for index, update in enumerate(bulk.updates):
+        transaction_id = normalize_transaction_id(update.transaction_id)
+        if transaction_id in requested:
+            duplicates[index] = {"index": index, "transaction_id": update.transaction_id, "status": "error",
+                                 "detail": "Transaction appears more than once in the request"}
+            continue
+        requested[transaction_id] = (index, update)
+
+    try:
+        for attempt in range(STATUS_UPDATE_RETRIES + 1):
+            results = dict(duplicates)
+            found = {
+                transaction.id: transaction
+                for transaction in db.query(Transaction).filter(Transaction.id.in_(list(requested))).all()
+            }
+
+            changes, completed, reversed_ids, branch_ids = [], [], [], set()
+            notification_updates = defaultdict(list)
+            for transaction_id, (index, update) in requested.items():
+                transaction = found.get(transaction_id)
+                if transaction is None:
+                    results[index] = {"index": index, "transaction_id": update.transaction_id, "status": "error",
+                                      "detail": "Transaction not found"}
+                    continue
+                # Authorization check
+                if current_user["role"] == "branch_manager" and current_user["branch_id"] not in (
+                    transaction.branch_id, transaction.destination_branch_id
+                ):
+                    results[index] = {"index": index, "transaction_id": update.transaction_id, "status": "error",
+                                      "detail": "Not authorized to modify this transaction"}
+                    continue
+
+                transition = profit_transition(transaction.status, update.status)
+                if transition == "record":
+                    completed.append(transaction)
+                elif transition == "remove":
+                    reversed_ids.append(transaction.id)
+                results[index] = {"index": index, "transaction_id": update.transaction_id, "status": "updated",
+                                  "old_status": transaction.status, "new_status": update.status}
+                notification_updates[NOTIFICATION_STATUS.get(update.status, "pending")].append(transaction.id)
+                changes.append((transaction, update.status, transaction.status))
+                branch_ids.update((transaction.branch_id, transaction.destination_branch_id))
+
+            # Reversals first: refilling a top-N list reads the ledger
+            remove_profits(db, reversed_ids)
+            record_branch_profits(db, completed)
+            for notification_status, transaction_ids in notification_updates.items():
+                db.query(Notification).filter(
+                    Notification.transaction_id.in_(transaction_ids)
+                ).update({Notification.status: notification_status}, synchronize_session=False)
+            changes.sort(key=lambda change: change[0].id)
+            if all(compare_and_set(db, transaction, status=new_status) for transaction, new_status, _ in changes):
+                break
+            db.rollback()
+            logger.info(f"Bulk status update of {len(changes)} transactions lost a race (attempt {attempt + 1})")
+        else:
+            raise HTTPException(
+                status_code=409,
+                detail="Some of the transactions were modified by another request, please try again"
+            )
+        changed_ids = [transaction.id for transaction, _, _ in changes]
+        status_events = [
+            event("transactions", "transaction.status", [transaction.branch_id, transaction.destination_branch_id],
+                  transaction_id=transaction.id, status=new_status, old_status=old_status)
+            for transaction, new_status, old_status in changes
+        ]
+        db.commit()
+    except HTTPException:
+        db.rollback()
+        raise
+    except Exception as e:
+        db.rollback()
+        print(f"Error in update_transaction_status_bulk: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Unexpected error: {str(e)}"
+        )
+
+    if changed_ids:
+        branch_ids.discard(None)
+        invalidate_transaction_caches(changed_ids, branch_ids)
+        event_broker.publish(status_events)
+    updated = len(changed_ids)
+    return {
+        "updated": updated,
+        "failed": len(results) - updated,
+        "results": [results[index] for index in sorted(results)]
+    }
+
 @app.post("/reset-password/")
 def reset_password(reset_data: PasswordReset, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
     # Only directors and branch managers can reset passwords
@@ -1754,6 +2371,7 @@ def delete_user(user_id: int, db: Session = Depends(get_db), current_user: dict
             raise HTTPException(status_code=403, detail="You can only delete employees in your branch")
     db.delete(user)
     db.commit()
+    resource_versions.bump("users")
     return {"status": "success", "message": "User deleted successfully"}
 
 @app.delete("/branches/{branch_id}/")
@@ -1767,6 +2385,10 @@ def delete_branch(branch_id: int, db: Session = Depends(get_db), current_user: d
         raise HTTPException(status_code=400, detail="Cannot delete branch with assigned users")
     db.delete(branch)
     db.commit()
+    branch_directory.publish_change()
+    event_broker.emit("branches", "branch.deleted", branch_id=branch_id)
+    cache.delete(get_branch_cache_key(branch_id))
+    resource_versions.bump("branches", "users", branch_version(branch_id))
     return {"status": "success", "message": "Branch deleted successfully"}
 
 @app.get("/branches/stats/")
@@ -1813,7 +2435,11 @@ def get_branch_stats(
         )
 
 @app.get("/users/stats/")
-def get_user_stats(db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+def get_user_stats(request: Request, response: Response, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+    not_modified = conditional_get(request, response, ["users"])
+    if not_modified:
+        return not_modified
+
     # Get total number of users
     total_users = db.query(User).count()
     
@@ -1968,7 +2594,7 @@ def get_transaction(transaction_id: str, db: Session = Depends(get_db), current_
         SendingBranch, Transaction.branch_id == SendingBranch.id
     ).outerjoin(
         DestinationBranch, Transaction.destination_branch_id == DestinationBranch.id
-    ).filter(Transaction.id == transaction_id).first()
+    ).options(joinedload(Transaction.details)).filter(Transaction.id == transaction_id).first()
     if not result:
         raise HTTPException(status_code=404, detail="Transaction not found")
     transaction, sending_branch_name, destination_branch_name = result
@@ -2004,36 +2630,69 @@ def get_transaction(transaction_id: str, db: Session = Depends(get_db), current_
     }
     return transaction_dict
 
+NOTIFICATION_FEED_COLUMNS = (
+    Notification.id, Notification.transaction_id, Notification.recipient_phone,
+    Notification.message, Notification.status, Notification.created_at
+)
+notification_rows = row_mapper(
+    ("id", "transaction_id", "recipient_phone", "message", "status", "created_at"), created_at=format_timestamp
+)
+
 @app.get("/notifications/")
-def get_notifications(db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    """Get notifications for the current user's branch"""
-    # Build base query
-    query = db.query(Notification).join(
-        Transaction, Notification.transaction_id == Transaction.id
-    )
-    
+def get_notifications(
+    since: Optional[str] = None,
+    limit: int = 100,
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """Notifications for the current user's branch, as a cursor-paged feed.
+
+    Without `since`: the newest `limit`, newest first. Pass the returned
+    next_cursor as `since` to get only what was added after them, oldest first
+    (has_more means poll again straight away).
+    """
     # Branch managers can only see notifications from their branch
-    if current_user["role"] == "branch_manager":
-        query = query.filter(Transaction.branch_id == current_user["branch_id"])
-    
-    # Order by created_at descending
-    query = query.order_by(Notification.created_at.desc())
-    
-    notifications = query.all()
-    
-    notification_list = []
-    for notification in notifications:
-        notification_dict = {
-            "id": notification.id,
-            "transaction_id": notification.transaction_id,
-            "recipient_phone": notification.recipient_phone,
-            "message": notification.message,
-            "status": notification.status,
-            "created_at": notification.created_at.strftime("%Y-%m-%d %H:%M:%S") if notification.created_at else None
-        }
-        notification_list.append(notification_dict)
-    
-    return {"notifications": notification_list}
+    branch_id = current_user["branch_id"] if current_user["role"] == "branch_manager" else None
+    try:
+        rows, next_cursor, has_more = notification_feed(
+            db, branch_id=branch_id, since=since, limit=limit, columns=NOTIFICATION_FEED_COLUMNS
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return FastJSONResponse({"notifications": notification_rows(rows), "next_cursor": next_cursor, "has_more": has_more})
+
+@app.get("/notifications/metrics/")
+def get_notification_metrics(current_user: dict = Depends(get_current_user)):
+    """Delivery throughput and queue lag; counters are this API worker's, the queue is shared"""
+    if current_user["role"] != "director":
+        raise HTTPException(status_code=403, detail="Director access required")
+    return notification_dispatcher.metrics()
+
+@app.get("/events/")
+async def stream_events(request: Request, topics: Optional[str] = None, access_token: Optional[str] = None):
+    """Server-Sent Events for dashboards: transaction, branch and fund changes the user may see.
+
+    Directors get every event; everyone else gets the events of their own
+    branch, plus branch list changes. `topics` narrows the stream (comma
+    separated: transactions, branches, funds). EventSource cannot send an
+    Authorization header, so the token may also come as ?access_token=.
+    """
+    authorization = request.headers.get("Authorization", "")
+    token = authorization[7:] if authorization.lower().startswith("bearer ") else access_token
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    current_user = get_current_user(token)
+    wanted = [topic.strip() for topic in topics.split(",") if topic.strip()] if topics else list(EVENT_TOPICS)
+    unknown = set(wanted) - set(EVENT_TOPICS)
+    if unknown or not wanted:
+        raise HTTPException(status_code=400, detail=f"topics must be among: {', '.join(EVENT_TOPICS)}")
+    subscription = event_broker.subscribe(current_user, wanted)
+    return StreamingResponse(
+        event_broker.stream(subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.get("/reports/{report_type}/")
 def get_report(
@@ -2058,6 +2717,18 @@ def get_report(
         except ValueError:
             raise HTTPException(status_code=400, detail="Invalid end_date format. Use YYYY-MM-DD")
     
+    if report_type not in ("daily", "branch", "currency"):
+        raise HTTPException(status_code=400, detail="Invalid report type")
+
+    scope_branch_id = current_user["branch_id"] if current_user["role"] == "branch_manager" else branch_id
+    # Closed periods are answered from the Parquet snapshot instead of scanning transactions
+    if analytics_snapshot.covers(end_date):
+        try:
+            partial = analytics_snapshot.report_partial(report_type, start_date, end_date, scope_branch_id)
+            return merge_partials({"report_type": report_type}, [partial])
+        except Exception as e:
+            logger.warning(f"Analytics snapshot unavailable for {report_type} report, using SQL: {str(e)}")
+
     # Base query
     query = db.query(Transaction)
     
@@ -2128,9 +2799,6 @@ def get_report(
             currency_data[transaction.currency]["count"] += 1
         
         return {"currency_report": currency_data}
-    
-    else:
-        raise HTTPException(status_code=400, detail="Invalid report type")
 
 # Tax-related endpoints
 class TaxRateUpdate(BaseModel):
@@ -2171,6 +2839,10 @@ def update_branch_tax_rate(
         
         branch.tax_rate = tax_data.tax_rate
         db.commit()
+        branch_directory.publish_change()
+        event_broker.emit("branches", "branch.updated", branch_id=branch_id, tax_rate=tax_data.tax_rate)
+        cache.delete(get_branch_cache_key(branch_id))
+        resource_versions.bump("branches")
         
         return {
             "id": branch.id,
@@ -2208,6 +2880,15 @@ def get_branch_tax_rate(
         "tax_rate": branch.tax_rate
     }
 
+def branch_display_name(branch_id) -> str:
+    return branch_directory.name(branch_id, str(branch_id))
+
+tax_summary_rows = row_mapper(
+    ("id", "date", "amount", "benefited_amount", "tax_rate", "tax_amount", "currency",
+     "source_branch", "destination_branch", "status", "profit"),
+    source_branch=branch_display_name, destination_branch=branch_display_name
+)
+
 @app.get("/api/transactions/tax_summary/")
 def tax_summary_endpoint(
     start_date: str,
@@ -2222,8 +2903,35 @@ def tax_summary_endpoint(
         end = datetime.strptime(end_date, "%Y-%m-%d")
         end = end.replace(hour=23, minute=59, second=59, microsecond=999999)
 
-        # Build base query for transactions
-        tx_query = db.query(Transaction)
+        scope_branch_id = branch_id or (current_user["branch_id"] if current_user["role"] == "branch_manager" else None)
+        if analytics_snapshot.covers(end):
+            try:
+                partial = analytics_snapshot.report_partial("tax_summary", start, end, scope_branch_id)
+                return merge_partials(
+                    {"report_type": "tax_summary", "start_date": start_date, "end_date": end_date}, [partial]
+                )
+            except Exception as e:
+                logger.warning(f"Analytics snapshot unavailable for tax summary, using SQL: {str(e)}")
+
+        # Build base query for transactions, as the columns the response needs
+        benefited = func.coalesce(Transaction.benefited_amount, 0)
+        tx_query = db.query(
+            Transaction.id,
+            cast(Transaction.date, Date).label("date"),
+            Transaction.amount,
+            Transaction.benefited_amount,
+            Transaction.tax_rate,
+            Transaction.tax_amount,
+            Transaction.currency,
+            Transaction.branch_id.label("source_branch"),
+            Transaction.destination_branch_id.label("destination_branch"),
+            Transaction.status,
+            # حساب الربح: إذا كان الفرع هو المدير (id==0) الربح = benefited_amount، غير ذلك الربح = benefited_amount - tax_amount
+            case(
+                (Transaction.branch_id == 0, benefited),
+                else_=benefited - func.coalesce(Transaction.tax_amount, 0)
+            ).label("profit")
+        )
         if branch_id:
             tx_query = tx_query.filter(
                 (Transaction.branch_id == branch_id) | (Transaction.destination_branch_id == branch_id)
@@ -2248,10 +2956,10 @@ def tax_summary_endpoint(
         # Prepare branch summary
         branch_summary_dict = {}
         for tx in transactions:
-            b_id = tx.branch_id
+            b_id = tx.source_branch
             currency = tx.currency or "SYP"
             if b_id not in branch_summary_dict:
-                branch = db.query(Branch).filter(Branch.id == b_id).first()
+                branch = branch_directory.get(b_id)
                 branch_summary_dict[b_id] = {
                     "branch_id": b_id,
                     "branch_name": branch.name if branch else str(b_id),
@@ -2269,38 +2977,12 @@ def tax_summary_endpoint(
             summary["benefited_amount"] += tx.benefited_amount or 0
             summary["tax_amount"] += tx.tax_amount or 0
             summary["currency"] = currency
-            # حساب الربح: إذا كان الفرع هو المدير (id==0) الربح = benefited_amount، غير ذلك الربح = benefited_amount - tax_amount
-            if b_id == 0:
-                profit = tx.benefited_amount or 0
-            else:
-                profit = (tx.benefited_amount or 0) - (tx.tax_amount or 0)
-            summary["profit"] += profit
-            total_profit += profit
+            summary["profit"] += tx.profit
+            total_profit += tx.profit
         branch_summary = list(branch_summary_dict.values())
 
         # Prepare transactions list for frontend
-        tx_list = []
-        for tx in transactions:
-            sending_branch = db.query(Branch).filter(Branch.id == tx.branch_id).first()
-            destination_branch = db.query(Branch).filter(Branch.id == tx.destination_branch_id).first()
-            # حساب الربح لكل عملية
-            if tx.branch_id == 0:
-                profit = tx.benefited_amount or 0
-            else:
-                profit = (tx.benefited_amount or 0) - (tx.tax_amount or 0)
-            tx_list.append({
-                "id": tx.id,
-                "date": tx.date.strftime("%Y-%m-%d"),
-                "amount": tx.amount,
-                "benefited_amount": tx.benefited_amount,
-                "tax_rate": tx.tax_rate,
-                "tax_amount": tx.tax_amount,
-                "currency": tx.currency,
-                "source_branch": sending_branch.name if sending_branch else str(tx.branch_id),
-                "destination_branch": destination_branch.name if destination_branch else str(tx.destination_branch_id),
-                "status": tx.status,
-                "profit": profit
-            })
+        tx_list = tax_summary_rows(transactions)
 
         response_data = {
             "start_date": start_date,
@@ -2313,7 +2995,7 @@ def tax_summary_endpoint(
             "branch_summary": branch_summary,
             "transactions": tx_list
         }
-        return response_data
+        return FastJSONResponse(response_data)
 
     except ValueError as e:
         raise HTTPException(
@@ -2365,9 +3047,12 @@ async def restore_backup(
     return {"status": "success", "message": "تمت الاستعادة بنجاح"}
 
 @app.get("/financial/total/")
-def get_total_financial_stats(db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+def get_total_financial_stats(request: Request, response: Response, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
     if current_user["role"] != "director":
         raise HTTPException(status_code=403, detail="Director access required")
+    not_modified = conditional_get(request, response, ["branches"])
+    if not_modified:
+        return not_modified
     total_syp = db.query(func.coalesce(func.sum(Branch.allocated_amount_syp), 0.0)).scalar()
     total_usd = db.query(func.coalesce(func.sum(Branch.allocated_amount_usd), 0.0)).scalar()
     return {
@@ -2376,10 +3061,13 @@ def get_total_financial_stats(db: Session = Depends(get_db), current_user: dict
     }
 
 @app.get("/activity/")
-def get_activity(db: Session = Depends(get_db), current_user: dict = Depends(get_current_user), limit: int = 20):
+def get_activity(request: Request, response: Response, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user), limit: int = 20):
     # المدير فقط يمكنه رؤية كل الأنشطة
     if current_user["role"] != "director":
         raise HTTPException(status_code=403, detail="Director access required")
+    not_modified = conditional_get(request, response, ["transactions"], limit)
+    if not_modified:
+        return not_modified
     activities = []
     transactions = db.query(Transaction).order_by(desc(Transaction.date)).limit(limit).all()
     for tx in transactions:
@@ -2391,79 +3079,98 @@ def get_activity(db: Session = Depends(get_db), current_user: dict = Depends(get
         })
     return {"activities": activities}
 
+def profit_ledger_filters(
+    branch_id: int,
+    start_date: Optional[str],
+    end_date: Optional[str],
+    currency: Optional[str],
+    source_type: Optional[str] = "benefited_amount"
+) -> list:
+    """Ledger predicates for the profit endpoints; end_date covers the whole day"""
+    try:
+        start = datetime.strptime(start_date, "%Y-%m-%d") if start_date else None
+        end = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1) if end_date else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+    return ledger_filters(branch_id, start, end, currency, source_type)
+
 @app.get("/api/branches/{branch_id}/profits/")
 async def get_branch_profits(
     branch_id: int,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     currency: Optional[str] = None,
+    page: int = Query(1, ge=1),
+    per_page: Optional[int] = Query(None, ge=1),
     db: Session = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
-    """Get profits for a specific branch with filters."""
+    """Get profits for a specific branch with filters.
+
+    Every matching ledger entry by default (the dashboard lists and exports
+    them all); pass per_page to get one page of entries at a time.
+    """
     # Authorization check
     if current_user["role"] != "branch_manager" or current_user["branch_id"] != branch_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Only branch managers can view their own branch profits"
         )
+    predicates = profit_ledger_filters(branch_id, start_date, end_date, currency)
 
     try:
-        # Build base query for transactions
-        query = db.query(Transaction).filter(
-            Transaction.branch_id == branch_id,  # Only outgoing transactions
-            Transaction.status == 'completed'    # Only completed transactions
-        )
-
-        # Apply date filters
-        if start_date:
-            query = query.filter(Transaction.date >= datetime.strptime(start_date, "%Y-%m-%d"))
-        if end_date:
-            query = query.filter(Transaction.date <= datetime.strptime(end_date, "%Y-%m-%d"))
+        # Totals over every matching entry, read from the ledger index alone
+        # (profit_amount is a 4-byte real; summed as double precision)
+        totals = {
+            entry_currency: (count, profit_sum)
+            for entry_currency, count, profit_sum in db.query(
+                BranchProfits.currency,
+                func.count(BranchProfits.id),
+                func.coalesce(func.sum(cast(BranchProfits.profit_amount, Float)), 0.0)
+            ).filter(*predicates).group_by(BranchProfits.currency).all()
+        }
+        total = sum(count for count, _ in totals.values())
 
-        # Apply currency filter
-        if currency:
-            query = query.filter(Transaction.currency == currency)
+        query = db.query(BranchProfits).filter(*predicates).order_by(
+            BranchProfits.date.desc(), BranchProfits.id.desc()
+        )
+        if per_page is not None:
+            query = query.offset((page - 1) * per_page).limit(per_page)
+        entries = query.all()
 
-        # Execute query
-        transactions = query.all()
+        # Rate and amount of the page's transactions, looked up by primary key
+        transactions = {
+            tx.id: tx for tx in db.query(
+                Transaction.id, Transaction.benefited_amount, Transaction.tax_rate, Transaction.status
+            ).filter(Transaction.id.in_([entry.transaction_id for entry in entries])).all()
+        } if entries else {}
 
-        # Calculate profits
-        total_syp = 0
-        total_usd = 0
         transaction_list = []
-
-        for tx in transactions:
-            # حساب الضريبة بشكل صحيح فقط على المبلغ المستفاد
-            tax_amount = tx.benefited_amount * (tx.tax_rate / 100)
-            benefited_profit = tx.benefited_amount - tax_amount
-            tax_profit = 0  # الضريبة ليست ربح للفرع المرسل
-            total_profit = benefited_profit
-
-            # تحديث الإجماليات
-            if tx.currency == "SYP":
-                total_syp += total_profit
-            elif tx.currency == "USD":
-                total_usd += total_profit
-
+        for entry in entries:
+            tx = transactions.get(entry.transaction_id)
+            benefited_amount = tx.benefited_amount if tx else entry.profit_amount
+            tax_rate = tx.tax_rate if tx else 0.0
             transaction_list.append({
-                "id": tx.id,
-                "date": tx.date.strftime("%Y-%m-%d %H:%M:%S"),
-                "benefited_amount": float(tx.benefited_amount),
-                "tax_rate": float(tx.tax_rate),
-                "tax_amount": float(tax_amount),
-                "benefited_profit": float(benefited_profit),
-                "tax_profit": float(tax_profit),
-                "profit": float(total_profit),
-                "currency": tx.currency,
-                "status": tx.status
+                "id": entry.transaction_id,
+                "date": entry.date.strftime("%Y-%m-%d %H:%M:%S"),
+                "benefited_amount": float(benefited_amount),
+                "tax_rate": float(tax_rate),
+                "tax_amount": float(benefited_amount * (tax_rate / 100)),
+                "benefited_profit": float(entry.profit_amount),
+                "tax_profit": 0.0,  # الضريبة ليست ربح للفرع المرسل
+                "profit": float(entry.profit_amount),
+                "currency": entry.currency,
+                "status": tx.status if tx else "completed"
             })
 
         return {
-            "total_profits_syp": float(total_syp),
-            "total_profits_usd": float(total_usd),
-            "total_transactions": len(transactions),
-            "transactions": transaction_list
+            "total_profits_syp": float(totals.get("SYP", (0, 0.0))[1]),
+            "total_profits_usd": float(totals.get("USD", (0, 0.0))[1]),
+            "total_transactions": total,
+            "transactions": transaction_list,
+            "page": page,
+            "per_page": per_page,
+            "total_pages": (total + per_page - 1) // per_page if per_page is not None else 1
         }
 
     except Exception as e:
@@ -2473,6 +3180,52 @@ async def get_branch_profits(
             detail=f"Error retrieving profits data: {str(e)}"
         )
 
+PROFIT_EXPORT_COLUMNS = ["transaction_id", "date", "source_type", "currency", "profit_amount"]
+
+@app.get("/api/branches/{branch_id}/profits/export/")
+def export_branch_profits(
+    branch_id: int,
+    request: Request,
+    format: str = "csv",
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    currency: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Stream a branch's ledger entries, profit and tax, as CSV, NDJSON or XLSX."""
+    if current_user["role"] != "branch_manager" or current_user["branch_id"] != branch_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only branch managers can view their own branch profits"
+        )
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format. Use: {', '.join(EXPORT_FORMATS)}")
+    predicates = profit_ledger_filters(branch_id, start_date, end_date, currency, source_type=None)
+
+    # Same session handling as the transaction report export
+    db = ReaderSessionLocal()
+
+    def rows():
+        try:
+            query = db.query(
+                BranchProfits.transaction_id,
+                BranchProfits.date,
+                BranchProfits.source_type,
+                BranchProfits.currency,
+                BranchProfits.profit_amount
+            ).filter(*predicates).order_by(BranchProfits.date.desc(), BranchProfits.id.desc())
+            for entry in query.yield_per(EXPORT_BATCH_SIZE):
+                yield tuple(entry)
+        finally:
+            db.close()
+
+    filename = f"branch_{branch_id}_profits_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    response = streaming_export(
+        PROFIT_EXPORT_COLUMNS, rows(), format, filename, request.headers.get("accept-encoding", "")
+    )
+    response.background = BackgroundTask(db.close)
+    return response
+
 @app.get("/api/branches/{branch_id}/profits/summary/")
 async def get_branch_profits_summary(
     branch_id: int,
@@ -2498,24 +3251,6 @@ async def get_branch_profits_summary(
         else:  # all-time
             start_date = None
 
-        # Build query
-        query = db.query(
-            func.sum(Transaction.benefited_amount - (Transaction.benefited_amount * (Transaction.tax_rate / 100))).label('profit'),
-            Transaction.currency
-        ).filter(
-            Transaction.branch_id == branch_id,
-            Transaction.status == 'completed'
-        )
-
-        if start_date:
-            query = query.filter(Transaction.date >= start_date)
-
-        # Group by currency
-        query = query.group_by(Transaction.currency)
-
-        # Execute query
-        results = query.all()
-
         # Format results
         summary = {
             "period": period,
@@ -2525,9 +3260,10 @@ async def get_branch_profits_summary(
             }
         }
 
-        for profit, currency in results:
+        # Whole months from the rollups, never the ledger itself
+        for currency, bucket in rollup_totals(db, branch_id, start_date).items():
             if currency in summary["profits"]:
-                summary["profits"][currency] = float(profit or 0)
+                summary["profits"][currency] = bucket["profit_sum"]
 
         return summary
 
@@ -2553,22 +3289,6 @@ async def get_branch_profits_statistics(
         )
 
     try:
-        # Get total transactions and average profit per transaction
-        stats = db.query(
-            func.count(Transaction.id).label('total_transactions'),
-            func.avg(Transaction.benefited_amount - (Transaction.benefited_amount * (Transaction.tax_rate / 100))).label('avg_profit'),
-            Transaction.currency
-        ).filter(
-            Transaction.branch_id == branch_id,
-            Transaction.status == 'completed'
-        ).group_by(Transaction.currency).all()
-
-        # Calculate highest profit transaction
-        highest_profit_tx = db.query(Transaction).filter(
-            Transaction.branch_id == branch_id,
-            Transaction.status == 'completed'
-        ).order_by(desc(Transaction.benefited_amount - (Transaction.benefited_amount * (Transaction.tax_rate / 100)))).first()
-
         # Format statistics
         statistics = {
             "total_transactions": {},
@@ -2581,17 +3301,20 @@ async def get_branch_profits_statistics(
             }
         }
 
-        for count, avg, currency in stats:
-            statistics["total_transactions"][currency] = count
-            statistics["average_profit"][currency] = float(avg or 0)
+        # Counts and sums come from the rollups, the highest profit from the maintained top-N
+        for currency, bucket in rollup_totals(db, branch_id).items():
+            statistics["total_transactions"][currency] = bucket["entries"]
+            statistics["average_profit"][currency] = float(
+                bucket["profit_sum"] / bucket["entries"] if bucket["entries"] else 0
+            )
 
-        if highest_profit_tx:
-            profit = highest_profit_tx.benefited_amount - (highest_profit_tx.benefited_amount * (highest_profit_tx.tax_rate / 100))
+        highest = top_profits(db, branch_id, limit=1)
+        if highest:
             statistics["highest_profit"] = {
-                "amount": float(profit),
-                "currency": highest_profit_tx.currency,
-                "date": highest_profit_tx.date.strftime("%Y-%m-%d %H:%M:%S"),
-                "transaction_id": highest_profit_tx.id
+                "amount": float(highest[0].profit_amount),
+                "currency": highest[0].currency,
+                "date": highest[0].date.strftime("%Y-%m-%d %H:%M:%S") if highest[0].date else None,
+                "transaction_id": highest[0].transaction_id
             }
 
         return statistics
@@ -2622,7 +3345,7 @@ async def validation_exception_handler(request: Request, exc: FastAPIRequestVali
         status_code=422,
         content={
             "detail": "المدخلات غير صحيحة. الرجاء التحقق من البيانات المدخلة.",
-            "errors": exc.errors(),
+            "errors": jsonable_encoder(exc.errors()),
         },
     )
 
@@ -2671,9 +3394,18 @@ def get_metrics():
         "total_requests": metrics['total_requests'],
         "successful_requests": metrics['successful_requests'],
         "failed_requests": metrics['failed_requests'],
-        "average_duration": round(avg_duration, 4)
+        "average_duration": round(avg_duration, 4),
+        "event_clients": event_broker.clients(),
+        "events_published": event_broker.stats["published"]
     }
 
+@app.get("/metrics/indexes/")
+def get_index_usage(current_user: dict = Depends(get_current_user)):
+    """Index scan counts and sizes, to find indexes that only cost writes"""
+    if current_user["role"] != "director":
+        raise HTTPException(status_code=403, detail="Director access required")
+    return index_usage_report(engine)
+
 def require_role(current_user, allowed_roles):
     if current_user["role"] not in allowed_roles:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="ليس لديك الصلاحية الكافية.")
@@ -2682,6 +3414,81 @@ def require_branch_access(current_user, branch_id):
     if current_user["role"] == "branch_manager" and current_user["branch_id"] != branch_id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="يمكنك فقط إدارة فرعك.")
 
+class ReportJobRequest(BaseModel):
+    report_type: str
+    start_date: str
+    end_date: Optional[str] = None
+    branch_id: Optional[int] = None
+
+def _report_job_view(record: dict) -> dict:
+    return {
+        "job_id": record["job_id"],
+        "status": record["status"],
+        "report_type": (record.get("params") or {}).get("report_type"),
+        "partitions": record.get("partitions"),
+        "submitted_at": record.get("submitted_at"),
+        "finished_at": record.get("finished_at"),
+        "error": record.get("error")
+    }
+
+def _get_report_job_for_user(job_id: str, current_user: dict) -> dict:
+    require_role(current_user, ["director", "branch_manager"])
+    record = report_jobs.get_status(job_id)
+    if not record:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    if current_user["role"] == "branch_manager":
+        params = record.get("params") or {}
+        if params.get("branch_id") != current_user["branch_id"]:
+            raise HTTPException(status_code=403, detail="Can only access your branch's data")
+    return record
+
+@app.post("/report-jobs/", status_code=202)
+def submit_report_job(job: ReportJobRequest, current_user: dict = Depends(get_current_user)):
+    """Queue a report (daily, branch, currency, tax_summary, daily_summary) for background computation.
+
+    Identical requests share a job id; finished results for past date ranges
+    are reused indefinitely.
+    """
+    require_role(current_user, ["director", "branch_manager"])
+    if job.report_type not in REPORT_TYPES:
+        raise HTTPException(status_code=400, detail=f"Invalid report type. Use: {', '.join(REPORT_TYPES)}")
+    end_date = job.end_date or datetime.now().strftime("%Y-%m-%d")
+    try:
+        start = datetime.strptime(job.start_date, "%Y-%m-%d")
+        end = datetime.strptime(end_date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+    if end < start:
+        raise HTTPException(status_code=400, detail="end_date must not be before start_date")
+
+    branch_id = job.branch_id
+    if current_user["role"] == "branch_manager":
+        if branch_id is not None and branch_id != current_user["branch_id"]:
+            raise HTTPException(status_code=403, detail="Can only access your branch's data")
+        branch_id = current_user["branch_id"]
+
+    params = {
+        "report_type": job.report_type,
+        "start_date": job.start_date,
+        "end_date": end_date,
+        "branch_id": branch_id
+    }
+    return _report_job_view(report_jobs.submit(params))
+
+@app.get("/report-jobs/{job_id}/")
+def get_report_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    return _report_job_view(_get_report_job_for_user(job_id, current_user))
+
+@app.get("/report-jobs/{job_id}/result/")
+def download_report_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    record = _get_report_job_for_user(job_id, current_user)
+    if record["status"] == "failed":
+        raise HTTPException(status_code=500, detail=f"Report job failed: {record.get('error')}")
+    path = artifact_path(job_id)
+    if record["status"] != "done" or not os.path.exists(path):
+        raise HTTPException(status_code=409, detail="Report is not ready yet")
+    return FileResponse(path, media_type="application/json")
+
 @app.get("/reports/daily/")
 def get_daily_summary(
     db: Session = Depends(get_db),
@@ -0,0 +1,132 @@
+import logging
+import os
+import sys
+import time
+
+from sqlalchemy import update
+
+from models import Transaction
+
+logger = logging.getLogger(__name__)
+
+# Status changes are optimistic: the transaction is read without a lock, the
+# follow-up work (profits, notification) is done, and the status is written
+# last with a compare-and-swap on transactions.version. A writer that lost the
+# race rolls back and starts over from a fresh read, so row locks are only held
+# from that final UPDATE to the commit right after it.
+
+STATUS_UPDATE_RETRIES = int(os.getenv("STATUS_UPDATE_RETRIES", "3"))
+
+
+def compare_and_set(db, transaction: Transaction, *conditions, **values) -> bool:
+    """UPDATE the transaction WHERE its version is still the one that was read; False if it moved on.
+
+    Bumps the version. Extra conditions guard columns that change without a
+    version bump (the payout lease). Runs in the caller's transaction, and the
+    row stays locked until it commits or rolls back.
+    """
+    return db.execute(
+        update(Transaction).where(
+            Transaction.id == transaction.id,
+            Transaction.date == transaction.date,
+            Transaction.version == transaction.version,
+            *conditions
+        ).values(version=Transaction.version + 1, **values)
+    ).rowcount == 1
+
+
+def benchmark_status_updates(updater_levels=(1, 8, 32), hot_rows=(64, 4), updates_per: int = 40,
+                             work_ms: float = 2.0):
+    """Status updates/s and p50/p99 latency, row lock for the whole request vs compare-and-swap.
+
+    Each updater flips a random transaction of `rows` between processing and
+    pending, with `work_ms` of bookkeeping (standing in for profit recording)
+    between reading the row and writing its status. Optimistic updaters retry
+    up to STATUS_UPDATE_RETRIES times; the ones still losing are counted as
+    conflicts. Rows are tagged and deleted afterwards; run against a scratch
+    database.
+    """
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.orm import sessionmaker
+    from database import DATABASE_URL
+    from group_commit import _bench_rows, _bench_cleanup, _percentiles, insert_transfers
+
+    bind = create_engine(DATABASE_URL, pool_size=10, max_overflow=30)
+    Session = sessionmaker(autoflush=False, bind=bind)
+    work = text("SELECT pg_sleep(:seconds)")
+
+    def flipped(status):
+        return "pending" if status == "processing" else "processing"
+
+    def pessimistic(db, key):
+        transaction = db.query(Transaction).filter(
+            Transaction.id == key[0], Transaction.date == key[1]
+        ).with_for_update().one()
+        db.execute(work, {"seconds": work_ms / 1000})
+        transaction.status = flipped(transaction.status)
+        db.commit()
+        return 0
+
+    def optimistic(db, key):
+        for attempt in range(STATUS_UPDATE_RETRIES + 1):
+            transaction = db.query(Transaction).filter(
+                Transaction.id == key[0], Transaction.date == key[1]
+            ).one()
+            db.execute(work, {"seconds": work_ms / 1000})
+            if compare_and_set(db, transaction, status=flipped(transaction.status)):
+                db.commit()
+                return attempt
+            db.rollback()
+        return None
+
+    results = []
+    for rows in hot_rows:
+        writes = [_bench_rows() for _ in range(rows)]
+        with bind.begin() as conn:
+            insert_transfers(conn, writes)
+        keys = [(write["transaction"]["id"], write["transaction"]["date"]) for write in writes]
+        for updaters in updater_levels:
+            for label, write in (("row lock", pessimistic), ("compare-and-swap", optimistic)):
+                def updater(seed):
+                    rng = random.Random(seed)
+                    latencies, retries, conflicts = [], 0, 0
+                    db = Session()
+                    try:
+                        for _ in range(updates_per):
+                            started = time.perf_counter()
+                            outcome = write(db, rng.choice(keys))
+                            latencies.append(time.perf_counter() - started)
+                            if outcome is None:
+                                conflicts += 1
+                            else:
+                                retries += outcome
+                    finally:
+                        db.close()
+                    return latencies, retries, conflicts
+
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=updaters) as pool:
+                    outcomes = list(pool.map(updater, range(updaters)))
+                elapsed = time.perf_counter() - started
+                latencies = [latency for own, _, _ in outcomes for latency in own]
+                results.append(dict(
+                    rows=rows, updaters=updaters, mode=label, per_second=len(latencies) / elapsed,
+                    retries=sum(retries for _, retries, _ in outcomes),
+                    conflicts=sum(conflicts for _, _, conflicts in outcomes),
+                    **_percentiles(latencies)
+                ))
+        _bench_cleanup(bind)
+    bind.dispose()
+    return results
+
+
+if __name__ == "__main__":
+    # python transitions.py [updates_per] [work_ms]   concurrent status updates, row lock vs CAS
+    updates_per = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    work_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+    for row in benchmark_status_updates(updates_per=updates_per, work_ms=work_ms):
+        print(f"{row['rows']:>3d} rows {row['updaters']:>3d} updaters  {row['mode']:17s} "
+              f"{row['per_second']:>7.0f} updates/s   p50 {row['p50_ms']:6.1f} ms   p99 {row['p99_ms']:7.1f} ms   "
+              f"{row['retries']:>4d} retries  {row['conflicts']:>3d} conflicts")
@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import secrets
+import sys
+import time
+from typing import Optional, Iterable, List
+
+from fastapi import Request, Response
+
+from cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Conditional GETs for endpoints the dashboards poll. Each resource ("branches",
+# "users", "transactions", "branch:3", ...) has a counter in Redis that the
+# write paths bump after they commit. A response's ETag is derived from the
+# counters it depends on, read *before* the query runs, plus whatever else
+# shapes the body (role, branch, query parameters). A request whose
+# If-None-Match still matches gets a 304 from one Redis MGET, without touching
+# the database or building the body.
+#
+# The counters live next to a random epoch. If Redis loses them (restart,
+# flush) the epoch changes with them, so an old ETag can never match a counter
+# that restarted from zero. Without Redis no ETag is sent at all: a counter
+# only this worker knows about could miss another worker's writes.
+
+VERSION_PREFIX = "version:"
+EPOCH_KEY = VERSION_PREFIX + "epoch"
+CACHE_CONTROL = "private, no-cache"
+
+
+class ResourceVersions:
+    def __init__(self):
+        self._lost_bump = False
+
+    def bump(self, *names: str):
+        """Mark resources as changed; call after the change is committed"""
+        names = [name for name in names if name]
+        if not names or cache.redis_client is None:
+            return
+        try:
+            pipe = cache.redis_client.pipeline(transaction=False)
+            for name in names:
+                pipe.incr(VERSION_PREFIX + name)
+            pipe.execute()
+        except Exception as e:
+            # A lost bump could let a stale ETag match; the next successful read starts a new epoch
+            self._lost_bump = True
+            logger.error(f"Resource version bump failed for {names}: {str(e)}")
+
+    def reset(self):
+        """Invalidate every ETag at once (bulk changes such as a backup restore)"""
+        try:
+            if cache.redis_client is not None:
+                cache.redis_client.delete(EPOCH_KEY)
+        except Exception as e:
+            self._lost_bump = True
+            logger.error(f"Resource version reset failed: {str(e)}")
+
+    def etag(self, names: Iterable[str], *variant) -> Optional[str]:
+        """Strong ETag for a response built from `names` and shaped by `variant`; None without Redis"""
+        names = list(names)
+        if cache.redis_client is None:
+            return None
+        try:
+            if self._lost_bump:
+                cache.redis_client.delete(EPOCH_KEY)
+                self._lost_bump = False
+            values = cache.redis_client.mget([EPOCH_KEY] + [VERSION_PREFIX + name for name in names])
+            epoch = values[0]
+            if epoch is None:
+                cache.redis_client.set(EPOCH_KEY, secrets.token_hex(8), nx=True)
+                epoch = cache.redis_client.get(EPOCH_KEY)
+        except Exception as e:
+            logger.error(f"Resource version read failed: {str(e)}")
+            return None
+        state = "|".join([epoch or ""] + [f"{name}={value or 0}" for name, value in zip(names, values[1:])]
+                         + [repr(part) for part in variant])
+        return '"' + hashlib.blake2b(state.encode("utf-8"), digest_size=12).hexdigest() + '"'
+
+
+def _matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison: W/"x" matches "x"
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def conditional_get(request: Request, response: Response, names: Iterable[str], *variant) -> Optional[Response]:
+    """A 304 when the client's copy is current; otherwise None, with the ETag set on `response`"""
+    etag = resource_versions.etag(names, request.url.path, *variant)
+    if etag is None:
+        return None
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match and _matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CACHE_CONTROL})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    return None
+
+
+def branch_version(branch_id) -> str:
+    return f"branch:{branch_id}"
+
+
+def transactions_changed(branch_ids: Iterable[Optional[int]]):
+    """Bump what transfers feed: /activity/ and the branches' financial stats"""
+    resource_versions.bump("transactions", *(branch_version(branch) for branch in set(branch_ids) if branch is not None))
+
+
+# Create a global version store for this worker
+resource_versions = ResourceVersions()
+
+
+def benchmark_conditional_gets(polls: int = 200) -> List[dict]:
+    """Per-poll time and bytes on the polled endpoints, plain GET vs If-None-Match revalidation"""
+    from fastapi.testclient import TestClient
+    from security import create_jwt_token
+    import server_improved
+
+    client = TestClient(server_improved.app)
+    token = create_jwt_token({"username": "benchmark", "role": "director", "branch_id": 0, "user_id": 0})
+    headers = {"Authorization": f"Bearer {token}"}
+    results = []
+    for path in ("/branches/", "/branches/1", "/financial/total/", "/activity/", "/users/stats/", "/check-initialization/"):
+        first = client.get(path, headers=headers)
+        etag = first.headers.get("ETag")
+        for label, extra in (("GET", {}), ("If-None-Match", {"If-None-Match": etag} if etag else {})):
+            sent, statuses = 0, set()
+            started = time.perf_counter()
+            for _ in range(polls):
+                response = client.get(path, headers={**headers, **extra})
+                sent += len(response.content)
+                statuses.add(response.status_code)
+            results.append(dict(path=path, mode=label, ms=(time.perf_counter() - started) / polls * 1000,
+                                bytes=sent / polls, statuses=sorted(statuses)))
+    return results
+
+
+if __name__ == "__main__":
+    # python versions.py [polls]   poll cost with and without conditional GETs
+    logging.disable(logging.INFO)  # the server logs every request
+    polls = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    for row in benchmark_conditional_gets(polls):
+        print(f"{row['path']:24s} {row['mode']:14s} {row['ms']:7.2f} ms/poll  {row['bytes']:8.0f} bytes/poll  {row['statuses']}")